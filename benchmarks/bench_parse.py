@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+#==============================================================================
+#title           :bench_parse.py
+#description     :Offline benchmark of the search_products callbacks and pipeline.
+#usage           :python -m benchmarks.bench_parse --reviews-option 3 --rounds 20
+#python version  :3.6
+#==============================================================================
+
+import json
+import time
+import argparse
+import tracemalloc
+from collections import defaultdict, deque
+from urllib.parse import parse_qsl
+from scrapy.http import Request, TextResponse
+from etsy.pipelines import EtsyPipeline
+from benchmarks.replay import create_spider, fixture_body, fixture_response
+
+# Fake session cookie (usually added by the CookiesMiddleware)
+SESSION_COOKIE = b'uaid=benchmark0123456789; user_prefs=abc'
+
+
+# Choose the fixture that answers a request
+def fixture_for(request):
+    url = request.url
+    if '/search?' in url:
+        return 'search_page.html'
+    if '/listing/' in url:
+        return 'listing_page.html'
+    if '/api/v3/ajax/' in url:
+        return 'ajax_reviews.json'
+    if '/reviews' in url:
+        return 'shop_reviews_page2.html' if 'page=2' in url else 'shop_reviews_page1.html'
+    raise ValueError('There is no fixture for {}'.format(url))
+
+
+# The Ajax fixture has the reviews of one product, the same reviews are returned for each spec of the batch
+def ajax_response(request):
+    reviews = json.loads(fixture_body('ajax_reviews.json'))['output']['reviews']
+    specs = set(key[len('specs['):].split(']')[0] for key, _ in parse_qsl(request.body.decode('utf-8'))
+                if key.startswith('specs['))
+    body = json.dumps({'output': {spec: reviews for spec in specs}})
+    return TextResponse(url=request.url, body=body, encoding='utf-8', request=request,
+                        headers={'Content-Type': 'application/json'})
+
+
+# Replay one search page and all requests generated from it (except the next search page)
+# Returns the number of pages processed and the items generated
+def replay_crawl(spider, pipeline, latencies):
+    pages = 0
+    items = []
+    queue = deque(spider.start_requests())
+
+    while queue or spider.ajax_batch:
+        # Nothing else to do, send the products waiting for the Ajax request (as in the spider_idle signal)
+        if not queue:
+            queue.extend(spider.flush_ajax_batches())
+
+        request = queue.popleft()
+        if '/listing/' in request.url:
+            request.headers.setdefault('Cookie', SESSION_COOKIE)
+
+        callback = request.callback or spider.parse
+        if '/api/v3/ajax/' in request.url:
+            response = ajax_response(request)
+        else:
+            response = fixture_response(fixture_for(request), request=request)
+
+        start = time.perf_counter()
+        results = list(callback(response))
+        latencies[callback.__name__].append(time.perf_counter() - start)
+        pages += 1
+
+        for result in results:
+            if isinstance(result, Request):
+                # Only the first search page is replayed
+                if '/search?' not in result.url:
+                    queue.append(result)
+            else:
+                start = time.perf_counter()
+                items.append(pipeline.process_item(result, spider))
+                latencies['pipeline'].append(time.perf_counter() - start)
+
+    return pages, items
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def run(reviews_option, rounds, cards=False, json_ld=True):
+    settings = {'LISTING_JSON_LD': json_ld}
+    latencies = defaultdict(list)
+    pages = 0
+    items = 0
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        spider = create_spider(settings, reviews_option=reviews_option, cards=cards)
+        round_pages, round_items = replay_crawl(spider, EtsyPipeline(), latencies)
+        spider.closed('finished')
+        pages += round_pages
+        items += len(round_items)
+    elapsed = time.perf_counter() - start
+
+    # Measure the memory in a separate round, tracemalloc slows down the code
+    tracemalloc.start()
+    spider = create_spider(settings, reviews_option=reviews_option, cards=cards)
+    replay_crawl(spider, EtsyPipeline(), defaultdict(list))
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    spider.closed('finished')
+
+    print('Reviews option: {} - Cards: {} - JSON-LD: {} - Rounds: {}'.format(reviews_option, cards, json_ld, rounds))
+    print('Pages: {} ({:.1f} pages/sec)'.format(pages, pages / elapsed))
+    print('Items: {} ({:.1f} items/sec)'.format(items, items / elapsed))
+    print('Peak memory per round: {:.2f} MB'.format(peak_memory / 1024.0 / 1024.0))
+    print()
+    print('{:<22}{:>8}{:>12}{:>12}{:>12}'.format('callback', 'calls', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)'))
+    for name, values in sorted(latencies.items()):
+        print('{:<22}{:>8}{:>12.3f}{:>12.3f}{:>12.3f}'.format(
+            name, len(values), percentile(values, 50) * 1000,
+            percentile(values, 90) * 1000, percentile(values, 99) * 1000))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the search_products callbacks with offline fixtures')
+    parser.add_argument('--reviews-option', type=int, default=1, choices=[1, 2, 3])
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--cards', action='store_true', help='get the products data from the search page')
+    parser.add_argument('--no-json-ld', action='store_true', help='get the product fields only with the XPaths')
+    args = parser.parse_args()
+
+    run(args.reviews_option, args.rounds, args.cards, not args.no_json_ld)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+#==============================================================================
+#title           :bench_reviews_memory.py
+#description     :Memory used by the store's reviews pages (reviews option 3) of a large synthetic store.
+#usage           :python -m benchmarks.bench_reviews_memory --pages 500 --listings 3000 --products 50
+#python version  :3.6
+#==============================================================================
+
+import time
+import argparse
+import tracemalloc
+from scrapy.http import HtmlResponse, Request
+from scrapy.loader import ItemLoader
+from etsy.items import ProductItem
+from benchmarks.replay import create_spider
+
+STORE_NAME = 'BigShop'
+REVIEWS_PER_PAGE = 30
+
+REVIEW_HTML = '''
+      <li class="col-group pl-xs-0 pr-xs-0" data-region="review">
+        <div class="col-xs-12 col-md-4">
+          <p class="shop2-review-attribution">
+            <a href="https://www.etsy.com/people/User{n}?ref=shop_review">User {n}</a>
+            on Dec 28, 2019
+          </p>
+        </div>
+        <div class="col-xs-12 col-md-8">
+          <span class="stars-svg"><input type="hidden" name="rating" value="{rating}"></span>
+          <div class="text-gray-lighter">
+            <p class="break-word">Review number {n} of the listing {listing_id}, lovely print, fast shipping, exactly as described.</p>
+          </div>
+          <div class="flag" data-region="listing">
+            <a href="https://www.etsy.com/listing/{listing_id}/item-{listing_id}?ref=shop_review"><img src="https://i.etsystatic.com/thumb{listing_id}.jpg" alt=""></a>
+          </div>
+        </div>
+      </li>'''
+
+NEXT_PAGE_HTML = '''
+    <div class="pagination">
+      <a href="https://www.etsy.com/shop/{store}/reviews?ref=pagination&amp;page={page}"><span>Next page</span></a>
+    </div>'''
+
+
+def listing_id(n):
+    return str(700000000 + n)
+
+
+# Build a reviews page of the synthetic store, the reviews are spread over all the listings
+def reviews_page(page, pages, listings):
+    reviews = []
+    for i in range(REVIEWS_PER_PAGE):
+        n = (page - 1) * REVIEWS_PER_PAGE + i
+        reviews.append(REVIEW_HTML.format(n=n, rating=n % 5 + 1, listing_id=listing_id(n % listings)))
+    next_page = NEXT_PAGE_HTML.format(store=STORE_NAME, page=page + 1) if page < pages else ''
+    return ('<html><body><div class="reviews"><ul class="list-unstyled">{}</ul>{}</div></body></html>'
+            .format(''.join(reviews), next_page)).encode('utf-8')
+
+
+# Visit all reviews pages of the store with some products waiting for the reviews
+# Returns the items, the peak memory and the memory still used after the last page
+def run_walk(pages, listings, products):
+    spider = create_spider(reviews_option=3)
+    spider.shops[STORE_NAME] = {'done': False, 'pending': []}
+    for n in range(products):
+        l = ItemLoader(item=ProductItem())
+        l.add_value('product_id', listing_id(n))
+        spider.shops[STORE_NAME]['pending'].append((listing_id(n), l))
+
+    request = spider.shop_reviews_request('https://www.etsy.com/shop/{}/reviews?ref=l2-see-more-feedback'.format(STORE_NAME),
+                                          STORE_NAME)
+    items = []
+    page = 1
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    while request is not None:
+        response = HtmlResponse(url=request.url, body=reviews_page(page, pages, listings), encoding='utf-8', request=request)
+        results = list(request.callback(response))
+        request = None
+        for result in results:
+            if isinstance(result, Request):
+                request = result
+            else:
+                items.append(result)
+        page += 1
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    spider.closed('finished')
+    return items, elapsed, peak, current
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Memory used by the reviews pages of a large store (reviews option 3)')
+    parser.add_argument('--pages', type=int, default=500, help='number of reviews pages of the store')
+    parser.add_argument('--listings', type=int, default=3000, help='number of listings with reviews')
+    parser.add_argument('--products', type=int, default=50, help='number of products waiting for the reviews')
+    args = parser.parse_args()
+
+    items, elapsed, peak, current = run_walk(args.pages, args.listings, args.products)
+    reviews = sum(len(item.get('reviews', [])) for item in items)
+
+    print('Store reviews: {} pages, {} reviews, {} listings'.format(args.pages, args.pages * REVIEWS_PER_PAGE, args.listings))
+    print('Products: {} ({} reviews)'.format(len(items), reviews))
+    print('Time: {:.2f}s ({:.1f} pages/sec)'.format(elapsed, args.pages / elapsed))
+    print('Peak memory: {:.2f} MB'.format(peak / 1024.0 / 1024.0))
+    print('Memory after the last page: {:.2f} MB'.format(current / 1024.0 / 1024.0))
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+#==============================================================================
+#title           :bench_selectors.py
+#description     :Compare the per-review XPath queries with the compiled extractors.
+#usage           :python -m benchmarks.bench_selectors --rounds 200
+#python version  :3.6
+#==============================================================================
+
+import json
+import time
+import argparse
+import scrapy
+from etsy import extractors
+from etsy.normalization import parse_price
+from benchmarks.replay import fixture_response
+
+
+# Previous implementation: one Selector query for each field of each review
+def listing_reviews_xpath(sel):
+    reviews = []
+    for r in sel.xpath('//*[@class="listing-page__review col-group pl-xs-0 pr-xs-0"]'):
+        reviews.append({
+            'profile': r.xpath(".//*[@class='display-block']/parent::*//@href").extract_first(),
+            'date': r.xpath(".//*[@class='text-link-underline display-inline-block mr-xs-1']/parent::*//text()").extract()[2],
+            'rating': r.xpath('.//input[@name="rating"]/@value').extract_first(),
+            'content': " ".join(r.xpath('.//div[@class="overflow-hidden"]//text()').extract()).strip(),
+            'listing_id': None,
+        })
+    return reviews
+
+
+def shop_reviews_xpath(sel):
+    reviews = []
+    for r in sel.xpath("//*[@data-region='review']"):
+        reviews.append({
+            'profile': r.xpath(".//*[@class='shop2-review-attribution']//@href").extract_first(),
+            'date': r.xpath(".//*[@class='shop2-review-attribution']//text()").extract()[2],
+            'rating': r.xpath('.//input[@name="rating"]/@value').extract_first(),
+            'content': " ".join(r.xpath('.//div[@class="text-gray-lighter"]//text()').extract()).strip(),
+            'listing_id': r.xpath(".//*[@data-region='listing']//@href").extract_first().split('/')[4],
+        })
+    return reviews
+
+
+# Fields of the product's page that are also in the JSON-LD block (the price is compared as a number)
+def listing_fields_xpath(sel):
+    images = sel.xpath('//ul[@data-carousel-pagination-list=""]/li/img/@data-src-delay').extract()
+    return {
+        'title': ' '.join(sel.xpath('//div[@data-component="listing-page-title-component"]/h1/text()').extract_first().split()),
+        'price': parse_price(sel.xpath('normalize-space(//*[contains(@data-buy-box-region, "price")]//p)').extract_first())[0],
+        'rating': sel.xpath('//a[@href="#reviews"]//input[@name="rating"]/@value').extract_first(),
+        'number_of_reviews': sel.xpath('//button[@id="same-listing-reviews-tab"]/span/text()').extract_first().strip(),
+        'store_name': sel.xpath('//div[@id="listing-page-cart"]//span/text()').extract_first(),
+        'images_urls': images,
+    }
+
+
+def listing_fields_json_ld(root):
+    fields = extractors.listing_json_ld(root)
+    return {
+        'title': fields['title'],
+        'price': parse_price(fields['price'])[0],
+        'rating': fields['rating'],
+        'number_of_reviews': fields['number_of_reviews'],
+        'store_name': fields['store_name'],
+        'images_urls': fields['images_urls'],
+    }
+
+
+def search_xpath(sel):
+    return sel.xpath('//div[@data-search-results=""]/div//li//a/@href').extract()
+
+
+def timeit(func, arg, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func(arg)
+    return (time.perf_counter() - start) / rounds
+
+
+def run(rounds):
+    ajax_html = json.loads(fixture_response('ajax_reviews.json').text)['output']['reviews']
+    cases = [
+        ('search page', search_xpath, extractors.SEARCH_PRODUCTS_HREFS,
+         fixture_response('search_page.html').selector),
+        ('ajax reviews', listing_reviews_xpath, extractors.listing_reviews.extract,
+         scrapy.Selector(text=ajax_html)),
+        ('shop reviews page', shop_reviews_xpath, extractors.shop_reviews.extract,
+         fixture_response('shop_reviews_page1.html').selector),
+        ('listing fields', listing_fields_xpath, listing_fields_json_ld,
+         fixture_response('listing_page.html').selector),
+    ]
+
+    print('{:<20}{:>14}{:>14}{:>10}'.format('page', 'xpath (ms)', 'compiled (ms)', 'speedup'))
+    for name, old, new, sel in cases:
+        # Both implementations must return the same data
+        assert old(sel) == new(sel.root), 'Different results for {}'.format(name)
+
+        old_time = timeit(old, sel, rounds)
+        new_time = timeit(new, sel.root, rounds)
+        print('{:<20}{:>14.3f}{:>14.3f}{:>9.1f}x'.format(name, old_time * 1000, new_time * 1000, old_time / new_time))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the compiled selectors with offline fixtures')
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+
+    run(args.rounds)
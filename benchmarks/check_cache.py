@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+#==============================================================================
+#title           :check_cache.py
+#description     :Save some pages in the ResponseCacheStorage and check its entries and its size.
+#usage           :python -m benchmarks.check_cache
+#python version  :3.6
+#==============================================================================
+
+# A page saved again with the same content (a stale page downloaded again and
+# not modified, as in the daily crawls) must still be read from the cache, and
+# the size of the cache must always be the size of the bodies saved.
+
+import os
+import shutil
+import tempfile
+from scrapy.http import HtmlResponse
+from etsy.middlewares import ResponseCacheStorage
+
+PAGE = b'<html><body>Product</body></html>'
+OTHER_PAGE = b'<html><body>Another product</body></html>'
+
+
+def response(url, body):
+    return HtmlResponse(url, body=body, headers={'ETag': '"v1"'})
+
+
+def files_size(storage):
+    return sum(os.path.getsize(os.path.join(folder, name))
+               for folder, _, names in os.walk(storage.bodies_dir) for name in names)
+
+
+# The size counted by the storage is the size of the bodies in the index and in the folder
+def check_size(storage, step):
+    assert storage.total_size == storage._bodies_size() == files_size(storage), \
+        '{}: size {}, index {}, files {}'.format(step, storage.total_size, storage._bodies_size(), files_size(storage))
+
+
+def check(cache_dir):
+    storage = ResponseCacheStorage(cache_dir, 0)
+
+    # The same page saved twice
+    storage.store('a', response('https://www.etsy.com/listing/1', PAGE))
+    storage.store('a', response('https://www.etsy.com/listing/1', PAGE))
+    entry = storage.get('a')
+    assert entry is not None and entry['body'] == PAGE, entry
+    check_size(storage, 'same page saved twice')
+    print('Same page saved twice: read back, cache size {}'.format(storage.total_size))
+
+    # Two URLs with the same content, one of them is modified
+    storage.store('b', response('https://www.etsy.com/listing/2', PAGE))
+    check_size(storage, 'two URLs with the same content')
+    storage.store('b', response('https://www.etsy.com/listing/2', OTHER_PAGE))
+    assert storage.get('a')['body'] == PAGE and storage.get('b')['body'] == OTHER_PAGE
+    check_size(storage, 'one URL modified')
+    print('Same content for two URLs, then modified: read back, cache size {}'.format(storage.total_size))
+
+    # The entries are still there after the cache is opened again
+    storage.close()
+    storage = ResponseCacheStorage(cache_dir, len(OTHER_PAGE))
+    check_size(storage, 'cache opened again')
+    assert storage.get('a')['body'] == PAGE
+
+    # The least recently used page is evicted to fit in the maximum size
+    evicted = storage.store('a', response('https://www.etsy.com/listing/1', PAGE))
+    assert evicted == 1 and storage.get('b') is None and storage.get('a')['body'] == PAGE, evicted
+    check_size(storage, 'eviction')
+    print('Eviction: {} entry removed, cache size {} (maximum {})'.format(evicted, storage.total_size, storage.max_size))
+    storage.close()
+
+
+if __name__ == '__main__':
+    cache_dir = tempfile.mkdtemp()
+    try:
+        check(cache_dir)
+    finally:
+        shutil.rmtree(cache_dir)
+    print('OK')
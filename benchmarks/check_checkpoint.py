@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+#==============================================================================
+#title           :check_checkpoint.py
+#description     :Stop a crawl over the offline fixtures after a checkpoint, resume it and compare with a full crawl.
+#usage           :python -m benchmarks.check_checkpoint --reviews-option 3
+#python version  :3.6
+#==============================================================================
+
+# The crawl visits SEARCH_PAGES search pages (the next pages are built from the
+# first one with other product IDs) and stops at COUNT_MAX products.
+#
+# 1. The crawl is killed some pages after the last checkpoint was saved (as when
+#    the process dies between two CHECKPOINT_INTERVAL), so the resumed crawl
+#    requests again the pages parsed after the checkpoint. The checkpoint must
+#    have the search pages not parsed yet, and the resumed crawl must scrape all
+#    the products of the full crawl with the same reviews.
+# 2. The crawl is stopped (as with Ctrl+C, the checkpoint and the output files
+#    are saved) and resumed with the same output files. The items go through the
+#    pipelines and the feeds (CSV, the Excel file created next to it and the
+#    reviews file): the files must have all the products and reviews of the full
+#    crawl, once.
+
+import os
+import re
+import csv
+import shutil
+import argparse
+import tempfile
+from collections import deque
+from openpyxl import load_workbook
+from scrapy.extensions.feedexport import FileFeedStorage
+from scrapy.http import HtmlResponse, Request
+from scrapy.utils.misc import load_object
+from etsy.pipelines import EtsyPipeline, ReviewsPipeline
+from benchmarks.replay import create_spider, fixture_body, fixture_response
+from benchmarks.bench_parse import fixture_for, ajax_response, SESSION_COOKIE
+
+# Search pages with products, the next pages are empty
+SEARCH_PAGES = 3
+COUNT_MAX = 100
+LISTING_ID_RE = re.compile(rb'/listing/(\d+)')
+
+
+# The next search pages have the products of the first page with other IDs
+def search_response(request):
+    page = request.meta.get('page', 1)
+    if page > SEARCH_PAGES:
+        return HtmlResponse(request.url, body=b'<html><body></body></html>', encoding='utf-8', request=request)
+    body = LISTING_ID_RE.sub(lambda m: b'/listing/' + str(int(m.group(1)) + (page - 1) * 10**7).encode('ascii'),
+                             fixture_body('search_page.html'))
+    return HtmlResponse(request.url, body=body, encoding='utf-8', request=request)
+
+
+# Replay the requests of the spider
+# The checkpoint is saved after save_at responses and the crawl stops after stop_at responses (or stop_items items)
+# Each item is given to export (the pipelines and the feeds) if it is set
+def replay(spider, save_at=None, stop_at=None, stop_items=None, export=None):
+    queue = deque(spider.start_requests())
+    items = []
+    responses = 0
+    while queue or spider.ajax_batch:
+        if responses == save_at:
+            spider.checkpoint.save(spider.checkpoint_state())
+        if responses == stop_at or (stop_items and len(items) >= stop_items):
+            return items
+
+        # Nothing else to do, send the products waiting for the Ajax request (as in the spider_idle signal)
+        if not queue:
+            queue.extend(spider.flush_ajax_batches())
+
+        request = queue.popleft()
+        if '/listing/' in request.url:
+            request.headers.setdefault('Cookie', SESSION_COOKIE)
+        if '/api/v3/ajax/' in request.url:
+            response = ajax_response(request)
+        elif '/search?' in request.url:
+            response = search_response(request)
+        else:
+            response = fixture_response(fixture_for(request), request=request)
+        responses += 1
+
+        for result in (request.callback or spider.parse)(response):
+            if isinstance(result, Request):
+                queue.append(result)
+            else:
+                items.append(result)
+                if export:
+                    export(result)
+    return items
+
+
+def reviews_key(item):
+    return [(review['profile'], review['rating'], review['date'], review['content']) for review in item.get('reviews', [])]
+
+
+def spooled_reviews(spider):
+    if spider.reviews_spool is None:
+        return None
+    return spider.reviews_spool.db.execute('SELECT COUNT(*) FROM reviews').fetchone()[0]
+
+
+def crawl_spider(reviews_option, folder, name, resume=False):
+    settings = {'SEARCH_PRICE_BANDS': [], 'ETSY_HTTPCACHE_ENABLED': False,
+                'FEEDS': {os.path.join(folder, name + '.csv'): {'format': 'csv'}}}
+    return create_spider(settings, reviews_option=reviews_option, count_max=COUNT_MAX,
+                         checkpoint=os.path.join(folder, name + '.json'), resume=resume)
+
+
+# The pipelines and the feeds of a crawl, as the ItemPipelineManager and the FeedExporter use them
+class Outputs(object):
+
+    def __init__(self, spider):
+        self.spider = spider
+        settings = spider.crawler.settings
+        self.pipelines = [EtsyPipeline(), ReviewsPipeline.from_crawler(spider.crawler)]
+        for pipeline in self.pipelines[1:]:
+            pipeline.open_spider(spider)
+
+        # The options of the feeds are changed by the spider when it is created by Scrapy (see crawl_feeds)
+        self.feeds = []
+        for uri, options in spider.crawl_feeds(settings.getdict('FEEDS')).items():
+            storage = FileFeedStorage(uri, feed_options=options)
+            f = storage.open(spider)
+            exporter = load_object(settings.getwithbase('FEED_EXPORTERS')[options['format']])(
+                f, fields_to_export=settings.getlist('FEED_EXPORT_FIELDS'), **options.get('item_export_kwargs', {}))
+            exporter.start_exporting()
+            self.feeds.append((storage, f, exporter))
+
+    def export(self, item):
+        for pipeline in self.pipelines:
+            item = pipeline.process_item(item, self.spider)
+        for _, _, exporter in self.feeds:
+            exporter.export_item(item)
+
+    def close(self):
+        for pipeline in self.pipelines[1:]:
+            pipeline.close_spider(self.spider)
+        for storage, f, exporter in self.feeds:
+            exporter.finish_exporting()
+            storage.store(f)
+
+
+def read_csv(path):
+    with open(path, newline='', encoding='utf-8') as f:
+        return list(csv.reader(f))
+
+
+def read_xlsx(path):
+    workbook = load_workbook(path, read_only=True)
+    rows = [list(row) for row in workbook.active.iter_rows(values_only=True)]
+    workbook.close()
+    return rows
+
+
+# Crawl killed after the checkpoint (the spider is not closed, the reviews spool is kept)
+def check_killed(reviews_option, save_at, kill_at, folder, full, full_spooled):
+    spider = crawl_spider(reviews_option, folder, 'killed')
+    first = replay(spider, save_at=save_at, stop_at=kill_at)
+    first_spooled = spooled_reviews(spider)
+    state = spider.checkpoint.load()
+    print('Killed after {} pages (checkpoint after {}): {} products, {} products and {} search pages left in the checkpoint'.format(
+        kill_at, save_at, len(first), len(state['products']), len(state['pages'])))
+    assert state['pages'], 'no search pages in the checkpoint'
+
+    # Resumed crawl
+    spider = crawl_spider(reviews_option, folder, 'killed', resume=True)
+    resumed = replay(spider)
+    resumed_spooled = spooled_reviews(spider)
+    spider.closed('finished')
+    print('Resumed: {} products'.format(len(resumed)))
+
+    # The products scraped after the checkpoint are scraped again, the last item of each product is kept
+    scraped = {}
+    for item in first + resumed:
+        scraped[item['product_id']] = reviews_key(item)
+    assert set(scraped) == set(full), 'products missing: {}'.format(sorted(set(full) - set(scraped)))
+    for product_id, reviews in full.items():
+        assert scraped[product_id] == reviews, 'different reviews for {}'.format(product_id)
+    print('Products: {} (full crawl: {}), the reviews of each product are the same'.format(len(scraped), len(full)))
+
+    if full_spooled is not None:
+        assert resumed_spooled == full_spooled, 'reviews spooled: {} (full crawl: {})'.format(resumed_spooled, full_spooled)
+        print('Reviews in the spool: {} before the kill, {} after the resume (full crawl: {})'.format(
+            first_spooled, resumed_spooled, full_spooled))
+
+
+# Crawl stopped (the spider is closed and the output files are saved) and resumed with the same files
+def check_stopped(reviews_option, stop_items, folder, full):
+    spider = crawl_spider(reviews_option, folder, 'stopped')
+    outputs = Outputs(spider)
+    first = replay(spider, stop_items=stop_items, export=outputs.export)
+    outputs.close()
+    spider.checkpoint.save(spider.checkpoint_state())
+    spider.closed('shutdown')
+
+    spider = crawl_spider(reviews_option, folder, 'stopped', resume=True)
+    outputs = Outputs(spider)
+    resumed = replay(spider, export=outputs.export)
+    outputs.close()
+    spider.closed('finished')
+    # Option 3: the products of a store are scraped together when its reviews pages are visited
+    print('Stopped after {} products, resumed: {} products{}'.format(
+        len(first), len(resumed), '' if first and resumed else ' (the output files were written by one crawl only)'))
+
+    fields = spider.crawler.settings.getlist('FEED_EXPORT_FIELDS')
+    product_ids = sorted(full)
+    rows = read_csv(os.path.join(folder, 'stopped.csv'))
+    assert rows[0] == fields and fields not in rows[1:], 'the CSV header is written {} times'.format(rows.count(fields))
+    assert sorted(row[fields.index('product_id')] for row in rows[1:]) == product_ids, 'products in the CSV file'
+
+    rows = read_xlsx(os.path.join(folder, 'stopped.xlsx'))
+    assert rows[0] == fields and fields not in rows[1:], 'the Excel header is written {} times'.format(rows.count(fields))
+    assert sorted(str(row[fields.index('product_id')]) for row in rows[1:]) == product_ids, 'products in the Excel file'
+
+    reviews = sum(len(reviews) for reviews in full.values())
+    reviews_path = os.path.join(folder, 'stopped_reviews.csv')
+    rows = read_csv(reviews_path) if os.path.exists(reviews_path) else [[]]
+    reviews_fields = spider.crawler.settings.getlist('REVIEWS_FEED_EXPORT_FIELDS')
+    assert (rows[0] == reviews_fields and reviews_fields not in rows[1:]) or not reviews, 'the reviews file header'
+    assert len(rows) - 1 == reviews, 'reviews in the file: {} (full crawl: {})'.format(len(rows) - 1, reviews)
+    print('Output files after the resume: {} products in the CSV and Excel files, {} reviews'.format(len(product_ids), reviews))
+
+
+def check(reviews_option, save_at, kill_at, stop_items, folder):
+    # Full crawl
+    spider = crawl_spider(reviews_option, folder, 'full')
+    full = {item['product_id']: reviews_key(item) for item in replay(spider)}
+    full_spooled = spooled_reviews(spider)
+    spider.closed('finished')
+    search_pages = len(spider.search_pages) and spider.search_pages[spider.search_page_url(spider.queries[0], 1)][0]
+    print('Full crawl: {} products, {} search pages'.format(len(full), search_pages))
+    assert len(full) == COUNT_MAX, len(full)
+
+    check_killed(reviews_option, save_at, kill_at, folder, full, full_spooled)
+    check_stopped(reviews_option, stop_items, folder, full)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stop a crawl after a checkpoint, resume it and compare with a full crawl')
+    parser.add_argument('--reviews-option', type=int, default=3, choices=[1, 2, 3])
+    parser.add_argument('--save-at', type=int, default=2, help='number of pages parsed when the checkpoint is saved')
+    parser.add_argument('--kill-at', type=int, default=52, help='number of pages parsed when the crawl is killed')
+    parser.add_argument('--stop-items', type=int, default=COUNT_MAX // 2, help='number of products scraped when the crawl is stopped')
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    try:
+        check(args.reviews_option, args.save_at, args.kill_at, args.stop_items, folder)
+    finally:
+        shutil.rmtree(folder)
+    print('OK')
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+#==============================================================================
+#title           :check_distributed.py
+#description     :Run a distributed crawl with two workers (and one that dies) over the offline fixtures.
+#usage           :python -m benchmarks.check_distributed [--redis-url redis://localhost:6379/15]
+#python version  :3.6
+#==============================================================================
+
+# Without --redis-url the queues are kept in a fakeredis server (pip install fakeredis[lua]).
+# The first worker takes the first search page and dies, so the crawl can only
+# finish if its page is leased again by the other workers. The parsing of one
+# search page fails, its page must be released anyway.
+
+import uuid
+import argparse
+from collections import deque
+from scrapy.exceptions import DontCloseSpider
+from scrapy.http import HtmlResponse, Request, Response
+from etsy.distributed import RedisFrontier
+from etsy.pipelines import EtsyPipeline, DistributedItemPipeline
+from benchmarks.replay import create_spider, fixture_response
+from benchmarks.bench_parse import fixture_for
+
+# fakeredis is only needed when no Redis server is given
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+# Search page that fails while it is parsed
+BROKEN_PAGE = 7
+# Maximum number of responses (the crawl is stuck if it is reached)
+MAX_STEPS = 5000
+
+
+# Replaces the engine of the crawler: the requests sent by the spider_idle signal go to the queue of the worker
+class ReplayEngine(object):
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def crawl(self, request, spider=None):
+        self.queue.append(request)
+
+
+class Worker(object):
+
+    def __init__(self, name, client, crawl_name):
+        self.name = name
+        self.spider = create_spider({'SEARCH_PRICE_BANDS': [], 'ETSY_HTTPCACHE_ENABLED': False}, distributed=crawl_name)
+        self.spider.frontier = RedisFrontier(client, self.spider.frontier.prefix)
+        self.queue = deque()
+        self.spider.crawler.engine = ReplayEngine(self.queue)
+        self.closed = False
+        self.errors = 0
+
+    def start(self):
+        self.queue.extend(self.spider.start_requests())
+
+    # Process one request, returns the items scraped
+    def step(self, pipelines):
+        if not self.queue:
+            try:
+                self.spider.spider_idle(self.spider)
+            except DontCloseSpider:
+                return []
+            self.closed = True
+            return []
+
+        request = self.queue.popleft()
+        callback = request.callback or self.spider.parse
+        items = []
+        try:
+            for result in callback(self.response(request)):
+                if isinstance(result, Request):
+                    self.queue.append(result)
+                else:
+                    for pipeline in pipelines:
+                        result = pipeline.process_item(result, self.spider)
+                    items.append(result)
+        except AttributeError:
+            # The broken page (Scrapy logs the error of the callback and goes on)
+            self.errors += 1
+        return items
+
+    def response(self, request):
+        page = request.meta.get('page', 1)
+        if '/search?' in request.url and page == BROKEN_PAGE:
+            # A response without a selector, the callback fails
+            return Response(request.url, body=b'', request=request)
+        if '/search?' in request.url and page > 1:
+            # The products of the fixture are only in the first page
+            return HtmlResponse(request.url, body=b'<html><body></body></html>', encoding='utf-8', request=request)
+        return fixture_response(fixture_for(request), request=request)
+
+
+def check(client):
+    crawl_name = 'check-{}'.format(uuid.uuid4().hex[:8])
+
+    # The first worker seeds the crawl, takes the first search page and dies
+    dead = Worker('dead', client, crawl_name)
+    dead.spider.frontier.lease_timeout = 0
+    dead.start()
+    assert [request.meta['page'] for request in dead.queue] == [1]
+    frontier = dead.spider.frontier
+    print('Worker dead: took the first search page and stopped')
+
+    workers = [Worker('worker-1', client, crawl_name), Worker('worker-2', client, crawl_name)]
+    for worker in workers:
+        worker.start()
+        assert not worker.queue, 'the search page is still leased by the dead worker'
+
+    pipelines = [EtsyPipeline(), DistributedItemPipeline()]
+    scraped = {worker.name: [] for worker in workers}
+    steps = 0
+    while not all(worker.closed for worker in workers):
+        steps += 1
+        assert steps < MAX_STEPS, 'the workers did not finish'
+        for worker in workers:
+            if not worker.closed:
+                scraped[worker.name].extend(item['product_id'] for item in worker.step(pipelines))
+
+    product_ids = [product_id for ids in scraped.values() for product_id in ids]
+    print('Products scraped: {}'.format(', '.join('{} {}'.format(name, len(ids)) for name, ids in scraped.items())))
+    assert product_ids, 'no products scraped'
+    assert len(product_ids) == len(set(product_ids)), 'products scraped twice'
+    assert sum(worker.errors for worker in workers) == 1, 'the broken page was not parsed'
+    assert frontier.finished()
+    assert not client.zcard(frontier.key('leases')) and not client.llen(frontier.key('pages'))
+
+    items = list(frontier.pop_items())
+    assert sorted(item['product_id'] for item in items) == sorted(product_ids)
+    print('Items in the shared sink: {}'.format(len(items)))
+    print('The page of the dead worker was leased again and the broken page was released ({} steps)'.format(steps))
+
+    for worker in workers + [dead]:
+        worker.spider.closed('finished')
+    frontier.reset()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a distributed crawl with two workers over the offline fixtures')
+    parser.add_argument('--redis-url', help='Redis server used by the check (default: a fakeredis server)')
+    args = parser.parse_args()
+
+    if args.redis_url:
+        import redis
+        client = redis.Redis.from_url(args.redis_url, decode_responses=True)
+    elif fakeredis is None:
+        parser.error('The check requires fakeredis (pip install fakeredis[lua]) or a Redis server (--redis-url)')
+    else:
+        client = fakeredis.FakeRedis(decode_responses=True)
+
+    check(client)
+    print('OK')
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+#==============================================================================
+#title           :check_identities.py
+#description     :Crawl some pages through local proxies with the IdentityPoolMiddleware.
+#usage           :python -m benchmarks.check_identities
+#python version  :3.6
+#==============================================================================
+
+# Three local HTTP proxies answer the pages themselves. The second proxy sends
+# a gzip captcha page for every request, so its identity must be retired after
+# IDENTITY_MAX_BLOCKS pages and its pages requested again with the other
+# identities. The Ajax request of each page must use the proxy, the cookie jar
+# and the user agent of the page, and each identity must respect its rate.
+# Some pages are already in the cache: they must be parsed at once, without
+# going through an identity (only the requests sent to the proxies use the rate
+# of the identities).
+
+import gzip
+import time
+import base64
+import shutil
+import tempfile
+import threading
+from itertools import combinations
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import scrapy
+from scrapy.crawler import CrawlerProcess
+from scrapy.http import HtmlResponse
+from etsy import settings as project_settings
+from etsy.middlewares import EtsyHttpCacheMiddleware, ResponseCacheStorage
+
+PAGES = 12
+# Pages saved in the cache before the crawl
+CACHED_PAGES = 6
+REQUESTS_PER_MINUTE = 120
+MAX_BLOCKS = 3
+PROXY_USER = 'user'
+PROXY_PASSWORD = 'secret'
+# Delay (in seconds) that a request may have between the pool and the proxy
+JITTER = 0.3
+
+PAGE_HTML = '<html><body><h1>Product {}</h1>' + '<p>Description of the product.</p>' * 60 + '</body></html>'
+CAPTCHA_HTML = ('<html><body>' + '<p>Please wait while we check your browser.</p>' * 40 +
+                '<script src="https://ct.captcha-delivery.com/c.js"></script></body></html>')
+
+
+# Local proxy, it saves the requests received and answers them
+class ProxyHandler(BaseHTTPRequestHandler):
+
+    # Requests received by each proxy port: [(time, url, headers)]
+    received = defaultdict(list)
+    lock = threading.Lock()
+    # Ports of the proxies that send captcha pages
+    blocking = set()
+
+    def do_GET(self):
+        port = self.server.server_address[1]
+        with self.lock:
+            self.received[port].append((time.time(), self.path, dict(self.headers)))
+
+        if port in self.blocking:
+            body = gzip.compress(CAPTCHA_HTML.encode('utf-8'))
+            headers = {'Content-Type': 'text/html; charset=utf-8', 'Content-Encoding': 'gzip'}
+        elif 'ajax' in self.path:
+            body = b'{"output": {}}'
+            headers = {'Content-Type': 'application/json'}
+        else:
+            body = PAGE_HTML.format(self.path).encode('utf-8')
+            headers = {'Content-Type': 'text/html; charset=utf-8', 'Set-Cookie': 'uaid=proxy{}; Path=/'.format(port)}
+
+        self.send_response(200)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        # The proxy and the request headers it received, read by the spider
+        self.send_header('X-Proxy-Port', str(port))
+        self.send_header('X-Request-Cookie', self.headers.get('Cookie', ''))
+        self.send_header('X-Request-User-Agent', self.headers.get('User-Agent', ''))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+# Requests the pages and the Ajax request of each page (with the identity of the page)
+class PagesSpider(scrapy.Spider):
+    name = 'check_identities'
+
+    def __init__(self, *args, **kwargs):
+        super(PagesSpider, self).__init__(*args, **kwargs)
+        self.pages = {}
+        self.ajax = {}
+        # Time when each page read from the cache was parsed (url -> time)
+        self.cached = {}
+
+    def start_requests(self):
+        for n in range(PAGES):
+            yield scrapy.Request(page_url(n), callback=self.parse_page)
+
+    def parse_page(self, response):
+        if 'cached' in response.flags:
+            self.cached[response.url] = time.time()
+            return
+        self.pages[response.url] = self.seen(response)
+        yield scrapy.Request(response.url + '?ajax=1', meta={'identity': response.meta['identity']},
+                             callback=self.parse_ajax)
+
+    def parse_ajax(self, response):
+        self.ajax[response.url.split('?')[0]] = self.seen(response)
+
+    def seen(self, response):
+        return {'identity': response.meta['identity'],
+                'port': int(response.headers['X-Proxy-Port']),
+                'cookie': response.headers.get('X-Request-Cookie', b'').decode('utf-8'),
+                'user_agent': response.headers['X-Request-User-Agent'].decode('utf-8')}
+
+
+def page_url(n):
+    return 'http://www.etsy.test/listing/{}'.format(n)
+
+
+# Save the last CACHED_PAGES pages in the cache used by the crawl
+def fill_cache(cache_dir):
+    storage = ResponseCacheStorage(cache_dir, 0)
+    cache = EtsyHttpCacheMiddleware(storage, {}, None)
+    for n in range(PAGES - CACHED_PAGES, PAGES):
+        request = scrapy.Request(page_url(n))
+        body = PAGE_HTML.format('/listing/{}'.format(n)).encode('utf-8')
+        storage.store(cache.request_key(request), HtmlResponse(request.url, body=body, encoding='utf-8',
+                                                               headers={'Content-Type': 'text/html; charset=utf-8'}))
+    storage.close()
+
+
+def start_proxy():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ProxyHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def check(cache_dir):
+    fill_cache(cache_dir)
+    proxies = [start_proxy() for _ in range(3)]
+    ports = [proxy.server_address[1] for proxy in proxies]
+    ProxyHandler.blocking.add(ports[1])
+
+    settings = {k: v for k, v in vars(project_settings).items() if k.isupper()}
+    settings.update({
+        'IDENTITY_POOL_ENABLED': True,
+        'IDENTITY_PROXIES': ['http://{}:{}@127.0.0.1:{}'.format(PROXY_USER, PROXY_PASSWORD, ports[0]),
+                             'http://127.0.0.1:{}'.format(ports[1]),
+                             'http://127.0.0.1:{}'.format(ports[2])],
+        'IDENTITY_USER_AGENTS': ['check-agent-0', 'check-agent-1', 'check-agent-2'],
+        'IDENTITY_REQUESTS_PER_MINUTE': REQUESTS_PER_MINUTE,
+        'IDENTITY_MAX_BLOCKS': MAX_BLOCKS,
+        'CLASSIFIER_MAX_RETRIES': MAX_BLOCKS + 1,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': 16,
+        'ETSY_HTTPCACHE_ENABLED': True,
+        'ETSY_HTTPCACHE_DIR': cache_dir,
+        # Only the pages saved before the crawl are read from the cache
+        'ETSY_HTTPCACHE_TTLS': {'listing': 3600, 'default': 0},
+        'ITEM_PIPELINES': {},
+        'EXTENSIONS': {},
+        'LOG_LEVEL': 'WARNING',
+    })
+
+    process = CrawlerProcess(settings)
+    crawler = process.create_crawler(PagesSpider)
+    process.crawl(crawler)
+    process.start()
+    for proxy in proxies:
+        proxy.shutdown()
+
+    spider = crawler.spider
+    stats = crawler.stats.get_stats()
+    print('Requests received by each proxy: {}'.format(', '.join(
+        '{} {}'.format(port, len(ProxyHandler.received[port])) for port in ports)))
+
+    # All pages were scraped with the good proxies, or read from the cache
+    network_pages = PAGES - CACHED_PAGES
+    assert len(spider.cached) == CACHED_PAGES, spider.cached
+    assert len(spider.pages) == network_pages and len(spider.ajax) == network_pages, (len(spider.pages), len(spider.ajax))
+    assert all(page['port'] != ports[1] for page in spider.pages.values())
+
+    # The pages read from the cache did not go through an identity: they were not sent to the proxies,
+    # they were not counted in the requests of the identities and they did not wait for their rate
+    received = [request for port in ports for request in ProxyHandler.received[port]]
+    assert not any(url.split('?')[0] in spider.cached for _, url, _ in received)
+    identity_requests = sum(value for key, value in stats.items() if key.startswith('identity/requests/'))
+    assert identity_requests == len(received), (identity_requests, len(received))
+    interval = 60.0 / REQUESTS_PER_MINUTE
+    cached_time = max(spider.cached.values()) - min(spider.cached.values())
+    assert cached_time < interval, cached_time
+    print('{} pages read from the cache in {:.2f}s, {} requests sent by the identities'.format(
+        CACHED_PAGES, cached_time, identity_requests))
+
+    # The identity of the blocking proxy was retired after MAX_BLOCKS captcha pages
+    assert len(ProxyHandler.received[ports[1]]) == MAX_BLOCKS, ProxyHandler.received[ports[1]]
+    assert stats.get('identity/blocked/identity-1') == MAX_BLOCKS and stats.get('identity/retired') == 1, stats
+    print('identity-1 retired after {} captcha pages (gzip)'.format(MAX_BLOCKS))
+
+    # The Ajax request of each page used the proxy, the user agent and the cookie jar of the page
+    for url, page in spider.pages.items():
+        ajax = spider.ajax[url]
+        assert ajax['identity'] == page['identity'] and ajax['port'] == page['port'], (page, ajax)
+        assert ajax['user_agent'] == page['user_agent'] == 'check-agent-{}'.format(ports.index(page['port']))
+        assert ajax['cookie'] == 'uaid=proxy{}'.format(page['port']), ajax
+    print('The Ajax requests used the proxy, the user agent and the cookies of their page')
+
+    # The credentials of the first proxy were sent
+    credentials = 'Basic ' + base64.b64encode('{}:{}'.format(PROXY_USER, PROXY_PASSWORD).encode('utf-8')).decode('ascii')
+    assert all(headers.get('Proxy-Authorization') == credentials for _, _, headers in ProxyHandler.received[ports[0]])
+
+    # Each identity sent at most REQUESTS_PER_MINUTE requests: any run of requests took at least
+    # the time of its intervals (the requests may arrive a little late at the proxy)
+    for port in ports:
+        times = sorted(t for t, _, _ in ProxyHandler.received[port])
+        for i, j in combinations(range(len(times)), 2):
+            assert times[j] - times[i] >= (j - i) * interval - JITTER, (port, i, j, times[j] - times[i])
+        print('Proxy {}: {} requests in {:.2f}s (one request every {:.2f}s)'.format(
+            port, len(times), times[-1] - times[0], interval))
+
+
+if __name__ == '__main__':
+    cache_dir = tempfile.mkdtemp()
+    try:
+        check(cache_dir)
+    finally:
+        shutil.rmtree(cache_dir)
+    print('OK')
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+#==============================================================================
+#title           :check_images.py
+#description     :Download the images of some products from a local HTTP server with the EtsyImagesPipeline (two runs).
+#usage           :python -m benchmarks.check_images
+#python version  :3.6
+#==============================================================================
+
+# The server has four images, two of them with the same content. The first run
+# must save three files (the same content is saved once) and the second run
+# must not download any image (they are in the index of the first run).
+
+import os
+import shutil
+import tempfile
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from twisted.internet import defer, reactor
+import scrapy
+from scrapy import signals
+from scrapy.crawler import CrawlerRunner
+from etsy import settings as project_settings
+from etsy.items import ProductItem
+
+# Content of each image of the server
+IMAGES = {
+    '/img/il_794xN.1_a.jpg': b'\xff\xd8\xff\xe0 image A',
+    '/img/il_794xN.2_b.jpg': b'\xff\xd8\xff\xe0 image B',
+    '/img/il_794xN.3_c.jpg': b'\xff\xd8\xff\xe0 image C',
+    # Same image of the first product, with another URL
+    '/img/il_794xN.4_a.jpg': b'\xff\xd8\xff\xe0 image A',
+}
+
+# Images of each product (the last product uses the images of the others)
+PRODUCTS = {
+    '1': ['/img/il_794xN.1_a.jpg', '/img/il_794xN.2_b.jpg'],
+    '2': ['/img/il_794xN.3_c.jpg', '/img/il_794xN.4_a.jpg'],
+    '3': ['/img/il_794xN.1_a.jpg', '/img/il_794xN.3_c.jpg'],
+}
+
+
+class ImagesHandler(BaseHTTPRequestHandler):
+
+    # Number of requests of each path
+    requests = Counter()
+
+    def do_GET(self):
+        self.requests[self.path] += 1
+        body = IMAGES.get(self.path)
+        if body is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+# Returns the products with the URLs of their images in the local server
+class ProductsSpider(scrapy.Spider):
+    name = 'check_images'
+
+    def __init__(self, server_url, *args, **kwargs):
+        super(ProductsSpider, self).__init__(*args, **kwargs)
+        self.server_url = server_url
+
+    def start_requests(self):
+        yield scrapy.Request(self.server_url + '/img/il_794xN.1_a.jpg', callback=self.parse_products, dont_filter=True)
+
+    def parse_products(self, response):
+        for product_id, paths in PRODUCTS.items():
+            item = ProductItem()
+            item['product_id'] = product_id
+            item['images_urls'] = ','.join(self.server_url + path for path in paths)
+            yield item
+
+
+def crawl_settings(images_store):
+    settings = {k: v for k, v in vars(project_settings).items() if k.isupper()}
+    settings.update({
+        'IMAGES_STORE': images_store,
+        'ITEM_PIPELINES': {'etsy.pipelines.EtsyImagesPipeline': 820},
+        'EXTENSIONS': {},
+        'ETSY_HTTPCACHE_ENABLED': False,
+        'LOG_LEVEL': 'WARNING',
+    })
+    return settings
+
+
+@defer.inlineCallbacks
+def run(runner, server_url, results):
+    for _ in range(2):
+        crawler = runner.create_crawler(ProductsSpider)
+        items = []
+
+        # The signals keep weak references, the function must live until the crawl ends
+        def item_scraped(item, response, spider):
+            items.append(item)
+        crawler.signals.connect(item_scraped, signal=signals.item_scraped)
+        before = sum(ImagesHandler.requests.values())
+        yield runner.crawl(crawler, server_url=server_url)
+        # The request of the start page is not an image download
+        downloads = sum(ImagesHandler.requests.values()) - before - 1
+        results.append((items, crawler.stats.get_stats(), downloads))
+    reactor.stop()
+
+
+def files_saved(images_store):
+    return sorted(os.path.relpath(os.path.join(folder, name), images_store)
+                  for folder, _, names in os.walk(os.path.join(images_store, 'full')) for name in names)
+
+
+def check(images_store):
+    server = HTTPServer(('127.0.0.1', 0), ImagesHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+    results = []
+    runner = CrawlerRunner(crawl_settings(images_store))
+    run(runner, server_url, results)
+    reactor.run()
+    server.shutdown()
+
+    # First run: four images downloaded, three files saved
+    items, stats, downloads = results[0]
+    files = files_saved(images_store)
+    print('Run 1: {} images downloaded, {} files saved, {} deduplicated'.format(
+        downloads, len(files), stats.get('file_status_count/deduplicated', 0)))
+    assert downloads == len(IMAGES), downloads
+    assert len(files) == len(set(IMAGES.values())), files
+    assert stats.get('file_status_count/deduplicated') == 1, stats
+
+    paths = {item['product_id']: item['images_paths'] for item in items}
+    assert len(paths) == len(PRODUCTS) and all(len(paths[p]) == len(PRODUCTS[p]) for p in PRODUCTS), paths
+    # The two URLs of the image A have the same file
+    assert paths['1'][0] == paths['2'][1], paths
+    assert sorted(set(path for item_paths in paths.values() for path in item_paths)) == files
+
+    # Second run: all images are in the index
+    items, stats, downloads = results[1]
+    print('Run 2: {} images downloaded, {} up to date'.format(downloads, stats.get('file_status_count/uptodate', 0)))
+    assert downloads == 0, downloads
+    assert stats.get('file_status_count/uptodate') == len(IMAGES), stats
+    assert {item['product_id']: item['images_paths'] for item in items} == paths
+
+
+if __name__ == '__main__':
+    images_store = tempfile.mkdtemp()
+    try:
+        check(images_store)
+    finally:
+        shutil.rmtree(images_store)
+    print('OK')
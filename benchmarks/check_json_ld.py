@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+#==============================================================================
+#title           :check_json_ld.py
+#description     :Parse the product's page with its images as URLs and as ImageObject blocks.
+#usage           :python -m benchmarks.check_json_ld
+#python version  :3.6
+#==============================================================================
+
+# The images of the JSON-LD Product block may be URLs or ImageObject blocks
+# (listing_page_image_objects.html, with the URL in contentURL, contentUrl or
+# url, and some images without URL). Both pages must give the same product.
+
+from scrapy.http import Request
+from etsy.pipelines import EtsyPipeline
+from benchmarks.replay import create_spider, fixture_response
+
+FIXTURES = ['listing_page.html', 'listing_page_image_objects.html']
+
+
+def parse_fixture(name):
+    spider = create_spider(reviews_option=1)
+    request = Request('https://www.etsy.com/listing/275174392', callback=spider.parse_product)
+    items = [result for result in spider.parse_product(fixture_response(name, request=request))
+             if not isinstance(result, Request)]
+    assert len(items) == 1, '{}: {} items'.format(name, len(items))
+    return dict(EtsyPipeline().process_item(items[0], spider))
+
+
+def check():
+    products = [parse_fixture(name) for name in FIXTURES]
+    for name, product in zip(FIXTURES, products):
+        print('{}: {} images, first image {}'.format(name, product['count_of_images'], product['images_urls'].split(',')[0]))
+
+    assert products[0]['count_of_images'] == 9, products[0]['count_of_images']
+    assert products[1] == products[0], {field: (products[0].get(field), products[1].get(field))
+                                        for field in set(products[0]) | set(products[1])
+                                        if products[0].get(field) != products[1].get(field)}
+
+
+if __name__ == '__main__':
+    check()
+    print('OK')
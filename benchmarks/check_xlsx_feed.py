@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+#==============================================================================
+#title           :check_xlsx_feed.py
+#description     :Check that the Excel feed created next to a CSV feed can be opened (also on the second run).
+#usage           :python -m benchmarks.check_xlsx_feed
+#python version  :3.6
+#==============================================================================
+
+import os
+import shutil
+import tempfile
+from openpyxl import load_workbook
+from scrapy.extensions.feedexport import FileFeedStorage
+from scrapy.settings import Settings
+from scrapy.utils.misc import load_object
+from etsy import settings as project_settings
+from benchmarks.replay import create_spider
+
+
+def sample_items(count):
+    return [{'title': 'Product {}'.format(n), 'product_id': str(275174392 + n), 'price': '{}.99'.format(n),
+             'currency': 'USD', 'product_options': ['Red', 'Blue'], 'store_name': 'PrintShop0'}
+            for n in range(count)]
+
+
+# Feeds created by "scrapy crawl search_products -o <output>" (with the options set by the spider)
+def derived_feeds(output):
+    spider = create_spider({'FEEDS': {output: {'format': 'csv'}}})
+    return spider.crawl_feeds(spider.crawler.settings.getdict('FEEDS'))
+
+
+# Write the items as the FeedExporter does: open the storage, export the items and close the file
+def export_feed(path, options, items):
+    settings = Settings({k: v for k, v in vars(project_settings).items() if k.isupper()})
+    try:
+        storage = FileFeedStorage(path, feed_options=options)
+    except TypeError:
+        # Scrapy < 2.4 (the feed files are always appended)
+        storage = FileFeedStorage(path)
+    f = storage.open(None)
+    exporter = load_object(settings.getdict('FEED_EXPORTERS')[options['format']])(
+        f, fields_to_export=settings.getlist('FEED_EXPORT_FIELDS'))
+    exporter.start_exporting()
+    for item in items:
+        exporter.export_item(item)
+    exporter.finish_exporting()
+    storage.store(f)
+
+
+def read_rows(path):
+    workbook = load_workbook(path, read_only=True)
+    rows = [list(row) for row in workbook.active.iter_rows(values_only=True)]
+    workbook.close()
+    return rows
+
+
+def check(folder):
+    csv_path = os.path.join(folder, 'products.csv')
+    xlsx_path = os.path.join(folder, 'products.xlsx')
+    options = derived_feeds(csv_path)[xlsx_path]
+    print('Excel feed options: {}'.format(options))
+
+    # Two runs with the same output, the second one finds the file of the first one
+    for run, count in enumerate([5, 3], 1):
+        items = sample_items(count)
+        export_feed(xlsx_path, options, items)
+        rows = read_rows(xlsx_path)
+        assert rows[0] == project_settings.FEED_EXPORT_FIELDS, rows[0]
+        assert len(rows) == count + 1, 'run {}: {} rows'.format(run, len(rows))
+        assert rows[1][0] == 'Product 0' and rows[1][7] == 'Red,Blue', rows[1]
+        print('Run {}: {} rows read back from {}'.format(run, len(rows) - 1, xlsx_path))
+
+    # The file of a feed without "overwrite" is opened in append mode
+    append_path = os.path.join(folder, 'append.xlsx')
+    export_feed(append_path, {'format': 'xlsx'}, sample_items(4))
+    assert len(read_rows(append_path)) == 5
+    print('Append mode: 4 rows read back from {}'.format(append_path))
+
+
+if __name__ == '__main__':
+    folder = tempfile.mkdtemp()
+    try:
+        check(folder)
+    finally:
+        shutil.rmtree(folder)
+    print('OK')
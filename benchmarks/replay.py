@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+#==============================================================================
+#title           :replay.py
+#description     :Helpers to replay the offline fixtures through the spider.
+#python version  :3.6
+#==============================================================================
+
+import os
+from scrapy.http import HtmlResponse, Request, TextResponse
+from scrapy.utils.test import get_crawler
+from etsy import settings as project_settings
+from etsy.spiders.search_products import ProductsSpider
+
+# Folder with the recorded pages
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# URL of each fixture
+FIXTURE_URLS = {
+    'search_page.html': 'https://www.etsy.com/search?q=3d printed&ref=pagination&page=1',
+    'listing_page.html': 'https://www.etsy.com/listing/275174392',
+    'ajax_reviews.json': 'https://www.etsy.com/api/v3/ajax/bespoke/member/neu/specs/reviews',
+    'shop_reviews_page1.html': 'https://www.etsy.com/shop/PrintShop0/reviews?ref=l2-see-more-feedback',
+    'shop_reviews_page2.html': 'https://www.etsy.com/shop/PrintShop0/reviews?ref=pagination&page=2',
+}
+
+_cache = {}
+
+
+# Read the fixture file only once
+def fixture_body(name):
+    if name not in _cache:
+        with open(os.path.join(FIXTURES_DIR, name), 'rb') as f:
+            _cache[name] = f.read()
+    return _cache[name]
+
+
+# Build the response of a fixture as if it was downloaded by Scrapy
+def fixture_response(name, url=None, request=None, headers=None):
+    url = url or (request.url if request else FIXTURE_URLS[name])
+    request = request or Request(url)
+    if name.endswith('.json'):
+        response_cls = TextResponse
+        headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+    else:
+        response_cls = HtmlResponse
+    return response_cls(url=url, body=fixture_body(name), encoding='utf-8',
+                        request=request, headers=headers)
+
+
+# Create a spider bound to a (not running) crawler using the project settings
+def create_spider(settings=None, **kwargs):
+    kwargs.setdefault('search', '3d printed')
+    settings_dict = {k: v for k, v in vars(project_settings).items() if k.isupper()}
+    settings_dict.update(settings or {})
+    crawler = get_crawler(ProductsSpider, settings_dict)
+    return ProductsSpider.from_crawler(crawler, **kwargs)
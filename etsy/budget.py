@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+# Control the number of products scraped (count_max parameter)
+#
+# A product is counted as soon as its page is requested (in flight), so the
+# spider stops requesting new products (and new search pages) when the
+# products in flight plus the products already scraped reach the maximum.
+# If a product fails (ex: unavailable), its place is released and another
+# product can be requested.
+
+
+class ItemBudget(object):
+
+    def __init__(self, max_items):
+        self.max_items = max_items
+        # Products requested and not finished yet
+        self.in_flight = 0
+        # Products scraped
+        self.completed = 0
+
+    # Number of products requested or scraped
+    @property
+    def committed(self):
+        return self.in_flight + self.completed
+
+    # No more products can be requested
+    @property
+    def exhausted(self):
+        return self.committed >= self.max_items
+
+    # All products were scraped
+    @property
+    def done(self):
+        return self.completed >= self.max_items
+
+    # Reserve a place for a new product, returns False if there is no place
+    def reserve(self):
+        if self.exhausted:
+            return False
+        self.in_flight += 1
+        return True
+
+    # The product failed, its place can be used by another product
+    def release(self):
+        self.in_flight = max(0, self.in_flight - 1)
+
+    # The product was scraped
+    def complete(self):
+        self.in_flight = max(0, self.in_flight - 1)
+        self.completed += 1
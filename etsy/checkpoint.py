@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+# Checkpoint of a crawl (used to resume a crawl that was stopped)
+#
+# The state of the spider (search pages not visited yet, products not scraped
+# yet, store reviews collected and the IDs of the products already found) is
+# saved in a JSON file. The file is written in a temporary file first and
+# then renamed, so a crawl killed while saving keeps the previous checkpoint.
+
+import os
+import json
+
+
+class CrawlCheckpoint(object):
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        with open(self.path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def save(self, state):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+    # The crawl finished, there is nothing to resume
+    def remove(self):
+        if self.exists():
+            os.remove(self.path)
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+# Classify the responses before they are parsed
+#
+# The checks use only the status code, the size and byte markers of the raw
+# body, so a blocked, captcha or unavailable page is detected without building
+# the lxml tree (see the ResponseClassifierMiddleware and the AdaptiveThrottle).
+# The pages seen before the HttpCompressionMiddleware are still compressed, so
+# the body is decoded here when the response has a Content-Encoding.
+
+import re
+import zlib
+from scrapy.utils.gz import gunzip
+
+# brotli is only needed to check the pages sent with Content-Encoding: br
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Classes of the responses
+OK = 'ok'
+UNAVAILABLE = 'unavailable'
+BLOCKED = 'blocked'
+CAPTCHA = 'captcha'
+
+# Markers found in the pages that Etsy sends instead of the requested page
+CAPTCHA_MARKERS = (b'captcha-delivery.com', b'px-captcha', b'g-recaptcha', b'/captcha/')
+# Status codes sent when Etsy blocks the requests
+BLOCK_STATUS = (403, 429)
+
+# Product's page of a listing that is not available ("Darn, this item is unavailable")
+LISTING_URL = re.compile(r'/listing/\d+')
+UNAVAILABLE_MARKER = re.compile(br'<h2[^>]*>\s*Darn')
+UNAVAILABLE_STATUS = (404, 410)
+
+# Errors of a broken compressed body
+DECODE_ERRORS = (OSError, EOFError, zlib.error) + ((brotli.error,) if brotli is not None else ())
+
+
+# Body of the response without the Content-Encoding
+# Returns None if the body can't be decoded (unknown encoding or broken body)
+def response_body(response):
+    encodings = b','.join(response.headers.getlist('Content-Encoding'))
+    encodings = [encoding.strip().lower() for encoding in encodings.split(b',') if encoding.strip()]
+
+    body = response.body
+    try:
+        # The last encoding was applied last
+        for encoding in reversed(encodings):
+            if encoding in (b'gzip', b'x-gzip'):
+                body = gunzip(body)
+            elif encoding == b'deflate':
+                try:
+                    body = zlib.decompress(body)
+                except zlib.error:
+                    # Raw deflate stream (without the zlib header)
+                    body = zlib.decompress(body, -zlib.MAX_WBITS)
+            elif encoding == b'br' and brotli is not None:
+                body = brotli.decompress(body)
+            elif encoding != b'identity':
+                return None
+    except DECODE_ERRORS:
+        return None
+    return body
+
+
+def has_captcha_marker(body):
+    return any(marker in body for marker in CAPTCHA_MARKERS)
+
+
+def is_captcha(response):
+    body = response_body(response)
+    return body is not None and has_captcha_marker(body)
+
+
+# Returns the class of the response
+# HTML pages smaller than min_size (bytes) are blank pages sent by the anti-bot, they are counted as blocked
+def classify_response(response, min_size=0):
+    if response.status in BLOCK_STATUS:
+        return BLOCKED
+
+    listing = LISTING_URL.search(response.url) is not None
+    if listing and response.status in UNAVAILABLE_STATUS:
+        return UNAVAILABLE
+
+    body = response_body(response)
+    # The body can't be read, only the status code is checked
+    if body is None:
+        return OK
+
+    if has_captcha_marker(body):
+        return CAPTCHA
+
+    if response.status == 200 and min_size and len(body) < min_size:
+        content_type = response.headers.get('Content-Type', b'') or b''
+        if b'html' in content_type.lower():
+            return BLOCKED
+
+    if listing and UNAVAILABLE_MARKER.search(body):
+        return UNAVAILABLE
+
+    return OK
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+#==============================================================================
+#title           :distributed.py
+#description     :Shared queue, dupe filter and item sink used to run search_products in several processes/nodes.
+#usage           :python -m etsy.distributed --crawl crawl1 --export products.csv
+#python version  :3.6
+#==============================================================================
+
+# All the workers of a crawl (scrapy crawl search_products -a distributed=crawl1)
+# use the same Redis server (REDIS_URL setting, any server that speaks the
+# Redis protocol). The keys of the crawl are:
+#   <prefix>:seeded             set by the first worker, that adds the first search pages
+#   <prefix>:pages              search pages not requested yet (JSON [url, search, ...])
+#   <prefix>:leases             search pages requested and not parsed yet (score: lease expiry time)
+#   <prefix>:products           products not requested yet (JSON [product_id, search])
+#   <prefix>:listings           IDs of the products found by any worker (dupe filter)
+#   <prefix>:queries:<id>       search strings that found the product
+#   <prefix>:items              scraped items (JSON), see the DistributedItemPipeline
+
+import os
+import json
+import time
+import argparse
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.project import get_project_settings
+from etsy.exporters import FEED_FORMATS
+
+# redis is only needed for the distributed mode
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+# Move the first search page to the leases (KEYS: pages, leases - ARGV: lease expiry time)
+POP_PAGE_SCRIPT = """
+local page = redis.call('LPOP', KEYS[1])
+if page then
+    redis.call('ZADD', KEYS[2], ARGV[1], page)
+end
+return page
+"""
+
+# Move the search pages with an expired lease back to the queue (KEYS: pages, leases - ARGV: now)
+RECOVER_PAGES_SCRIPT = """
+local pages = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+for _, page in ipairs(pages) do
+    redis.call('ZREM', KEYS[2], page)
+    redis.call('RPUSH', KEYS[1], page)
+end
+return #pages
+"""
+
+
+class RedisFrontier(object):
+
+    def __init__(self, client, prefix, lease_timeout=600):
+        self.client = client
+        self.prefix = prefix
+        # A search page not parsed in this time (in seconds) goes back to the queue (ex: the worker died)
+        self.lease_timeout = lease_timeout
+        self.pop_page_script = client.register_script(POP_PAGE_SCRIPT)
+        self.recover_pages_script = client.register_script(RECOVER_PAGES_SCRIPT)
+
+    @classmethod
+    def from_settings(cls, settings, crawl_name):
+        if redis is None:
+            raise NotConfigured('The distributed mode requires redis (pip install redis)')
+        client = redis.Redis.from_url(settings.get('REDIS_URL'), decode_responses=True)
+        return cls(client, '{}:{}'.format(settings.get('DISTRIBUTED_KEY_PREFIX'), crawl_name),
+                   settings.getfloat('DISTRIBUTED_LEASE_TIMEOUT'))
+
+    def key(self, name):
+        return '{}:{}'.format(self.prefix, name)
+
+    # Only the first worker adds the first search pages
+    def seed(self, pages):
+        if not self.client.set(self.key('seeded'), 1, nx=True):
+            return False
+        self.push_pages(pages)
+        return True
+
+    # Search pages
+
+    def push_pages(self, pages):
+        if pages:
+            self.client.rpush(self.key('pages'), *[json.dumps(page) for page in pages])
+
+    # Returns the lease of the page (used to mark it as done) and the page, or None
+    # The page is moved to the leases in the same step, so it is never missing from both
+    def pop_page(self):
+        page = self.pop_page_script(keys=[self.key('pages'), self.key('leases')],
+                                    args=[time.time() + self.lease_timeout])
+        if page is None:
+            return None
+        return page, tuple(json.loads(page))
+
+    # The search page was parsed (or failed)
+    def page_done(self, lease):
+        if lease is not None:
+            self.client.zrem(self.key('leases'), lease)
+
+    # Move the pages of the workers that did not parse them in time back to the queue
+    def recover_pages(self):
+        return self.recover_pages_script(keys=[self.key('pages'), self.key('leases')], args=[time.time()])
+
+    # Products
+
+    def push_products(self, products):
+        if products:
+            self.client.rpush(self.key('products'), *[json.dumps(product) for product in products])
+
+    def pop_product(self):
+        product = self.client.lpop(self.key('products'))
+        return tuple(json.loads(product)) if product is not None else None
+
+    # Save the search string that found the product, returns True if no worker found the product before
+    def add_listing(self, product_id, search):
+        if search is not None:
+            self.client.sadd(self.key('queries:{}'.format(product_id)), search)
+        return bool(self.client.sadd(self.key('listings'), product_id))
+
+    def listing_queries(self, product_id):
+        return self.client.smembers(self.key('queries:{}'.format(product_id)))
+
+    # There is no work left for any worker: all queues are empty and no search page is being parsed
+    # (only the search pages add new work)
+    # The keys are read in one transaction: a worker adds the new work before it releases its page
+    def finished(self):
+        if self.recover_pages():
+            return False
+        pipe = self.client.pipeline(transaction=True)
+        pipe.llen(self.key('pages'))
+        pipe.llen(self.key('products'))
+        pipe.zcard(self.key('leases'))
+        return not any(pipe.execute())
+
+    # Items
+
+    def push_item(self, data):
+        self.client.rpush(self.key('items'), data)
+
+    def pop_items(self, count=1000):
+        while True:
+            items = [self.client.lpop(self.key('items')) for _ in range(count)]
+            items = [item for item in items if item is not None]
+            if not items:
+                return
+            for item in items:
+                yield json.loads(item)
+
+    # Remove all keys of the crawl
+    def reset(self):
+        keys = list(self.client.scan_iter(match=self.prefix + ':*'))
+        if keys:
+            self.client.delete(*keys)
+
+
+if __name__ == '__main__':
+    from etsy.shards import export_items
+
+    parser = argparse.ArgumentParser(description='Manage a distributed search_products crawl')
+    parser.add_argument('--crawl', required=True, help='name of the crawl (-a distributed=<name>)')
+    parser.add_argument('--export', help='save the items of the crawl in this file ({})'.format(', '.join(FEED_FORMATS)))
+    parser.add_argument('--reset', action='store_true', help='remove the queues, the dupe filter and the items of the crawl')
+    args = parser.parse_args()
+
+    settings = get_project_settings()
+    frontier = RedisFrontier.from_settings(settings, args.crawl)
+
+    if args.export:
+        stem, ext = os.path.splitext(args.export)
+        if ext not in FEED_FORMATS:
+            parser.error('Output format not supported: {}'.format(args.export))
+
+        items = list(frontier.pop_items())
+        reviews = [review for item in items for review in item.pop('reviews', None) or []]
+        export_items(items, args.export)
+        print('{} products saved in {}'.format(len(items), args.export))
+        if reviews:
+            export_items(reviews, stem + '_reviews' + ext, fields=settings.getlist('REVIEWS_FEED_EXPORT_FIELDS'), xlsx=False)
+
+    if args.reset:
+        frontier.reset()
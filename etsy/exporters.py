@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+
+# Define here the custom item exporters
+#
+# Don't forget to add your exporter to the FEED_EXPORTERS setting
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/exporters.html
+
+import os
+import re
+import shutil
+import tempfile
+from urllib.parse import urlparse
+from decimal import Decimal, InvalidOperation
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from scrapy.exceptions import NotConfigured
+from scrapy.exporters import BaseItemExporter
+from w3lib.url import file_uri_to_path
+
+# pyarrow is only needed for the Parquet output
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Feed format of each output file extension
+FEED_FORMATS = {
+    '.csv': 'csv',
+    '.json': 'json',
+    '.jl': 'jsonlines',
+    '.jsonl': 'jsonlines',
+    '.xml': 'xml',
+    '.xlsx': 'xlsx',
+    '.parquet': 'parquet',
+}
+
+
+# Write the items in an Excel file, one row per item.
+# The workbook is created in write-only mode, so each row is streamed to a
+# temporary file as soon as the item arrives and the memory usage stays flat
+# no matter how many items are scraped.
+# The workbook is saved in a temporary file and then copied to the feed file:
+# saving a workbook needs a seekable file and the feed files can be opened in
+# append mode (the seeks are ignored and the zip file is broken).
+# A file opened in append mode (ex: a resumed crawl) may already have rows,
+# they are written again before the new rows and the file is replaced.
+class XlsxItemExporter(BaseItemExporter):
+
+    def __init__(self, file, **kwargs):
+        super(XlsxItemExporter, self).__init__(dont_fail=True, **kwargs)
+        self.file = file
+        self.workbook = Workbook(write_only=True)
+        self.worksheet = self.workbook.create_sheet()
+        self._headers_not_written = True
+        self.previous_rows = []
+
+    def start_exporting(self):
+        path = previous_file(self.file)
+        if path:
+            try:
+                workbook = load_workbook(path, read_only=True)
+                self.previous_rows = [list(row) for row in workbook.active.iter_rows(values_only=True)]
+                workbook.close()
+            except Exception:
+                # The file is not a workbook (ex: the previous crawl was killed before saving it)
+                self.previous_rows = []
+
+    def serialize_field(self, field, name, value):
+        value = super(XlsxItemExporter, self).serialize_field(field, name, value)
+        # Lists are saved as a comma separated string (same as the CSV output)
+        if isinstance(value, (list, tuple)):
+            value = ','.join(str(v) for v in value)
+        # Excel does not accept some control characters
+        if isinstance(value, str):
+            value = ILLEGAL_CHARACTERS_RE.sub('', value)
+        return value
+
+    def export_item(self, item):
+        if self._headers_not_written:
+            self._write_headers(item)
+
+        fields = self._get_serialized_fields(item, default_value='', include_empty=True)
+        self.worksheet.append([value for _, value in fields])
+
+    def _write_headers(self, item=None):
+        self._headers_not_written = False
+        # Use the item fields if FEED_EXPORT_FIELDS is not set
+        if not self.fields_to_export and item is not None:
+            self.fields_to_export = list(item.keys())
+        # The rows of the previous file start with its headers
+        if self.previous_rows:
+            for row in self.previous_rows:
+                self.worksheet.append(row)
+            self.previous_rows = []
+        elif self.fields_to_export:
+            self.worksheet.append(list(self.fields_to_export))
+
+    def finish_exporting(self):
+        if self._headers_not_written:
+            self._write_headers()
+
+        # Saves the file (the previous content was read in start_exporting)
+        with tempfile.TemporaryFile() as f:
+            self.workbook.save(f)
+            f.seek(0)
+            truncate_file(self.file)
+            shutil.copyfileobj(f, self.file)
+
+
+# Write the items in a Parquet file with typed columns
+# The items are saved in memory until a row group is complete (row_group_size
+# items), then the row group is written to the file.
+# A file opened in append mode (ex: a resumed crawl) may already have rows,
+# they are written again in the first row groups of the file.
+# The row group size can be set in the feed options:
+#     FEEDS = {'products.parquet': {'format': 'parquet', 'item_export_kwargs': {'row_group_size': 50000}}}
+class ParquetItemExporter(BaseItemExporter):
+
+    ROW_GROUP_SIZE = 10000
+
+    # Type of each column, the other columns are saved as strings
+    # The lists are saved from the strings joined by the ItemLoader (ex: images_urls)
+    COLUMN_TYPES = {
+        'price': 'decimal',
+        'rating': 'float',
+        'number_of_reviews': 'int',
+        'count_of_images': 'int',
+        'favorited_by': 'int',
+        'review_number': 'int',
+        'images_urls': ('list', ','),
+        'images_paths': ('list', ','),
+        'product_options': ('list', '|'),
+        'search_queries': ('list', '|'),
+    }
+
+    def __init__(self, file, row_group_size=None, **kwargs):
+        if pyarrow is None:
+            raise NotConfigured('The Parquet output requires pyarrow (pip install pyarrow)')
+
+        super(ParquetItemExporter, self).__init__(dont_fail=True, **kwargs)
+        self.file = file
+        self.row_group_size = int(row_group_size or self.ROW_GROUP_SIZE)
+        self.writer = None
+        self.schema = None
+        self.columns = None
+        self.previous_table = None
+
+    def start_exporting(self):
+        self.writer = None
+        path = previous_file(self.file)
+        if path:
+            try:
+                self.previous_table = pyarrow.parquet.read_table(path)
+            except (pyarrow.ArrowException, OSError):
+                # The file is not a Parquet file (ex: the previous crawl was killed before closing it)
+                self.previous_table = None
+            truncate_file(self.file)
+
+    def export_item(self, item):
+        # The schema is created with the first item
+        if self.writer is None:
+            if not self.fields_to_export:
+                self.fields_to_export = list(item.keys())
+            self.schema = pyarrow.schema([(name, self._arrow_type(name)) for name in self.fields_to_export])
+            self.writer = pyarrow.parquet.ParquetWriter(self.file, self.schema)
+            self.columns = {name: [] for name in self.fields_to_export}
+            if self.previous_table is not None:
+                self.writer.write_table(self.previous_table.select(self.fields_to_export).cast(self.schema))
+                self.previous_table = None
+
+        for name in self.fields_to_export:
+            self.columns[name].append(self._convert(name, item.get(name)))
+
+        if len(self.columns[self.fields_to_export[0]]) >= self.row_group_size:
+            self._write_row_group()
+
+    def finish_exporting(self):
+        if self.writer is None:
+            # No new items, the previous rows are written back
+            if self.previous_table is not None:
+                pyarrow.parquet.write_table(self.previous_table, self.file)
+            return
+        self._write_row_group()
+        self.writer.close()
+
+    def _write_row_group(self):
+        if not self.columns[self.fields_to_export[0]]:
+            return
+        self.writer.write_table(pyarrow.Table.from_pydict(self.columns, schema=self.schema))
+        self.columns = {name: [] for name in self.fields_to_export}
+
+    def _arrow_type(self, name):
+        column_type = self.COLUMN_TYPES.get(name)
+        if column_type == 'decimal':
+            return pyarrow.decimal128(12, 2)
+        if column_type == 'float':
+            return pyarrow.float64()
+        if column_type == 'int':
+            return pyarrow.int64()
+        if isinstance(column_type, tuple):
+            return pyarrow.list_(pyarrow.string())
+        return pyarrow.string()
+
+    # Convert the value to the type of the column (None if it is not valid)
+    def _convert(self, name, value):
+        if isinstance(value, (list, tuple)) and not isinstance(self.COLUMN_TYPES.get(name), tuple):
+            value = value[0] if value else None
+        if value is None or value == '':
+            return None
+
+        column_type = self.COLUMN_TYPES.get(name)
+        try:
+            if column_type == 'decimal':
+                return Decimal(str(value).replace(',', '')).quantize(Decimal('0.01'))
+            if column_type == 'float':
+                return float(value)
+            if column_type == 'int':
+                if isinstance(value, int):
+                    return value
+                # Ex: "1,350 favorites"
+                digits = re.sub(r'[^\d]', '', str(value))
+                return int(digits) if digits else None
+        except (InvalidOperation, ValueError):
+            return None
+
+        if isinstance(column_type, tuple):
+            values = value if isinstance(value, (list, tuple)) else str(value).split(column_type[1])
+            return [str(v) for v in values if v != '']
+        return str(value)
+
+
+
+# Path of the feed file if it was opened in append mode and it already has some content, otherwise None
+def previous_file(file):
+    path = getattr(file, 'name', None)
+    if not isinstance(path, str) or 'a' not in getattr(file, 'mode', ''):
+        return None
+    try:
+        return path if file.tell() > 0 else None
+    except (OSError, ValueError):
+        return None
+
+
+# Remove the content of a feed file (the writes of a file in append mode go to the end of the file)
+def truncate_file(file):
+    if previous_file(file):
+        file.seek(0)
+        file.truncate()
+
+
+# Size of the file of a local feed (a path or a file:// URI), 0 if it does not exist or the feed is not local
+def local_file_size(uri):
+    # The one letter schemes are Windows drives (ex: C:\\products.csv)
+    scheme = urlparse(uri).scheme
+    if len(scheme) > 1 and scheme != 'file':
+        return 0
+    try:
+        return os.path.getsize(file_uri_to_path(uri))
+    except OSError:
+        return 0
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+
+# Define here the custom extensions
+#
+# Don't forget to add your extension to the EXTENSIONS setting
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/extensions.html
+
+import os
+from collections import deque
+from twisted.internet import task
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from etsy.classifier import BLOCK_STATUS, is_captcha
+
+
+# Adjust the concurrency and the delay of each download slot (domain)
+# The concurrency is increased while the responses are fast and healthy and it
+# is decreased (and the delay increased) when Etsy sends block signals
+# (429/403 responses and captcha pages).
+class AdaptiveThrottle(object):
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('ADAPTIVE_THROTTLE_ENABLED'):
+            raise NotConfigured
+
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.min_concurrency = settings.getint('ADAPTIVE_THROTTLE_MIN_CONCURRENCY')
+        self.max_concurrency = settings.getint('ADAPTIVE_THROTTLE_MAX_CONCURRENCY')
+        self.max_delay = settings.getfloat('ADAPTIVE_THROTTLE_MAX_DELAY')
+        self.block_delay = settings.getfloat('ADAPTIVE_THROTTLE_BLOCK_DELAY')
+        self.target_latency = settings.getfloat('ADAPTIVE_THROTTLE_TARGET_LATENCY')
+        self.ramp_up_responses = settings.getint('ADAPTIVE_THROTTLE_RAMP_UP_RESPONSES')
+        self.window = settings.getint('ADAPTIVE_THROTTLE_WINDOW')
+
+        # State of each slot: healthy responses in a row and the last responses (True if blocked)
+        self.slots_state = {}
+
+        crawler.signals.connect(self.response_downloaded, signal=signals.response_downloaded)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def response_downloaded(self, response, request, spider):
+        key = request.meta.get('download_slot')
+        slot = self.crawler.engine.downloader.slots.get(key)
+        latency = request.meta.get('download_latency')
+        if slot is None or latency is None:
+            return
+
+        state = self.slots_state.setdefault(key, {'healthy': 0, 'last_responses': deque(maxlen=self.window)})
+        blocked = self.is_blocked(response)
+        state['last_responses'].append(blocked)
+
+        if blocked:
+            # Back off: half of the concurrency and a longer delay
+            state['healthy'] = 0
+            slot.concurrency = max(self.min_concurrency, slot.concurrency // 2)
+            slot.delay = min(self.max_delay, max(slot.delay * 2, self.block_delay))
+            self.stats.inc_value('adaptive_throttle/blocked', spider=spider)
+            spider.logger.info('Block signal ({}) in {}, concurrency: {} delay: {:.1f}s'.format(
+                response.status, response.url, slot.concurrency, slot.delay))
+
+        elif latency > self.target_latency:
+            # The server is slowing down, remove one request in parallel
+            state['healthy'] = 0
+            slot.concurrency = max(self.min_concurrency, slot.concurrency - 1)
+
+        else:
+            state['healthy'] += 1
+            # Ramp up after a sequence of healthy responses
+            if state['healthy'] >= self.ramp_up_responses:
+                state['healthy'] = 0
+                slot.concurrency = min(self.max_concurrency, slot.concurrency + 1)
+                slot.delay = slot.delay * 0.5 if slot.delay > 0.1 else 0
+
+        last_responses = state['last_responses']
+        self.stats.set_value('adaptive_throttle/concurrency', slot.concurrency, spider=spider)
+        self.stats.max_value('adaptive_throttle/max_concurrency', slot.concurrency, spider=spider)
+        self.stats.set_value('adaptive_throttle/delay', round(slot.delay, 3), spider=spider)
+        self.stats.set_value('adaptive_throttle/error_rate',
+                             round(sum(last_responses) / float(len(last_responses)), 3), spider=spider)
+
+    # The response_downloaded signal is sent before the HttpCompressionMiddleware,
+    # is_captcha decodes the body (the response_received signal is not sent for the
+    # blocked pages requested again by the ResponseClassifierMiddleware)
+    def is_blocked(self, response):
+        if response.status in BLOCK_STATUS:
+            self.stats.inc_value('adaptive_throttle/status/{}'.format(response.status))
+            return True
+        if is_captcha(response):
+            self.stats.inc_value('adaptive_throttle/captcha')
+            return True
+        return False
+
+
+# Save the state of the search_products spider periodically (-a checkpoint=crawl.json)
+# The checkpoint is also saved when the spider is closed, and removed if the crawl finished
+# (see etsy/checkpoint.py)
+class CrawlCheckpointSaver(object):
+
+    def __init__(self, crawler):
+        self.interval = crawler.settings.getfloat('CHECKPOINT_INTERVAL')
+        if not self.interval:
+            raise NotConfigured
+
+        self.stats = crawler.stats
+        self.task = None
+
+        crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def spider_opened(self, spider):
+        if getattr(spider, 'checkpoint', None) is None:
+            return
+        self.task = task.LoopingCall(self.save, spider)
+        self.task.start(self.interval, now=False)
+
+    def spider_closed(self, spider, reason):
+        if self.task is None:
+            return
+        if self.task.running:
+            self.task.stop()
+
+        # Nothing to resume
+        if reason == 'finished' or spider.budget.done:
+            spider.checkpoint.remove()
+        else:
+            self.save(spider)
+            spider.logger.info('Crawl state saved in {}, use -a resume=true to continue'.format(spider.checkpoint.path))
+
+    def save(self, spider):
+        spider.checkpoint.save(spider.checkpoint_state())
+        self.stats.inc_value('checkpoint/saved', spider=spider)
+
+
+# Save the metrics of the crawl (see etsy/metrics.py) in the Scrapy stats every
+# METRICS_INTERVAL seconds, and in a file in the Prometheus text format
+# (METRICS_PROMETHEUS_FILE). It also measures the time of the items in the
+# pipelines and the size of the queues of the spider and of the scheduler.
+class CrawlMetrics(object):
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('METRICS_ENABLED'):
+            raise NotConfigured
+
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.interval = settings.getfloat('METRICS_INTERVAL')
+        self.prometheus_file = settings.get('METRICS_PROMETHEUS_FILE')
+        self.task = None
+
+        crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(self.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(self.item_dropped, signal=signals.item_dropped)
+        crawler.signals.connect(self.item_error, signal=signals.item_error)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def spider_opened(self, spider):
+        if getattr(spider, 'metrics', None) is None:
+            return
+        if self.interval:
+            self.task = task.LoopingCall(self.save, spider)
+            self.task.start(self.interval, now=False)
+
+    def spider_closed(self, spider):
+        if getattr(spider, 'metrics', None) is None:
+            return
+        if self.task is not None and self.task.running:
+            self.task.stop()
+        self.save(spider)
+
+    def item_scraped(self, item, spider):
+        if getattr(spider, 'metrics', None) is not None:
+            spider.metrics.item_finished(item, 'pipeline/scraped')
+
+    def item_dropped(self, item, spider):
+        if getattr(spider, 'metrics', None) is not None:
+            spider.metrics.item_finished(item, 'pipeline/dropped')
+
+    def item_error(self, item, spider):
+        if getattr(spider, 'metrics', None) is not None:
+            spider.metrics.item_finished(item, 'pipeline/error')
+
+    def save(self, spider):
+        metrics = spider.metrics
+
+        # Size of the queues
+        engine = self.crawler.engine
+        if engine is not None and engine.slot is not None:
+            metrics.set('queue/scheduler', len(engine.slot.scheduler))
+            metrics.set('queue/downloader', len(engine.downloader.active))
+        if hasattr(spider, 'queue_depths'):
+            for name, depth in spider.queue_depths().items():
+                metrics.set('queue/{}'.format(name), depth)
+
+        for key, value in metrics.stats().items():
+            self.stats.set_value(key, value, spider=spider)
+
+        if self.prometheus_file:
+            tmp_path = self.prometheus_file + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(metrics.prometheus_text())
+            os.replace(tmp_path, self.prometheus_file)
+
+        spider.logger.info('Products found: {}, scraped: {}, waiting: {}'.format(
+            metrics.counters.get('products_found', 0), metrics.counters.get('products_scraped', 0),
+            metrics.gauges.get('queue/waiting_products', 0)))
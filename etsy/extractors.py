@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+# Precompiled selectors used by the spiders
+#
+# The XPath expressions are compiled only once (when the module is loaded)
+# and evaluated directly on the lxml tree of the response, without creating
+# a Selector object for each result.
+
+from lxml import etree
+from w3lib.html import replace_entities
+
+# orjson parses the JSON-LD blocks faster, the json module is used if it is not installed
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+
+def _xpath(expression):
+    # smart_strings=False returns plain strings that do not keep a reference to the tree
+    return etree.XPath(expression, smart_strings=False)
+
+
+# Search page
+SEARCH_PRODUCTS_HREFS = _xpath('//div[@data-search-results=""]/div//li//a/@href')
+# Page numbers of the pagination links
+SEARCH_PAGES = _xpath('//nav[contains(@class, "search-pagination")]//a/@data-page')
+
+# Product cards of the search page, the fields are relative to the card
+SEARCH_CARDS = _xpath('//div[@data-search-results=""]/div//li[.//a/@href]')
+CARD_HREF = _xpath('(.//a/@href)[1]')
+CARD_TITLE = _xpath('normalize-space(.//*[@data-listing-card-title])')
+CARD_STORE_NAME = _xpath('normalize-space(.//*[@data-shop-name])')
+CARD_RATING = _xpath('(.//input[@name="rating"]/@value)[1]')
+CARD_NUMBER_OF_REVIEWS = _xpath('normalize-space(.//*[contains(@class, "listing-card__rating")]/span[contains(text(), "(")])')
+CARD_CURRENCY_SYMBOL = _xpath('normalize-space(.//*[@class="currency-symbol"])')
+CARD_PRICE = _xpath('normalize-space(.//*[@class="currency-value"])')
+CARD_IMAGE = _xpath('(.//img/@src)[1]')
+
+# Structured data (schema.org) of the product's page
+LISTING_JSON_LD = _xpath('//script[@type="application/ld+json"]/text()')
+
+# Reviews in the product's page (and in the Ajax response)
+LISTING_REVIEWS = _xpath('//*[@class="listing-page__review col-group pl-xs-0 pr-xs-0"]')
+
+# Reviews in the store's reviews page
+SHOP_REVIEWS = _xpath("//*[@data-region='review']")
+SHOP_REVIEWS_LISTING_HREF = _xpath("//*[@data-region='listing']//@href")
+SHOP_REVIEWS_NEXT_PAGE = _xpath("//*[contains(text(),'Next page')]/parent::*/@href")
+
+
+# Extract the fields of each review in a single walk over the review's subtree
+# Each review is returned as a dict with the keys: profile, date, rating, content
+# and listing_id (only in the store's reviews page, the product of the review)
+class ReviewExtractor(object):
+
+    def __init__(self, reviews_xpath, profile_class, date_class, content_class, from_parent):
+        self.reviews_xpath = reviews_xpath
+        self.profile_class = profile_class
+        self.date_class = date_class
+        self.content_class = content_class
+        # If the profile and the date are in the parent of the element found by its class
+        self.from_parent = from_parent
+
+    def extract(self, root):
+        return [self.extract_review(review) for review in self.reviews_xpath(root)]
+
+    def extract_review(self, review):
+        profile = date = rating = listing_id = None
+        content = []
+
+        for el in review.iter(etree.Element):
+            el_class = el.get('class')
+
+            # Get the profile URL of the reviewer (first href found)
+            if profile is None and el_class == self.profile_class:
+                profile = first_href(el.getparent() if self.from_parent else el)
+
+            # The date is the third text
+            if date is None and el_class == self.date_class:
+                texts = list((el.getparent() if self.from_parent else el).itertext())
+                date = texts[2] if len(texts) > 2 else ''
+
+            if rating is None and el.tag == 'input' and el.get('name') == 'rating':
+                rating = el.get('value')
+
+            if el_class == self.content_class and el.tag == 'div':
+                content.extend(el.itertext())
+
+            # Get the product ID from the product URL (ex: https://www.etsy.com/listing/666125766/...)
+            if listing_id is None and el.get('data-region') == 'listing':
+                href = first_href(el)
+                listing_id = href.split('/')[4] if href else None
+
+        return {'profile': profile, 'date': date, 'rating': rating,
+                'content': " ".join(content).strip(), 'listing_id': listing_id}
+
+
+# Extract the data shown in each product card of the search page
+# Each card is returned as a dict with the fields of the ProductItem (strings, empty if not found)
+def search_cards(root):
+    cards = []
+    for card in SEARCH_CARDS(root):
+        href = CARD_HREF(card)[0]
+        rating = CARD_RATING(card)
+        image = CARD_IMAGE(card)
+        cards.append({
+            'product_id': href.split('/')[4],
+            'url': '/'.join(href.split('?')[0].split('/')[2:5]),
+            'title': CARD_TITLE(card),
+            'store_name': CARD_STORE_NAME(card),
+            'rating': rating[0] if rating else '',
+            'number_of_reviews': CARD_NUMBER_OF_REVIEWS(card),
+            'price': CARD_CURRENCY_SYMBOL(card) + CARD_PRICE(card),
+            'images_urls': image[0] if image else '',
+        })
+    return cards
+
+
+# Number of the last search page (None if the page has no pagination links)
+def search_last_page(root):
+    pages = [int(page) for page in SEARCH_PAGES(root) if page.isdigit()]
+    return max(pages) if pages else None
+
+
+# Fields of the ProductItem found in the JSON-LD Product block of the product's page
+# Returns a dict with the fields found (strings, the images as a list), empty if the page has no Product block
+def listing_json_ld(root):
+    product = None
+    for text in LISTING_JSON_LD(root):
+        try:
+            data = json_loads(text)
+        except ValueError:
+            continue
+        for block in (data if isinstance(data, list) else [data]):
+            if isinstance(block, dict) and block.get('@type') == 'Product':
+                product = block
+                break
+        if product is not None:
+            break
+    if product is None:
+        return {}
+
+    offers = product.get('offers') or {}
+    if isinstance(offers, list):
+        offers = offers[0] if offers else {}
+    rating = product.get('aggregateRating') or {}
+    brand = product.get('brand') or {}
+    images = product.get('image') or []
+    if not isinstance(images, list):
+        images = [images]
+    images = [url for url in map(json_ld_image_url, images) if url]
+
+    fields = {
+        'title': product.get('name'),
+        'price': offers.get('price', offers.get('lowPrice')),
+        'currency': offers.get('priceCurrency'),
+        'rating': rating.get('ratingValue'),
+        'number_of_reviews': rating.get('reviewCount'),
+        'store_name': brand.get('name') if isinstance(brand, dict) else brand,
+    }
+    # The text in the script is not decoded by the HTML parser (ex: &amp;)
+    fields = {field: replace_entities(str(value)) for field, value in fields.items() if value not in (None, '')}
+    if images:
+        fields['images_urls'] = images
+        fields['count_of_images'] = len(images)
+    return fields
+
+
+# URL of an image of the JSON-LD block, the image is a URL or an ImageObject block
+# (with the URL in contentUrl or url). Returns None if the image has no URL
+def json_ld_image_url(image):
+    if isinstance(image, dict):
+        image = image.get('contentUrl') or image.get('contentURL') or image.get('url')
+    return image if isinstance(image, str) and image else None
+
+
+# Return the first href of an element or its descendants (document order)
+def first_href(el):
+    for e in el.iter(etree.Element):
+        href = e.get('href')
+        if href is not None:
+            return href
+    return None
+
+
+# Reviews in the product's page (and in the Ajax response)
+listing_reviews = ReviewExtractor(LISTING_REVIEWS,
+                                  profile_class='display-block',
+                                  date_class='text-link-underline display-inline-block mr-xs-1',
+                                  content_class='overflow-hidden',
+                                  from_parent=True)
+
+# Reviews in the store's reviews page
+# The profile and the date are both in the attribution element
+shop_reviews = ReviewExtractor(SHOP_REVIEWS,
+                               profile_class='shop2-review-attribution',
+                               date_class='shop2-review-attribution',
+                               content_class='text-gray-lighter',
+                               from_parent=False)
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+# Persistent index of the downloaded images (used by the EtsyImagesPipeline)
+#
+# The images are saved by the hash of their content, so the same image found
+# in several products is saved only once. The index saves the path of each
+# image URL, so the next runs do not download the images again.
+
+import os
+import sqlite3
+
+
+class ImageIndex(object):
+
+    # Number of updates saved in each transaction
+    COMMIT_EVERY = 100
+
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS images (url TEXT PRIMARY KEY, path TEXT, checksum TEXT)')
+        self.db.commit()
+        self._pending_updates = 0
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    # Returns the path and the checksum of the image (None if it was not downloaded)
+    def get(self, url):
+        return self.db.execute('SELECT path, checksum FROM images WHERE url = ?', (url,)).fetchone()
+
+    def add(self, url, path, checksum):
+        self.db.execute('INSERT OR REPLACE INTO images VALUES (?, ?, ?)', (url, path, checksum))
+        self._pending_updates += 1
+        if self._pending_updates >= self.COMMIT_EVERY:
+            self.db.commit()
+            self._pending_updates = 0
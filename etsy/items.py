@@ -9,14 +9,14 @@ import scrapy
 from w3lib.html import remove_tags
 from scrapy.loader.processors import MapCompose, TakeFirst, Join
 
-# Remove extras spaces in strings
-def strip_space(value):
-    return value.strip()
-
-# Put only one space between strings
+# Put only one space between strings (and remove the spaces in the beginning and in the end)
 def normalize_space(value):
     return " ".join(value.split())
 
+# Remove the HTML tags and the extra spaces
+# The tags are removed first, so the spaces left by the tags are also removed
+clean_text = MapCompose(remove_tags, normalize_space)
+
 # This class defines the fields that will be created
 class ProductItem(scrapy.Item):
 
@@ -25,40 +25,57 @@ class ProductItem(scrapy.Item):
 
     product_id = scrapy.Field(output_processor=TakeFirst())
     url = scrapy.Field(output_processor=TakeFirst())
-    title = scrapy.Field(input_processor=MapCompose(normalize_space, remove_tags, strip_space),
+    title = scrapy.Field(input_processor=clean_text,
     					       output_processor=TakeFirst())
-    description = scrapy.Field(input_processor=MapCompose(normalize_space, remove_tags, strip_space),
+    description = scrapy.Field(input_processor=clean_text,
     					       output_processor=Join(' '))
 
-    product_options = scrapy.Field(input_processor=MapCompose(normalize_space, remove_tags, strip_space),
+    product_options = scrapy.Field(input_processor=clean_text,
                               output_processor=Join(','))
 
-    price = scrapy.Field(input_processor=MapCompose(normalize_space, remove_tags, strip_space),
+    price = scrapy.Field(input_processor=clean_text,
                          output_processor=TakeFirst())
 
-    currency = scrapy.Field(input_processor=MapCompose(normalize_space, remove_tags, strip_space),
+    currency = scrapy.Field(input_processor=clean_text,
                             output_processor=TakeFirst())
 
     rating = scrapy.Field(output_processor=TakeFirst())
 
-    number_of_reviews = scrapy.Field(input_processor=MapCompose(normalize_space, remove_tags, strip_space),
+    number_of_reviews = scrapy.Field(input_processor=clean_text,
                             output_processor=TakeFirst())
     count_of_images = scrapy.Field(output_processor=TakeFirst())
 
-    images_urls = scrapy.Field(input_processor=MapCompose(normalize_space, remove_tags, strip_space),
+    images_urls = scrapy.Field(input_processor=clean_text,
                               output_processor=Join(','))
 
-    overview = scrapy.Field(input_processor=MapCompose(normalize_space, remove_tags, strip_space),
+    # Paths of the downloaded images (see the EtsyImagesPipeline)
+    images_paths = scrapy.Field()
+
+    overview = scrapy.Field(input_processor=clean_text,
                             output_processor=Join(','))
 
     favorited_by = scrapy.Field(output_processor=TakeFirst())
-    store_name = scrapy.Field(input_processor=MapCompose(normalize_space, remove_tags, strip_space),
+    store_name = scrapy.Field(input_processor=clean_text,
                               output_processor=TakeFirst())
 
-    store_location = scrapy.Field(input_processor=MapCompose(normalize_space, remove_tags, strip_space),
+    store_location = scrapy.Field(input_processor=clean_text,
                                   output_processor=TakeFirst())
 
-    return_location = scrapy.Field(input_processor=MapCompose(normalize_space, remove_tags, strip_space),
+    return_location = scrapy.Field(input_processor=clean_text,
                                     output_processor=TakeFirst())
 
-    reviews = scrapy.Field()
\ No newline at end of file
+    # List of ReviewItem (saved in a separate file by the ReviewsPipeline)
+    reviews = scrapy.Field()
+
+    # Search strings that found the product
+    search_queries = scrapy.Field(output_processor=Join('|'))
+
+
+# Each review of a product
+class ReviewItem(scrapy.Item):
+    product_id = scrapy.Field()
+    review_number = scrapy.Field()
+    profile = scrapy.Field()
+    rating = scrapy.Field()
+    date = scrapy.Field()
+    content = scrapy.Field()
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+# Persistent index of the scraped products (used by the incremental mode)
+#
+# For each product ID the index saves when the product was scraped for the
+# last time and a fingerprint of its data, so the next runs can skip the
+# products scraped recently and the products that were not modified.
+
+import os
+import time
+import sqlite3
+
+
+class ListingIndex(object):
+
+    # Number of updates saved in each transaction
+    COMMIT_EVERY = 100
+
+    def __init__(self, path, freshness):
+        # Time (in seconds) that a scraped product is not requested again
+        self.freshness = freshness
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS listings (
+                            product_id TEXT PRIMARY KEY, scraped_at REAL, fingerprint TEXT)""")
+        self.db.commit()
+        self._pending_updates = 0
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    # Check if the product was scraped inside the freshness window
+    def is_fresh(self, product_id):
+        row = self.db.execute('SELECT scraped_at FROM listings WHERE product_id = ?', (product_id,)).fetchone()
+        return row is not None and time.time() - row[0] < self.freshness
+
+    def fingerprint(self, product_id):
+        row = self.db.execute('SELECT fingerprint FROM listings WHERE product_id = ?', (product_id,)).fetchone()
+        return row[0] if row else None
+
+    # Save the fingerprint of the product and the current time
+    def update(self, product_id, fingerprint):
+        self.db.execute('INSERT OR REPLACE INTO listings VALUES (?, ?, ?)', (product_id, time.time(), fingerprint))
+        self._pending_updates += 1
+        if self._pending_updates >= self.COMMIT_EVERY:
+            self.db.commit()
+            self._pending_updates = 0
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+# Timings and counters of the crawl (used by the MetricsMiddleware and the CrawlMetrics extension)
+#
+# Each timing saves the number of calls, the wall time, the CPU time and the
+# slowest call, so the values are cheap to record and the memory does not grow
+# with the number of responses.
+
+import time
+from contextlib import contextmanager
+
+
+class Metrics(object):
+
+    def __init__(self):
+        # name -> [calls, wall time, cpu time, max wall time]
+        self.timings = {}
+        # name -> value
+        self.counters = {}
+        self.gauges = {}
+        # Time when each item left the spider (id(item) -> time), used to measure the pipelines
+        self.items_started = {}
+
+    # Measure the time of a block of code (ex: with metrics.time('selectors/search'): ...)
+    @contextmanager
+    def time(self, name):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+    # Same as time() for code that can not be inside a with block (ex: generators)
+    def start(self):
+        return time.perf_counter(), time.process_time()
+
+    def stop(self, name, started):
+        self.observe(name, time.perf_counter() - started[0], time.process_time() - started[1])
+
+    def observe(self, name, wall, cpu=0.0):
+        timing = self.timings.get(name)
+        if timing is None:
+            timing = self.timings[name] = [0, 0.0, 0.0, 0.0]
+        timing[0] += 1
+        timing[1] += wall
+        timing[2] += cpu
+        if wall > timing[3]:
+            timing[3] = wall
+
+    def item_started(self, item):
+        self.items_started[id(item)] = time.perf_counter()
+
+    def item_finished(self, item, name):
+        started = self.items_started.pop(id(item), None)
+        if started is not None:
+            self.observe(name, time.perf_counter() - started)
+
+    def inc(self, name, count=1):
+        self.counters[name] = self.counters.get(name, 0) + count
+
+    def set(self, name, value):
+        self.gauges[name] = value
+
+    # Values saved in the Scrapy stats (ex: metrics/callback/parse_product/wall_ms)
+    def stats(self):
+        values = {}
+        for name, (calls, wall, cpu, max_wall) in self.timings.items():
+            values['metrics/{}/calls'.format(name)] = calls
+            values['metrics/{}/wall_ms'.format(name)] = round(wall * 1000, 3)
+            values['metrics/{}/cpu_ms'.format(name)] = round(cpu * 1000, 3)
+            values['metrics/{}/max_ms'.format(name)] = round(max_wall * 1000, 3)
+        for name, value in list(self.counters.items()) + list(self.gauges.items()):
+            values['metrics/{}'.format(name)] = value
+        return values
+
+    # Prometheus text format, the first part of each name is the metric and the rest is the label
+    # (ex: callback/parse_product -> etsy_callback_seconds_sum{name="parse_product"})
+    def prometheus_text(self, prefix='etsy'):
+        lines = []
+        timings = {}
+        for name, timing in self.timings.items():
+            metric, _, label = name.partition('/')
+            timings.setdefault(metric, []).append((label, timing))
+
+        for metric, values in sorted(timings.items()):
+            full_name = '{}_{}_seconds'.format(prefix, metric)
+            lines.append('# TYPE {} summary'.format(full_name))
+            for label, (calls, wall, cpu, max_wall) in sorted(values):
+                lines.append('{}_count{{name="{}"}} {}'.format(full_name, label, calls))
+                lines.append('{}_sum{{name="{}"}} {:.6f}'.format(full_name, label, wall))
+            lines.append('# TYPE {}_cpu_seconds_total counter'.format(prefix + '_' + metric))
+            for label, (calls, wall, cpu, max_wall) in sorted(values):
+                lines.append('{}_{}_cpu_seconds_total{{name="{}"}} {:.6f}'.format(prefix, metric, label, cpu))
+
+        for kind, values in (('counter', self.counters), ('gauge', self.gauges)):
+            for name, value in sorted(values.items()):
+                full_name = '{}_{}'.format(prefix, name.replace('/', '_'))
+                if kind == 'counter':
+                    full_name += '_total'
+                lines.append('# TYPE {} {}'.format(full_name, kind))
+                lines.append('{} {}'.format(full_name, value))
+
+        return '\n'.join(lines) + '\n'
@@ -5,7 +5,22 @@
 # See documentation in:
 # https://doc.scrapy.org/en/latest/topics/spider-middleware.html
 
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import cProfile
+from twisted.internet import reactor
+from twisted.internet.task import deferLater
 from scrapy import signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.http import Headers, Request
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.project import data_path
+from w3lib.http import headers_dict_to_raw, headers_raw_to_dict
+from w3lib.url import canonicalize_url
+from etsy import classifier
 
 
 class EtsySpiderMiddleware(object):
@@ -101,3 +116,452 @@ class EtsyDownloaderMiddleware(object):
 
     def spider_opened(self, spider):
         spider.logger.info('Spider opened: %s' % spider.name)
+
+
+# On-disk cache of the responses
+# The bodies are saved in files named by the SHA1 of their content, so pages
+# with the same content are saved only once. The index of the cached URLs is
+# saved in a SQLite database.
+class ResponseCacheStorage(object):
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.bodies_dir = os.path.join(cache_dir, 'bodies')
+        self.max_size = max_size
+        os.makedirs(self.bodies_dir, exist_ok=True)
+
+        self.db = sqlite3.connect(os.path.join(cache_dir, 'index.db'), isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute("""CREATE TABLE IF NOT EXISTS responses (
+                            key TEXT PRIMARY KEY, url TEXT, status INTEGER, headers BLOB,
+                            body_hash TEXT, size INTEGER, etag TEXT, last_modified TEXT,
+                            validated_at REAL, accessed_at REAL)""")
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)')
+        self.total_size = self._bodies_size()
+
+    def close(self):
+        self.db.close()
+
+    # Size of all bodies saved (each body is counted once)
+    def _bodies_size(self):
+        row = self.db.execute('SELECT SUM(size) FROM (SELECT DISTINCT body_hash, size FROM responses)').fetchone()
+        return row[0] or 0
+
+    def _body_path(self, body_hash):
+        return os.path.join(self.bodies_dir, body_hash[:2], body_hash)
+
+    # Returns the cache entry (dict) of the key or None
+    def get(self, key):
+        row = self.db.execute('SELECT url, status, headers, body_hash, etag, last_modified, validated_at '
+                              'FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+
+        try:
+            with open(self._body_path(row[3]), 'rb') as f:
+                body = f.read()
+        except IOError:
+            # The body file was removed, ignore the entry
+            self.delete(key)
+            return None
+
+        self.db.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (time.time(), key))
+        return {'url': row[0], 'status': row[1], 'headers': headers_raw_to_dict(row[2]), 'body': body,
+                'etag': row[4], 'last_modified': row[5], 'validated_at': row[6]}
+
+    # Save the response and returns the number of entries evicted to free space
+    def store(self, key, response):
+        # The old entry is removed first: the page may be saved again with the same
+        # content (ex: a stale page downloaded again), its body file must be kept
+        self.delete(key)
+
+        body_hash = hashlib.sha1(response.body).hexdigest()
+        body_path = self._body_path(body_hash)
+        # The same content may be already saved by another URL
+        if not os.path.exists(body_path):
+            os.makedirs(os.path.dirname(body_path), exist_ok=True)
+            with open(body_path, 'wb') as f:
+                f.write(response.body)
+            self.total_size += len(response.body)
+
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        now = time.time()
+        self.db.execute('INSERT INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (key, response.url, response.status, headers_dict_to_raw(response.headers),
+                         body_hash, len(response.body),
+                         etag.decode('latin-1') if etag else None,
+                         last_modified.decode('latin-1') if last_modified else None,
+                         now, now))
+        return self.evict()
+
+    # Mark the entry as fresh again (after a 304 Not Modified response)
+    def touch(self, key):
+        now = time.time()
+        self.db.execute('UPDATE responses SET validated_at = ?, accessed_at = ? WHERE key = ?', (now, now, key))
+
+    def delete(self, key):
+        row = self.db.execute('SELECT body_hash, size FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return
+        self.db.execute('DELETE FROM responses WHERE key = ?', (key,))
+        # Remove the body file if no other entry uses it
+        if not self.db.execute('SELECT 1 FROM responses WHERE body_hash = ? LIMIT 1', (row[0],)).fetchone():
+            try:
+                os.remove(self._body_path(row[0]))
+            except OSError:
+                pass
+            self.total_size -= row[1]
+
+    # Remove the least recently used entries until the cache fits in max_size
+    # Returns the number of removed entries
+    def evict(self):
+        evicted = 0
+        while self.max_size and self.total_size > self.max_size:
+            row = self.db.execute('SELECT key FROM responses ORDER BY accessed_at LIMIT 1').fetchone()
+            if row is None:
+                break
+            self.delete(row[0])
+            evicted += 1
+        return evicted
+
+
+# Downloader middleware that caches the product and reviews pages between runs
+# Fresh pages (according to the TTL of each type of page) are served from the
+# cache, stale pages are revalidated with the ETag/Last-Modified headers.
+# It must run before the IdentityPoolMiddleware (650), so only the requests that
+# go to the network wait for the rate of an identity (the fresh pages are served
+# without identity). It stays further from the downloader than the
+# HttpCompressionMiddleware (590), the bodies are saved as they were downloaded.
+class EtsyHttpCacheMiddleware(object):
+
+    # Type of page of each URL, the first matching pattern is used
+    URL_TYPES = [
+        ('listing', re.compile(r'/listing/\d+')),
+        ('shop_reviews', re.compile(r'/shop/[^/]+/reviews')),
+        ('search', re.compile(r'/search\?')),
+    ]
+
+    def __init__(self, storage, ttls, stats, min_size=0):
+        self.storage = storage
+        self.ttls = ttls
+        self.stats = stats
+        # Minimum size of the HTML pages (see classifier.classify_response)
+        self.min_size = min_size
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('ETSY_HTTPCACHE_ENABLED'):
+            raise NotConfigured
+
+        storage = ResponseCacheStorage(data_path(settings['ETSY_HTTPCACHE_DIR'], createdir=True),
+                                       settings.getint('ETSY_HTTPCACHE_MAX_SIZE'))
+        s = cls(storage, settings.getdict('ETSY_HTTPCACHE_TTLS'), crawler.stats, settings.getint('CLASSIFIER_MIN_SIZE'))
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def spider_closed(self, spider):
+        self.storage.close()
+
+    # Time (in seconds) that a page of this URL is considered fresh
+    def ttl(self, url):
+        for url_type, pattern in self.URL_TYPES:
+            if pattern.search(url):
+                return self.ttls.get(url_type, 0)
+        return self.ttls.get('default', 0)
+
+    def request_key(self, request):
+        return hashlib.sha1(canonicalize_url(request.url).encode('utf-8')).hexdigest()
+
+    def cached_response(self, entry, flags):
+        headers = Headers(entry['headers'])
+        respcls = responsetypes.from_args(headers=headers, url=entry['url'], body=entry['body'])
+        return respcls(url=entry['url'], status=entry['status'], headers=headers,
+                       body=entry['body'], flags=flags)
+
+    def process_request(self, request, spider):
+        # Only GET requests are cached (the Ajax requests are POST)
+        if request.method != 'GET' or request.meta.get('dont_cache') or not self.ttl(request.url):
+            return None
+
+        key = self.request_key(request)
+        entry = self.storage.get(key)
+        if entry is None:
+            self.stats.inc_value('etsy_httpcache/miss', spider=spider)
+            return None
+
+        # Fresh page, it is not downloaded again
+        if time.time() - entry['validated_at'] < self.ttl(request.url):
+            self.stats.inc_value('etsy_httpcache/hit', spider=spider)
+            return self.cached_response(entry, ['cached'])
+
+        # Stale page, ask the server if it was modified
+        self.stats.inc_value('etsy_httpcache/stale', spider=spider)
+        request.meta['_etsy_cache_key'] = key
+        if entry['etag']:
+            request.headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            request.headers['If-Modified-Since'] = entry['last_modified']
+        return None
+
+    def process_response(self, request, response, spider):
+        if 'cached' in response.flags or request.method != 'GET' or request.meta.get('dont_cache'):
+            return response
+
+        key = request.meta.pop('_etsy_cache_key', None)
+        # The stale page was not modified, use the cached version
+        if key and response.status == 304:
+            entry = self.storage.get(key)
+            if entry is not None:
+                self.storage.touch(key)
+                self.stats.inc_value('etsy_httpcache/revalidated', spider=spider)
+                return self.cached_response(entry, ['cached', 'revalidated'])
+
+            # The entry was evicted meanwhile, download the page again
+            retry = request.replace(dont_filter=True)
+            retry.headers.pop('If-None-Match', None)
+            retry.headers.pop('If-Modified-Since', None)
+            return retry
+
+        if response.status == 200 and self.ttl(request.url):
+            # Blocked, captcha and unavailable pages are not saved
+            response_class = classifier.classify_response(response, self.min_size)
+            if response_class != classifier.OK:
+                self.stats.inc_value('etsy_httpcache/skipped/{}'.format(response_class), spider=spider)
+                return response
+
+            evicted = self.storage.store(key or self.request_key(request), response)
+            self.stats.inc_value('etsy_httpcache/store', spider=spider)
+            if evicted:
+                self.stats.inc_value('etsy_httpcache/evicted', evicted, spider=spider)
+
+        return response
+
+
+
+# Classify each response before it is parsed (see etsy/classifier.py)
+# The blocked and captcha pages are requested again (up to CLASSIFIER_MAX_RETRIES
+# times) and the unavailable products are dropped, so they never reach the
+# callbacks. The dropped requests go to the errback of the request (IgnoreRequest).
+# It must be further from the downloader than the HttpCompressionMiddleware (590),
+# so the pages are already decompressed (the EtsyHttpCacheMiddleware classifies
+# the pages itself, so the blocked pages are not saved in the cache).
+class ResponseClassifierMiddleware(object):
+
+    def __init__(self, max_retries, min_size, stats):
+        self.max_retries = max_retries
+        self.min_size = min_size
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('CLASSIFIER_ENABLED'):
+            raise NotConfigured
+        return cls(settings.getint('CLASSIFIER_MAX_RETRIES'), settings.getint('CLASSIFIER_MIN_SIZE'), crawler.stats)
+
+    def process_response(self, request, response, spider):
+        # The Ajax responses are JSON, they have no page to classify
+        if request.method != 'GET':
+            return response
+
+        response_class = classifier.classify_response(response, self.min_size)
+        self.stats.inc_value('classifier/{}'.format(response_class), spider=spider)
+        request.meta['response_class'] = response_class
+
+        if response_class == classifier.OK:
+            return response
+
+        if response_class == classifier.UNAVAILABLE:
+            raise IgnoreRequest('Product not available: {}'.format(request.url))
+
+        # Blocked or captcha page: try again later
+        retries = request.meta.get('classifier_retries', 0) + 1
+        if retries > self.max_retries:
+            self.stats.inc_value('classifier/dropped/{}'.format(response_class), spider=spider)
+            raise IgnoreRequest('Page {} after {} retries: {}'.format(response_class, self.max_retries, request.url))
+
+        self.stats.inc_value('classifier/retry', spider=spider)
+        spider.logger.debug('Page {} ({}), retrying ({}/{}): {}'.format(
+            response_class, response.status, retries, self.max_retries, request.url))
+        retry = request.replace(dont_filter=True, priority=request.priority - 1)
+        retry.meta['classifier_retries'] = retries
+        return retry
+
+
+# Spread the requests over a pool of identities (proxy + user agent + cookie jar)
+# Each identity sends at most IDENTITY_REQUESTS_PER_MINUTE requests, a request waits
+# here until its identity has place. A request that already has an identity
+# (meta['identity'], ex: the Ajax request of a product's page) keeps it, so the
+# session cookie, the proxy and the user agent are the same of the page.
+# An identity that gets IDENTITY_MAX_BLOCKS blocked or captcha pages is retired
+# (the last identity is never retired).
+# It must run before the CookiesMiddleware and the HttpProxyMiddleware, that use
+# the cookie jar and the proxy (with its credentials) of the identity, and after
+# the EtsyHttpCacheMiddleware, so the pages read from the cache are not counted
+# in the rate of the identities.
+class IdentityPoolMiddleware(object):
+
+    def __init__(self, identities, interval, max_blocks, stats, min_size=0):
+        self.identities = identities
+        # Minimum time between two requests of the same identity
+        self.interval = interval
+        self.max_blocks = max_blocks
+        self.stats = stats
+        # Minimum size of the HTML pages (see classifier.classify_response)
+        self.min_size = min_size
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('IDENTITY_POOL_ENABLED'):
+            raise NotConfigured
+
+        proxies = settings.getlist('IDENTITY_PROXIES') or [None]
+        user_agents = settings.getlist('IDENTITY_USER_AGENTS') or [settings.get('USER_AGENT')]
+        size = settings.getint('IDENTITY_POOL_SIZE') or max(len(proxies), len(user_agents))
+
+        identities = {}
+        for n in range(size):
+            name = 'identity-{}'.format(n)
+            identities[name] = {
+                'proxy': proxies[n % len(proxies)],
+                'user_agent': user_agents[n % len(user_agents)],
+                'next_request': 0.0,
+                'blocks': 0,
+                'retired': False,
+            }
+
+        rate = settings.getfloat('IDENTITY_REQUESTS_PER_MINUTE')
+        s = cls(identities, 60.0 / rate if rate else 0.0, settings.getint('IDENTITY_MAX_BLOCKS'), crawler.stats,
+                settings.getint('CLASSIFIER_MIN_SIZE'))
+        # The downloaded pages are checked before the other middlewares retry them (the cached pages are not checked)
+        # The signal is sent before the HttpCompressionMiddleware, the classifier decodes the body
+        crawler.signals.connect(s.response_downloaded, signal=signals.response_downloaded)
+        return s
+
+    # The active identity that can send a request first
+    def next_identity(self):
+        active = [name for name, identity in self.identities.items() if not identity['retired']]
+        return min(active, key=lambda name: self.identities[name]['next_request'])
+
+    def process_request(self, request, spider):
+        name = request.meta.get('identity')
+        if name not in self.identities or self.identities[name]['retired']:
+            if name is not None:
+                self.stats.inc_value('identity/reassigned', spider=spider)
+            name = self.next_identity()
+        identity = self.identities[name]
+
+        request.meta['identity'] = name
+        request.meta['cookiejar'] = name
+        request.headers['User-Agent'] = identity['user_agent']
+        if identity['proxy']:
+            request.meta['proxy'] = identity['proxy']
+        self.stats.inc_value('identity/requests/{}'.format(name), spider=spider)
+
+        # Reserve the next place of the identity, the request waits until then
+        now = time.time()
+        wait = max(0.0, identity['next_request'] - now)
+        identity['next_request'] = now + wait + self.interval
+        if wait > 0:
+            self.stats.inc_value('identity/delayed', spider=spider)
+            return deferLater(reactor, wait, self.identity_ready, request, spider)
+        return None
+
+    # The identity may have been retired while the request was waiting, it gets another identity
+    def identity_ready(self, request, spider):
+        if self.identities[request.meta['identity']]['retired']:
+            return self.process_request(request, spider)
+        return None
+
+    def response_downloaded(self, response, request, spider):
+        name = request.meta.get('identity')
+        identity = self.identities.get(name)
+        if identity is None:
+            return
+
+        response_class = classifier.classify_response(response, self.min_size)
+        if response_class not in (classifier.BLOCKED, classifier.CAPTCHA):
+            return
+
+        # The request is sent again (ex: by the ResponseClassifierMiddleware) with another identity
+        request.meta.pop('identity', None)
+        identity['blocks'] += 1
+        self.stats.inc_value('identity/blocked/{}'.format(name), spider=spider)
+
+        active = sum(1 for i in self.identities.values() if not i['retired'])
+        if identity['blocks'] >= self.max_blocks and not identity['retired'] and active > 1:
+            identity['retired'] = True
+            self.stats.inc_value('identity/retired', spider=spider)
+            spider.logger.warning('Identity {} retired after {} blocked pages'.format(name, identity['blocks']))
+
+
+# Measure the wall and CPU time of each spider callback (see etsy/metrics.py)
+# The callbacks are generators, so the time is measured while the spider creates
+# each result. It must be the spider middleware closest to the spider.
+# The first METRICS_PROFILE_RESPONSES responses are also profiled with cProfile
+# and the profile is saved in METRICS_PROFILE_FILE when the spider is closed
+# (read it with: python -m pstats metrics.prof).
+class MetricsMiddleware(object):
+
+    def __init__(self, profile_responses, profile_file):
+        self.profile_responses = profile_responses
+        self.profile_file = profile_file
+        self.profiler = cProfile.Profile() if profile_responses else None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('METRICS_ENABLED'):
+            raise NotConfigured
+
+        mw = cls(settings.getint('METRICS_PROFILE_RESPONSES'), settings.get('METRICS_PROFILE_FILE'))
+        crawler.signals.connect(mw.spider_closed, signal=signals.spider_closed)
+        return mw
+
+    def process_spider_output(self, response, result, spider):
+        metrics = getattr(spider, 'metrics', None)
+        if metrics is None:
+            for r in result:
+                yield r
+            return
+
+        callback = response.request.callback if response.request is not None else None
+        name = getattr(callback, '__name__', 'parse')
+        metrics.inc('response_bytes/{}'.format(name), len(response.body))
+
+        profiler = None
+        if self.profile_responses > 0:
+            self.profile_responses -= 1
+            profiler = self.profiler
+
+        wall = cpu = 0.0
+        result = iter(result)
+        try:
+            while True:
+                started = metrics.start()
+                if profiler:
+                    profiler.enable()
+                try:
+                    r = next(result)
+                except StopIteration:
+                    break
+                finally:
+                    if profiler:
+                        profiler.disable()
+                    wall += time.perf_counter() - started[0]
+                    cpu += time.process_time() - started[1]
+
+                if not isinstance(r, Request):
+                    metrics.item_started(r)
+                yield r
+        finally:
+            metrics.observe('callback/{}'.format(name), wall, cpu)
+
+    def spider_closed(self, spider):
+        if self.profiler and self.profile_file:
+            self.profiler.dump_stats(self.profile_file)
+            spider.logger.info('Profile of the callbacks saved in {}'.format(self.profile_file))
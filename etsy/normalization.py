@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+# Functions that convert the scraped strings to typed values
+#
+# The regular expressions are compiled only once, when the module is loaded.
+
+import re
+from decimal import Decimal, InvalidOperation
+
+# Ex: "$24.99+", "BRL 1,236.62", "€24,99", "CA$ 10.00", "1 236,50 €"
+# A space in the amount is a thousands separator (it is followed by 3 digits)
+PRICE_RE = re.compile(r'(?P<before>[^\d\s]*)\s*(?P<amount>\d(?:[\d.,]|\s(?=\d{3}(?!\d)))*)\s*(?P<after>[^\d\s+]*)')
+# Amount using a dot or a space as thousands separator and a comma as decimal separator
+# (ex: 1.236,62, 1 236,50, 24,99 or 1.236 without decimals)
+DECIMAL_COMMA_RE = re.compile(r'^\d{1,3}([.\s]\d{3})*(,\d{2})?$')
+# Thousands separators of both formats
+DOT_SEPARATORS_RE = re.compile(r'[.\s]')
+COMMA_SEPARATORS_RE = re.compile(r'[,\s]')
+CURRENCY_CODE_RE = re.compile(r'^[A-Z]{3}$')
+DIGITS_RE = re.compile(r'\d+')
+
+# Currency code of each symbol shown by Etsy
+CURRENCY_SYMBOLS = {
+    '$': 'USD',
+    'US$': 'USD',
+    'CA$': 'CAD',
+    'A$': 'AUD',
+    'AU$': 'AUD',
+    'NZ$': 'NZD',
+    'MX$': 'MXN',
+    'HK$': 'HKD',
+    'R$': 'BRL',
+    '€': 'EUR',
+    '£': 'GBP',
+    '¥': 'JPY',
+    '₹': 'INR',
+    'kr': 'SEK',
+    'zł': 'PLN',
+    'CHF': 'CHF',
+}
+
+
+# Returns the price as a Decimal and its currency code (None if not found)
+def parse_price(text):
+    if text is None:
+        return None, None
+    if isinstance(text, (int, float, Decimal)):
+        return Decimal(str(text)), None
+
+    match = PRICE_RE.search(text)
+    if not match:
+        return None, None
+
+    amount = match.group('amount').rstrip('.,')
+    if DECIMAL_COMMA_RE.match(amount):
+        amount = DOT_SEPARATORS_RE.sub('', amount).replace(',', '.')
+    else:
+        amount = COMMA_SEPARATORS_RE.sub('', amount)
+
+    try:
+        price = Decimal(amount)
+    except InvalidOperation:
+        return None, None
+
+    return price, parse_currency(match.group('before') or match.group('after'))
+
+
+def parse_currency(symbol):
+    symbol = symbol.strip().rstrip('+')
+    if not symbol:
+        return None
+    if symbol in CURRENCY_SYMBOLS:
+        return CURRENCY_SYMBOLS[symbol]
+    if CURRENCY_CODE_RE.match(symbol):
+        return symbol
+    return None
+
+
+# Sometimes the spider take the rate in the wrong format (ex: 48.333 instead of 4.8333)
+def parse_rating(text):
+    try:
+        rating = float(text)
+    except (TypeError, ValueError):
+        return None
+
+    while rating > 5:
+        rating = rating / 10
+    return round(rating, 2)
+
+
+# Returns the first number of the text as an int (ex: "(1,234)" -> 1234, "1350 favorites" -> 1350)
+def parse_count(text):
+    if text is None:
+        return None
+    if isinstance(text, int):
+        return text
+
+    match = DIGITS_RE.search(str(text).replace(',', ''))
+    return int(match.group()) if match else None
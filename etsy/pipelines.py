@@ -5,37 +5,300 @@
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: https://doc.scrapy.org/en/latest/topics/item-pipeline.html
 
+import os
+import re
+import json
+import hashlib
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+from concurrent.futures import ProcessPoolExecutor
+from scrapy.exceptions import DropItem, NotConfigured
+from scrapy.exporters import CsvItemExporter
+from scrapy.http import Request
+from scrapy.pipelines.files import FilesPipeline, FSFilesStore
+from scrapy.settings import Settings
+from scrapy.utils.misc import load_object
+from scrapy.utils.serialize import ScrapyJSONEncoder
+from etsy.exporters import FEED_FORMATS, previous_file
+from etsy.images_index import ImageIndex
+from etsy.normalization import parse_count, parse_price, parse_rating
+
+# Pillow is only needed for the thumbnails
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Size of the image in the URL (ex: il_794xN.275174392_img0.jpg)
+IMAGE_SIZE_RE = re.compile(r'/il_[^/.]+\.')
+
+
 # This Pipeline processes several items scraped.
+# The strings are converted to typed values (see etsy/normalization.py)
 class EtsyPipeline(object):
     def process_item(self, item, spider):
-        
-        # Format the price output
+
+        # Get the price as a number and its currency (ex: "BRL 1,236.62+" or "$24.99")
         if 'price' in item:
-            # Check if there is a currency symbol
-            if len(item['price'].split()) > 1:
-                # Remove the currency symbol and the + signal
-                item['price'] = item['price'].split()[1].replace('+','')
-            else:
-                # Remove the currency symbol and the + signal
-                item['price'] = item['price'].replace('$','').replace('+','')
-        
-        # Remove the 'in' string 
+            price, currency = parse_price(item['price'])
+            item['price'] = price
+            if currency and not item.get('currency'):
+                item['currency'] = currency
+
+        # Remove the 'in' string
         if 'store_location' in item:
             item['store_location'] = item['store_location'].replace('in ', '')
-        
-        # Remove the 'From' string 
+
+        # Remove the 'From' string
         if 'return_location' in item:
             item['return_location'] = item['return_location'].replace('From ', '')
 
         # Sometimes the spider take the rate in the wrong format (ex: 48.333 instead of 4.8333)
         if 'rating' in item:
-            rating = item['rating']
-            if float(rating) > 5:
-                # Ex: Transform this 48.333 in 4.83)
-                rating = rating[0] + '.' + rating[1:2]
-            else:
-                rating = round(float(rating), 2)
-
-            item['rating'] = rating
-        
-        return item     
+            item['rating'] = parse_rating(item['rating'])
+
+        # Counts as integers
+        for field in ('number_of_reviews', 'favorited_by', 'count_of_images'):
+            if field in item:
+                item[field] = parse_count(item[field])
+
+        return item
+
+
+# This Pipeline drops the products that were not modified since the last run (incremental mode)
+class IncrementalPipeline(object):
+
+    # Fields that are not product data (the crawl that found the product and the files saved)
+    IGNORED_FIELDS = ('search_queries', 'images_paths')
+
+    def process_item(self, item, spider):
+        index = getattr(spider, 'listing_index', None)
+        if index is None or not item.get('product_id'):
+            return item
+
+        # Fingerprint of all the product data
+        data = json.dumps({field: value for field, value in item.items() if field not in self.IGNORED_FIELDS},
+                          sort_keys=True, default=str)
+        fingerprint = hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+        modified = index.fingerprint(item['product_id']) != fingerprint
+        # Save the fingerprint and the time the product was scraped
+        index.update(item['product_id'], fingerprint)
+
+        if not modified:
+            spider.crawler.stats.inc_value('incremental/not_modified')
+            raise DropItem('Product {} was not modified'.format(item['product_id']))
+
+        return item
+
+
+# This Pipeline downloads the images of each product (IMAGES_STORE setting)
+# The images are requested by Scrapy, so they are downloaded in parallel with
+# the same concurrency limits of the other requests.
+# Each image is saved by the hash of its content (full/<hash[:2]>/<hash>.jpg),
+# so the same image of several products is saved once, and the URLs already
+# downloaded in the previous runs are not requested again (see etsy/images_index.py).
+# The paths of the images are saved in the images_paths field.
+# If IMAGES_THUMBS is set, the thumbnails are created by a pool of processes.
+class EtsyImagesPipeline(FilesPipeline):
+
+    def __init__(self, store_uri, download_func=None, settings=None):
+        super(EtsyImagesPipeline, self).__init__(store_uri, download_func=download_func, settings=settings)
+        self.full_size = settings.getbool('IMAGES_FULL_SIZE')
+        self.max_per_item = settings.getint('IMAGES_MAX_PER_ITEM')
+        self.thumbs = settings.getdict('IMAGES_THUMBS')
+
+        # The index and the thumbnails are used only when the images are saved in a local folder
+        self.basedir = self.store.basedir if isinstance(self.store, FSFilesStore) else None
+        self.index = ImageIndex(os.path.join(self.basedir, 'index.db')) if self.basedir else None
+
+        self.pool = None
+        if self.thumbs and self.basedir:
+            if Image is None:
+                raise NotConfigured('The thumbnails (IMAGES_THUMBS) require Pillow (pip install Pillow)')
+            self.pool = ProcessPoolExecutor(max_workers=settings.getint('IMAGES_THUMBS_WORKERS') or None)
+        self.thumbs_jobs = []
+
+    @classmethod
+    def from_settings(cls, settings):
+        if not settings.get('IMAGES_STORE'):
+            raise NotConfigured
+        # The FilesPipeline reads the folder (or the S3/GCS/FTP URI) from FILES_STORE
+        settings = Settings(settings.copy_to_dict())
+        settings.set('FILES_STORE', settings['IMAGES_STORE'])
+        return super(EtsyImagesPipeline, cls).from_settings(settings)
+
+    def close_spider(self, spider):
+        if self.pool:
+            for job in self.thumbs_jobs:
+                if job.exception():
+                    spider.logger.error('Error creating the thumbnails: {}'.format(job.exception()))
+            self.pool.shutdown(wait=True)
+        if self.index:
+            self.index.close()
+
+    # URLs of the images of the product
+    # Ex: //i.etsystatic.com/.../il_794xN.275174392_img0.jpg -> https://i.etsystatic.com/.../il_fullxfull.275174392_img0.jpg
+    def image_urls(self, item):
+        urls = item.get('images_urls') or []
+        if isinstance(urls, str):
+            urls = urls.split(',')
+
+        images = []
+        for url in urls:
+            url = url.strip()
+            if not url:
+                continue
+            if url.startswith('//'):
+                url = 'https:' + url
+            if self.full_size:
+                url = IMAGE_SIZE_RE.sub('/il_fullxfull.', url)
+            if url not in images:
+                images.append(url)
+
+        if self.max_per_item:
+            images = images[:self.max_per_item]
+        return images
+
+    def get_media_requests(self, item, info):
+        return [Request(url) for url in self.image_urls(item)]
+
+    # The images downloaded in the previous runs are not requested again
+    def media_to_download(self, request, info, *, item=None):
+        image = self.index.get(request.url) if self.index else None
+        if image is None or not os.path.exists(os.path.join(self.basedir, image[0])):
+            return None
+
+        self.inc_stats(info.spider, 'uptodate')
+        return {'url': request.url, 'path': image[0], 'checksum': image[1], 'status': 'uptodate'}
+
+    # The image is saved by the hash of its content
+    def file_path(self, request, response=None, info=None, *, item=None):
+        if response is None:
+            return super(EtsyImagesPipeline, self).file_path(request, response=response, info=info)
+
+        checksum = hashlib.sha1(response.body).hexdigest()
+        extension = os.path.splitext(request.url.split('?')[0])[1] or '.jpg'
+        return 'full/{}/{}{}'.format(checksum[:2], checksum, extension)
+
+    def file_downloaded(self, response, request, info, *, item=None):
+        path = self.file_path(request, response=response, info=info)
+        checksum = os.path.splitext(os.path.basename(path))[0]
+
+        # The same image was already saved (ex: from another product)
+        if self.basedir and os.path.exists(os.path.join(self.basedir, path)):
+            self.inc_stats(info.spider, 'deduplicated')
+        else:
+            super(EtsyImagesPipeline, self).file_downloaded(response, request, info)
+            if self.pool:
+                self.thumbs_jobs.append(self.pool.submit(create_thumbnails, self.basedir, path, self.thumbs))
+
+        if self.index:
+            self.index.add(request.url, path, checksum)
+        return checksum
+
+    def item_completed(self, results, item, info):
+        item['images_paths'] = [result['path'] for ok, result in results if ok]
+        return item
+
+
+# Create the thumbnails of an image (runs in the pool of processes)
+# The thumbnails are saved in thumbs/<size name>/ with the same name of the image
+def create_thumbnails(basedir, path, thumbs):
+    image = Image.open(os.path.join(basedir, path))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    for name, size in thumbs.items():
+        thumb = image.copy()
+        thumb.thumbnail(tuple(size))
+        thumb_path = os.path.join(basedir, 'thumbs', name, os.path.splitext(os.path.basename(path))[0] + '.jpg')
+        os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+        thumb.save(thumb_path, 'JPEG')
+
+
+# This Pipeline saves the items in the shared item sink (distributed mode, see etsy/distributed.py)
+# The items of all workers are exported with: python -m etsy.distributed --crawl <name> --export products.csv
+class DistributedItemPipeline(object):
+
+    def __init__(self):
+        self.encoder = ScrapyJSONEncoder()
+
+    def process_item(self, item, spider):
+        frontier = getattr(spider, 'frontier', None)
+        if frontier is not None:
+            frontier.push_item(self.encoder.encode(dict(item)))
+        return item
+
+
+# This Pipeline saves the reviews of each product in a separate file (REVIEWS_FEED_URI setting)
+# The file format is chosen by the file extension (ex: reviews.jl, reviews.csv)
+# The URI is opened with the feed storages of Scrapy (FEED_STORAGES), so it can be a local
+# path, a file:// URI or a remote URI (ex: s3://) and it can have the parameters of the feeds
+# (ex: reviews_%(time)s.csv). The file is created when the first review arrives.
+class ReviewsPipeline(object):
+
+    def __init__(self, uri, exporter_cls, fields, crawler):
+        self.uri = uri
+        self.exporter_cls = exporter_cls
+        self.fields = fields
+        self.crawler = crawler
+        self.storage = None
+        self.exporter = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        uri = crawler.settings.get('REVIEWS_FEED_URI')
+        if not uri:
+            raise NotConfigured
+
+        feed_format = FEED_FORMATS.get(os.path.splitext(urlparse(uri).path)[1], 'jsonlines')
+        exporter_cls = load_object(crawler.settings.getwithbase('FEED_EXPORTERS')[feed_format])
+        return cls(uri, exporter_cls, crawler.settings.getlist('REVIEWS_FEED_EXPORT_FIELDS'), crawler)
+
+    def open_spider(self, spider):
+        # The parameters are set when the crawl starts (as the FeedExporter does)
+        self.uri = self.uri % self.uri_params(spider)
+
+    def close_spider(self, spider):
+        if self.exporter is None:
+            return None
+        self.exporter.finish_exporting()
+        # The remote storages upload the file here
+        return self.storage.store(self.file)
+
+    def process_item(self, item, spider):
+        # The reviews are removed from the product
+        for review in item.pop('reviews', None) or []:
+            if self.exporter is None:
+                self.open_file(spider)
+            self.exporter.export_item(review)
+        return item
+
+    # A resumed crawl adds the reviews to the file of the first run (the CSV header is not written again)
+    def open_file(self, spider):
+        resume = getattr(spider, 'RESUME', False)
+        self.storage = self.feed_storage(self.uri, {'overwrite': not resume})
+        self.file = self.storage.open(spider)
+        kwargs = {}
+        if resume and issubclass(self.exporter_cls, CsvItemExporter) and previous_file(self.file):
+            kwargs['include_headers_line'] = False
+        self.exporter = self.exporter_cls(self.file, fields_to_export=self.fields, **kwargs)
+        self.exporter.start_exporting()
+
+    # Storage of the URI, the same used for the feeds of the URI scheme
+    def feed_storage(self, uri, feed_options):
+        storages = self.crawler.settings.getwithbase('FEED_STORAGES')
+        storage_cls = load_object(storages.get(urlparse(uri).scheme, storages['file']))
+        if hasattr(storage_cls, 'from_crawler'):
+            return storage_cls.from_crawler(self.crawler, uri, feed_options=feed_options)
+        return storage_cls(uri, feed_options=feed_options)
+
+    # Parameters of the URI: the spider attributes and the time (and FEED_URI_PARAMS if it is set)
+    def uri_params(self, spider):
+        params = {name: getattr(spider, name) for name in dir(spider)}
+        params['time'] = datetime.now(tz=timezone.utc).replace(microsecond=0).isoformat().replace(':', '-')
+        uri_params_function = self.crawler.settings.get('FEED_URI_PARAMS')
+        if uri_params_function:
+            params = load_object(uri_params_function)(params, spider) or params
+        return params
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+# Temporary storage of the store's reviews (reviews option 3)
+#
+# The reviews of each store's reviews page are saved in a SQLite file as soon
+# as the page is parsed, so the spider keeps in memory only the next page of
+# each store and the products waiting for the reviews, no matter how many
+# reviews the store has. The reviews of a product are read when its item is
+# built.
+# The URL of each page saved is also kept, so a page parsed again (ex: the next
+# page saved in the checkpoint of a resumed crawl) does not add its reviews twice.
+
+import os
+import sqlite3
+
+
+class ReviewsSpool(object):
+
+    def __init__(self, path, keep=False):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # The reviews of a previous crawl are kept only when the crawl is resumed
+        if not keep and os.path.exists(path):
+            os.remove(path)
+
+        self.db = sqlite3.connect(path)
+        # It is a temporary file, so it does not need to survive a system crash
+        self.db.execute('PRAGMA synchronous = OFF')
+        self.db.execute("""CREATE TABLE IF NOT EXISTS reviews (
+                            store_name TEXT, listing_id TEXT, profile TEXT, rating TEXT, date TEXT, content TEXT)""")
+        self.db.execute('CREATE INDEX IF NOT EXISTS reviews_listing ON reviews (store_name, listing_id)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS pages (store_name TEXT, page TEXT, PRIMARY KEY (store_name, page))')
+        self.db.commit()
+
+    # Save the reviews of a page: [(listing_id, profile, rating, date, content)]
+    # Returns False if the page was already saved (its reviews are ignored)
+    def add(self, store_name, page, reviews):
+        if not self.db.execute('INSERT OR IGNORE INTO pages VALUES (?, ?)', (store_name, page)).rowcount:
+            return False
+        self.db.executemany('INSERT INTO reviews VALUES (?, ?, ?, ?, ?, ?)',
+                            [(store_name,) + tuple(review) for review in reviews])
+        self.db.commit()
+        return True
+
+    # Reviews of a product in the order they were found: [(profile, rating, date, content)]
+    def get(self, store_name, listing_id, limit=None):
+        return self.db.execute('SELECT profile, rating, date, content FROM reviews '
+                               'WHERE store_name = ? AND listing_id = ? ORDER BY rowid LIMIT ?',
+                               (store_name, listing_id, limit or -1)).fetchall()
+
+    def count(self, store_name, listing_id):
+        return self.db.execute('SELECT COUNT(*) FROM reviews WHERE store_name = ? AND listing_id = ?',
+                               (store_name, listing_id)).fetchone()[0]
+
+    def close(self, remove=True):
+        self.db.close()
+        if remove and os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+#==============================================================================
+#title           :shards.py
+#description     :Split a file of search strings between several Scrapy processes and merge the results.
+#usage           :python -m etsy.shards --search-file queries.txt --workers 4 -o products.csv -a reviews_option=1
+#python version  :3.6
+#==============================================================================
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+from scrapy.utils.misc import load_object
+from scrapy.utils.project import get_project_settings
+from etsy.exporters import FEED_FORMATS
+
+
+# Run one search_products process for each shard of the search strings
+# The extra arguments (ex: -a reviews_option=3) are passed to all processes
+# Each process saves its items in a JSON Lines file
+def run_shards(search_file, workers, output, extra_args):
+    stem = os.path.splitext(output)[0]
+    shard_files = ['{}.shard{}.jl'.format(stem, i) for i in range(workers)]
+
+    processes = []
+    for i, shard_file in enumerate(shard_files):
+        # Scrapy appends the items to existing files
+        if os.path.exists(shard_file):
+            os.remove(shard_file)
+
+        cmd = [sys.executable, '-m', 'scrapy', 'crawl', 'search_products',
+               '-a', 'search_file={}'.format(search_file),
+               '-a', 'shard={}'.format(i), '-a', 'shards={}'.format(workers),
+               '-o', shard_file] + extra_args
+        processes.append(subprocess.Popen(cmd))
+
+    failed = [i for i, p in enumerate(processes) if p.wait() != 0]
+    if failed:
+        print('Shards with errors: {}'.format(failed))
+
+    return shard_files
+
+
+# Read the items of all shards, the products found by more than one shard are saved once
+def read_shards(shard_files):
+    items = {}
+    for shard_file in shard_files:
+        for item in read_jsonlines(shard_file):
+            key = item.get('product_id') or item.get('url')
+
+            if key in items:
+                # Join the search strings that found the product
+                queries = set(items[key].get('search_queries', '').split('|'))
+                queries.update(item.get('search_queries', '').split('|'))
+                items[key]['search_queries'] = '|'.join(sorted(q for q in queries if q))
+            else:
+                items[key] = item
+    return list(items.values())
+
+
+# Read the reviews files of all shards, the reviews of a product found by more than one shard are saved once
+def read_shards_reviews(shard_files):
+    reviews = {}
+    for shard_file in shard_files:
+        for review in read_jsonlines(os.path.splitext(shard_file)[0] + '_reviews.jl'):
+            reviews.setdefault((review.get('product_id'), review.get('review_number')), review)
+    return list(reviews.values())
+
+
+def read_jsonlines(path):
+    if not os.path.exists(path):
+        return
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+# Save the merged items using the project exporters (a CSV output also creates the Excel file)
+def export_items(items, output, fields=None, xlsx=True):
+    settings = get_project_settings()
+    exporters = settings.getwithbase('FEED_EXPORTERS')
+    fields = fields or settings.getlist('FEED_EXPORT_FIELDS') or None
+
+    stem, ext = os.path.splitext(output)
+    outputs = [(output, FEED_FORMATS[ext])]
+    if ext == '.csv' and xlsx:
+        outputs.append((stem + '.xlsx', 'xlsx'))
+
+    for path, feed_format in outputs:
+        with open(path, 'wb') as f:
+            exporter = load_object(exporters[feed_format])(f, fields_to_export=fields)
+            exporter.start_exporting()
+            for item in items:
+                exporter.export_item(item)
+            exporter.finish_exporting()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run search_products for a file of search strings using several processes')
+    parser.add_argument('--search-file', required=True, help='file with one search string per line')
+    parser.add_argument('--workers', type=int, default=2, help='number of Scrapy processes')
+    parser.add_argument('-o', '--output', required=True, help='merged output file ({})'.format(', '.join(FEED_FORMATS)))
+    parser.add_argument('--keep-shards', action='store_true', help='do not remove the output of each process')
+    args, extra_args = parser.parse_known_args()
+
+    if os.path.splitext(args.output)[1] not in FEED_FORMATS:
+        parser.error('Output format not supported: {}'.format(args.output))
+
+    shard_files = run_shards(args.search_file, args.workers, args.output, extra_args)
+    items = read_shards(shard_files)
+    export_items(items, args.output)
+    print('{} products saved in {}'.format(len(items), args.output))
+
+    reviews = read_shards_reviews(shard_files)
+    if reviews:
+        stem, ext = os.path.splitext(args.output)
+        export_items(reviews, stem + '_reviews' + ext, fields=get_project_settings().getlist('REVIEWS_FEED_EXPORT_FIELDS'), xlsx=False)
+
+    if not args.keep_shards:
+        for shard_file in shard_files:
+            for path in (shard_file, os.path.splitext(shard_file)[0] + '_reviews.jl'):
+                if os.path.exists(path):
+                    os.remove(path)
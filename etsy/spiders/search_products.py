@@ -9,16 +9,29 @@
 #==============================================================================
 
 
-import scrapy
 import os
-import sys
-import csv
-import glob
+import time
+import tempfile
+import scrapy
 import json
-from openpyxl import Workbook
+from collections import deque
+from twisted.internet import reactor
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
 from scrapy.http import Request
-from etsy.items import ProductItem
+from etsy.items import ProductItem, ReviewItem
+from etsy import extractors
+from etsy import classifier
+from etsy.exporters import FEED_FORMATS, local_file_size
+from etsy.budget import ItemBudget
+from etsy.listings_index import ListingIndex
+from etsy.checkpoint import CrawlCheckpoint
+from etsy.reviews_spool import ReviewsSpool
+from etsy.metrics import Metrics
+from etsy.distributed import RedisFrontier
+from etsy.normalization import parse_count, parse_rating
 from scrapy.loader import ItemLoader
+from scrapy.utils.project import data_path
 
 # Spider Class
 class ProductsSpider(scrapy.Spider):
@@ -29,99 +42,703 @@ class ProductsSpider(scrapy.Spider):
 
     # Max number of items
     COUNT_MAX = 10**100
-    # Count the number of items scraped
-    COUNTER = 0
+    # Count the products requested and scraped (see etsy/budget.py)
+    budget = None
+    # Products found in the search pages and not requested yet (product_id, search)
+    waiting_products = None
+    # Next search pages not requested yet (url, search, page, last_page, price_range), they are requested when the budget has place again
+    waiting_pages = None
+    # Search pages requested and not parsed yet (url -> (search, page, last_page, price_range))
+    pages_in_flight = None
+    # Pagination of each search: URL of the first page -> [last page added to waiting_pages, last page of the search]
+    search_pages = None
+    # Maximum number of search pages requested at once
+    search_pages_window = 1
+
+    # Etsy shows only the first pages of a search, so a search with more pages is split in
+    # price ranges, each one with less pages (see partition_search)
+    search_pages_cap = 250
+    # First price ranges of a split search (the last range has no maximum price), empty to disable it
+    search_price_bands = None
+    # Price ranges narrower than this are not split again
+    search_min_price_step = 1
+    # Maximum number of price ranges of each search string
+    search_max_partitions = 0
+    # Number of price ranges of each search string (search -> number)
+    search_partitions = None
+    # Products requested and not scraped yet (product_id -> search)
+    products_in_flight = None
 
     # Get only the products URLs
     URLS_ONLY = False
 
+    # Get the products data from the search pages (cards), without visiting the products pages
+    CARDS = False
+    # In cards mode, the products pages are visited only for the products with at least this
+    # rating and number of reviews (None: not used)
+    DEEP_MIN_RATING = None
+    DEEP_MIN_REVIEWS = None
+
     # Set the method to get the product reviews
     # If set to 1 (default), Spider will get only the reviews in the product's page, the default value is 4 reviews [FAST SCRAPING]
     # If set to 2, Spider will produce a Ajax request to get all reviews in the product's page, that is, a maximum of 10 reviews
     # If set to 3, Spider will visit the page with all store reviews and get all the reviews for this specific product [SLOWER SCRAPING]
     reviews_opt = None
 
-    def __init__(self, search, reviews_option=1, count_max=None, urls_only=False, *args, **kwargs):
-        if search:
-            # Build the search URL
-            self.start_urls = ['https://www.etsy.com/search?q={}&ref=pagination&page=1'.format(search)]
-            # Set the maximum number of items to be scraped
-            if count_max:
-                self.COUNT_MAX = int(count_max)
-
-            # Get only the products URLs
-            self.URLS_ONLY = bool(urls_only)
-            # Set the chosen review option
-            self.reviews_opt = int(reviews_option)
+    # Reviews of each store (option 3)
+    # The store's reviews pages are visited only once and the reviews are saved by product ID in the reviews spool
+    # Each store is a dict: {'done': bool, 'pending': [(product_id, itemLoader)], 'next_page': url}
+    shops = None
+    # Reviews of the stores saved on disk (see etsy/reviews_spool.py)
+    reviews_spool = None
+    # Rules to stop visiting the store's reviews pages (0 disables the rule, see settings.py)
+    reviews_max_age = 0
+    reviews_max_pages = 0
+    reviews_max_per_product = 0
+    reviews_stop_at_known_count = False
+
+    # Incremental mode: skip the products scraped recently and save only the modified products
+    INCREMENTAL = False
+    # Index of the scraped products (only in incremental mode)
+    listing_index = None
+
+    # Search strings, each one is crawled concurrently
+    queries = None
+    # Search strings that found each product (product_id -> set of search strings)
+    listing_queries = None
+
+    # Checkpoint of the crawl state, used to resume the crawl (see etsy/checkpoint.py)
+    checkpoint = None
+    # Resume the crawl from the checkpoint
+    RESUME = False
+
+    # Timings and counters of the crawl (see etsy/metrics.py)
+    metrics = None
+
+    # Distributed mode: name of the crawl shared by all workers (see etsy/distributed.py)
+    DISTRIBUTED = None
+    # Shared queues, dupe filter and item sink (only in the distributed mode)
+    frontier = None
+    # Maximum number of products requested and not scraped yet by this worker
+    distributed_prefetch = None
+
+    # Get the product fields from the JSON-LD block of the product's page (the XPaths are used for the missing fields)
+    LISTING_JSON_LD = True
+
+    # Products waiting for the reviews Ajax request (option 2), one batch for each identity of the
+    # IdentityPoolMiddleware (None without the pool or for the pages read from the cache):
+    # identity -> [(product_id, shop_id, itemLoader)]
+    ajax_batch = None
+    # Time when the first product of each batch arrived (identity -> time)
+    ajax_batch_started = None
+    # Call that sends each batch when its first product waited for ajax_batch_timeout (identity -> DelayedCall)
+    ajax_batch_timers = None
+    # Maximum number of products in each batch and maximum waiting time (in seconds)
+    ajax_batch_size = 1
+    ajax_batch_timeout = 0
+    # Session cookie and x-csrf-token used in the Ajax requests (taken from the first product page)
+    # One session for each identity of the IdentityPoolMiddleware (identity -> session, None without the pool
+    # or for the pages read from the cache)
+    ajax_session = None
+
+    def __init__(self, search=None, reviews_option=1, count_max=None, urls_only=False, incremental=False,
+                 search_file=None, shard=None, shards=None, cards=False, deep_min_rating=None,
+                 deep_min_reviews=None, checkpoint=None, resume=False, distributed=None, *args, **kwargs):
+        # Get the search strings
+        if search_file:
+            # One search string per line
+            with open(search_file, encoding='utf-8') as f:
+                self.queries = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+        else:
+            self.queries = [search] if search else []
+
+        # Use only a part of the search strings (when the list is split between processes)
+        if shards:
+            self.queries = self.queries[int(shard or 0)::int(shards)]
+
+        # Set the maximum number of items to be scraped
+        if count_max:
+            self.COUNT_MAX = int(count_max)
+
+        # Get only the products URLs
+        self.URLS_ONLY = bool(urls_only)
+        # Get the products data from the search pages
+        self.CARDS = str(cards).lower() in ('1', 'true', 'yes')
+        if deep_min_rating is not None:
+            self.DEEP_MIN_RATING = float(deep_min_rating)
+        if deep_min_reviews is not None:
+            self.DEEP_MIN_REVIEWS = int(deep_min_reviews)
+        # Set the chosen review option
+        self.reviews_opt = int(reviews_option)
+        # Enable the incremental mode
+        self.INCREMENTAL = str(incremental).lower() in ('1', 'true', 'yes')
+
+        self.listing_queries = {}
+        self.budget = ItemBudget(self.COUNT_MAX)
+        self.waiting_products = deque()
+        self.waiting_pages = []
+        self.pages_in_flight = {}
+        self.search_pages = {}
+        self.search_partitions = {}
+        self.products_in_flight = {}
+        self.shops = {}
+        self.ajax_batch = {}
+        self.ajax_batch_started = {}
+        self.ajax_batch_timers = {}
+        self.ajax_session = {}
+        self.metrics = Metrics()
+        # Share the work with other processes/nodes (ex: -a distributed=crawl1)
+        self.DISTRIBUTED = distributed
+
+        # Save the crawl state in a file (ex: -a checkpoint=crawl.json) and resume from it (-a resume=true)
+        if checkpoint:
+            self.checkpoint = CrawlCheckpoint(checkpoint)
+            # The crawl is resumed only if the checkpoint of the previous crawl exists
+            self.RESUME = str(resume).lower() in ('1', 'true', 'yes') and self.checkpoint.exists()
+            if self.RESUME:
+                self.restore_checkpoint(self.checkpoint.load())
 
         super(ProductsSpider, self).__init__(*args, **kwargs)
 
-
-    # Parse the first page result and go to the next page
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super(ProductsSpider, cls).from_crawler(crawler, *args, **kwargs)
+
+        # Reviews Ajax requests (option 2)
+        spider.ajax_batch_size = max(1, crawler.settings.getint('REVIEWS_AJAX_BATCH_SIZE'))
+        spider.ajax_batch_timeout = crawler.settings.getfloat('REVIEWS_AJAX_BATCH_TIMEOUT')
+        spider.LISTING_JSON_LD = crawler.settings.getbool('LISTING_JSON_LD')
+        crawler.signals.connect(spider.spider_idle, signal=signals.spider_idle)
+
+        # Search pages requested in parallel
+        spider.search_pages_window = max(1, crawler.settings.getint('SEARCH_PAGES_WINDOW'))
+        spider.search_pages_cap = crawler.settings.getint('SEARCH_PAGES_CAP')
+        spider.search_price_bands = [float(price) for price in crawler.settings.getlist('SEARCH_PRICE_BANDS')
+                                     if str(price).strip()]
+        spider.search_min_price_step = crawler.settings.getfloat('SEARCH_MIN_PRICE_STEP')
+        spider.search_max_partitions = crawler.settings.getint('SEARCH_MAX_PARTITIONS')
+
+        # Connect to the shared queues of the crawl
+        if spider.DISTRIBUTED:
+            spider.frontier = RedisFrontier.from_settings(crawler.settings, spider.DISTRIBUTED)
+            spider.distributed_prefetch = max(1, crawler.settings.getint('DISTRIBUTED_PREFETCH'))
+
+        # The store's reviews are saved on disk while the reviews pages are visited (option 3)
+        # The file is kept with the checkpoint, so a resumed crawl does not visit the pages again
+        if spider.reviews_opt == 3:
+            if spider.checkpoint:
+                spool_path = spider.checkpoint.path + '.reviews'
+            else:
+                fd, spool_path = tempfile.mkstemp(prefix='etsy_reviews_', suffix='.db')
+                os.close(fd)
+            spider.reviews_spool = ReviewsSpool(spool_path, keep=spider.RESUME)
+
+            settings = crawler.settings
+            spider.reviews_max_age = settings.getfloat('REVIEWS_MAX_AGE_DAYS') * 24 * 3600
+            spider.reviews_max_pages = settings.getint('REVIEWS_MAX_PAGES')
+            spider.reviews_max_per_product = settings.getint('REVIEWS_MAX_PER_PRODUCT')
+            spider.reviews_stop_at_known_count = settings.getbool('REVIEWS_STOP_AT_KNOWN_COUNT')
+
+        # Options of the feeds that depend on the spider arguments (the settings can be changed here since Scrapy 2.11)
+        feeds = crawler.settings.getdict('FEEDS')
+        if feeds and not crawler.settings.frozen:
+            crawler.settings.set('FEEDS', spider.crawl_feeds(feeds), priority=crawler.settings.getpriority('FEEDS'))
+
+        # Open the index of the products scraped in the previous runs
+        if spider.INCREMENTAL:
+            settings = crawler.settings
+            spider.listing_index = ListingIndex(data_path(settings['INCREMENTAL_INDEX_FILE']),
+                                                settings.getfloat('INCREMENTAL_FRESHNESS_HOURS') * 3600)
+        return spider
+
+    # Called when the spider is closed
+    def closed(self, reason):
+        for timer in self.ajax_batch_timers.values():
+            if timer.active():
+                timer.cancel()
+        if self.listing_index:
+            self.listing_index.close()
+        if self.reviews_spool:
+            # Keep the reviews if the crawl can be resumed
+            self.reviews_spool.close(remove=self.checkpoint is None or reason == 'finished' or self.budget.done)
+
+    # Create an Excel file for each CSV file in the configured feeds
+    # The Excel rows are written as the items arrive (see etsy/exporters.py)
+    # The reviews are saved in a separate file (see the ReviewsPipeline)
+    @classmethod
+    def update_settings(cls, settings):
+        super(ProductsSpider, cls).update_settings(settings)
+
+        feeds = settings.getdict('FEEDS')
+        # Support the old FEED_URI/FEED_FORMAT settings
+        if not feeds and settings.get('FEED_URI'):
+            feeds = {settings['FEED_URI']: {'format': settings.get('FEED_FORMAT', 'jsonlines')}}
+
+        xlsx_feeds = {}
+        for key, options in feeds.items():
+            uri = str(key)
+            if options.get('format') == 'csv' and uri.endswith('.csv'):
+                xlsx_uri = uri[:-len('.csv')] + '.xlsx'
+                if xlsx_uri not in feeds:
+                    xlsx_feeds[xlsx_uri] = {'format': 'xlsx'}
+
+        if xlsx_feeds:
+            feeds.update(xlsx_feeds)
+            settings.set('FEEDS', feeds, priority=settings.getpriority('FEEDS') or 'spider')
+
+        # Save the reviews in a file next to the first feed (ex: products_reviews.csv)
+        # The feeds sent to the standard output (-o -:csv) have no file next to them
+        first_uri = str(next(iter(feeds))) if feeds else ''
+        if first_uri not in ('', '-') and not first_uri.startswith('stdout:') and not settings.get('REVIEWS_FEED_URI'):
+            stem, ext = os.path.splitext(first_uri)
+            settings.set('REVIEWS_FEED_URI', stem + '_reviews' + (ext if ext in FEED_FORMATS else '.jl'),
+                         priority=settings.getpriority('FEEDS') or 'spider')
+
+
+    # An Excel or Parquet file can't be appended to an existing one (-o products.xlsx), it is replaced on each run.
+    # A resumed crawl adds its items to the files of the first run: the Excel and Parquet exporters write
+    # the rows of the file again (see etsy/exporters.py) and the CSV header is not written again
+    def crawl_feeds(self, feeds):
+        feeds = dict(feeds)
+        for key, options in feeds.items():
+            if options.get('format') in ('xlsx', 'parquet') and 'overwrite' not in options:
+                feeds[key] = dict(options, overwrite=not self.RESUME)
+            elif self.RESUME and options.get('format') == 'csv' and not options.get('overwrite') and local_file_size(str(key)):
+                export_kwargs = dict(options.get('item_export_kwargs') or {}, include_headers_line=False)
+                feeds[key] = dict(options, item_export_kwargs=export_kwargs)
+        return feeds
+
+
+    # Start the search of each search string
+    def start_requests(self):
+        if self.RESUME:
+            for request in self.resume_requests():
+                yield request
+            return
+
+        # Build the search URL
+        search_pages = [(self.search_page_url(search, 1), search, 1, None, None) for search in self.queries]
+
+        # Distributed mode: the first worker adds the search pages to the shared queue
+        if self.frontier is not None:
+            self.frontier.seed(search_pages)
+            for request in self.schedule_products():
+                yield request
+            return
+
+        for search_page in search_pages:
+            yield self.search_request(*search_page)
+
+
+    # URL of a search page
+    # price_range is [minimum price, maximum price] (the maximum can be None)
+    def search_page_url(self, search, page, price_range=None):
+        prices = ''
+        if price_range:
+            prices = '&min={:g}'.format(price_range[0])
+            if price_range[1] is not None:
+                prices += '&max={:g}'.format(price_range[1])
+        return 'https://www.etsy.com/search?q={}{}&ref=pagination&page={}'.format(search, prices, page)
+
+
+    # Request a search page
+    # last_page is the number of the last page of the search (None if it is not known yet)
+    def search_request(self, url, search, page=1, last_page=None, price_range=None):
+        self.pages_in_flight[url] = (search, page, last_page, price_range)
+        return Request(url, meta={'search':search, 'search_url':url, 'page':page, 'last_page':last_page,
+                                  'price_range':price_range},
+                       errback=self.parse_search_error)
+
+
+    def parse_search_error(self, failure):
+        self.logger.error('Error getting the search page: {}'.format(repr(failure)))
+        self.pages_in_flight.pop(failure.request.meta.get('search_url'), None)
+        if self.frontier is not None:
+            self.frontier.page_done(failure.request.meta.get('frontier_lease'))
+            for request in self.schedule_products():
+                yield request
+
+
+    # State of the crawl saved in the checkpoint
+    # The products requested and not scraped yet (their data is in the requests) are
+    # requested again when the crawl is resumed, the same for the search pages
+    def checkpoint_state(self):
+        return {
+            'queries': self.queries,
+            'completed': self.budget.completed,
+            'listing_queries': {product_id: sorted(queries) for product_id, queries in self.listing_queries.items()},
+            'pages': [(url,) + page for url, page in self.pages_in_flight.items()] + list(self.waiting_pages),
+            'search_pages': self.search_pages,
+            'search_partitions': self.search_partitions,
+            'products': list(self.products_in_flight.items()) + list(self.waiting_products),
+            # The next reviews page of each store (the reviews are saved in the reviews spool)
+            'shops': {store_name: {'done': shop['done'], 'next_page': shop.get('next_page'), 'pages': shop.get('pages', 0)}
+                      for store_name, shop in self.shops.items()},
+        }
+
+
+    def restore_checkpoint(self, state):
+        self.queries = state['queries']
+        self.budget.completed = state['completed']
+        self.listing_queries = {product_id: set(queries) for product_id, queries in state['listing_queries'].items()}
+        self.waiting_pages = [tuple(page) for page in state['pages']]
+        self.search_pages = state.get('search_pages', {})
+        self.search_partitions = state.get('search_partitions', {})
+        self.waiting_products = deque(tuple(product) for product in state['products'])
+        self.shops = {store_name: dict(shop, pending=[]) for store_name, shop in state['shops'].items()}
+        self.logger.info('Resuming the crawl: {} products scraped, {} products and {} search pages left'.format(
+            self.budget.completed, len(self.waiting_products), len(self.waiting_pages)))
+
+
+    # First requests of a resumed crawl
+    def resume_requests(self):
+        # Continue the store's reviews pages not finished
+        for store_name, shop in self.shops.items():
+            if not shop['done'] and shop.get('next_page'):
+                yield self.shop_reviews_request(shop['next_page'], store_name)
+
+        # Stops if all products were scraped
+        if self.budget.done:
+            return
+
+        for request in self.schedule_products():
+            yield request
+
+
+    # Parse the search page and add the next pages of the search
+    # Distributed mode: the page is released when it is parsed, also if the parsing fails
     def parse(self, response):
+        try:
+            for result in self.parse_search_page(response):
+                yield result
+        finally:
+            if self.frontier is not None:
+                self.frontier.page_done(response.meta.get('frontier_lease'))
+
+
+    def parse_search_page(self, response):
+        search = response.meta.get('search')
+        page = response.meta.get('page', 1)
+        price_range = response.meta.get('price_range')
+        self.pages_in_flight.pop(response.meta.get('search_url'), None)
 
         # Get the list of products from html response
-        products_list = response.xpath('//div[@data-search-results=""]/div//li//a/@href').extract()
-        products_id_list = [product_href.split("/")[4] for product_href in products_list]
+        with self.metrics.time('selectors/search'):
+            if self.CARDS:
+                cards = {card['product_id']: card for card in extractors.search_cards(response.selector.root)}
+                products_id_list = list(cards)
+            else:
+                products_list = extractors.SEARCH_PRODUCTS_HREFS(response.selector.root)
+                products_id_list = [product_href.split("/")[4] for product_href in products_list]
+
+        # Products already found by another search string (or in another page) are not requested again
+        new_products_id_list = []
+        for product_id in products_id_list:
+            found = product_id in self.listing_queries
+            # Distributed mode: the product may have been found by another worker
+            if self.frontier is not None:
+                found = not self.frontier.add_listing(product_id, search)
+
+            if found:
+                self.crawler.stats.inc_value('search/duplicated_products')
+            else:
+                new_products_id_list.append(product_id)
+            self.listing_queries.setdefault(product_id, set()).add(search)
 
-        # For each product extracts the product URL
-        print(f"#### FOUND {len(products_id_list)} PRODUCTS")
+        # Number of products found (see the CrawlMetrics extension)
+        self.metrics.inc('products_found', len(products_id_list))
+        self.logger.debug('Found {} products in {}'.format(len(products_id_list), response.url))
+
+        # Stops if all products were scraped
+        if self.budget.done:
+            raise scrapy.exceptions.CloseSpider(reason='COUNT_MAX value reached - {} items'.format(self.COUNT_MAX))
 
         if self.URLS_ONLY:
-            for product_id in products_id_list:
+            for product_id in new_products_id_list:
+                # Stops if the maximum number of products was reached
+                if not self.budget.reserve():
+                    break
+                self.budget.complete()
 
                 # Create the ItemLoader object that stores each product information
                 l = ItemLoader(item=ProductItem(), response=response)
 
                 product_url = f'https://www.etsy.com/listing/{product_id}'
                 l.add_value('url', product_url)
+                l.add_value('search_queries', search)
                 yield l.load_item()
 
-        else:
-            for product_id in products_id_list:
-                product_url = f'https://www.etsy.com/listing/{product_id}'
-                # Stops if the COUNTER reaches the maximum set value
-                if self.COUNTER < self.COUNT_MAX:
-                    # Go to the product's page to get the data
-                    yield scrapy.Request(product_url, callback=self.parse_product, dont_filter=True)
+        elif self.CARDS:
+            for product_id in new_products_id_list:
+                card = cards[product_id]
 
-        # Pagination - Go to the next page
-        current_page_number = int(response.url.split('=')[-1])
-        next_page_number = current_page_number + 1
-        # Build the next page URL
-        next_page_url = '='.join(response.url.split('=')[:-1]) + '=' + str(next_page_number)
+                # Visit the product's page only if it matches the thresholds
+                if self.deep_fetch(card):
+                    self.crawler.stats.inc_value('cards/deep_fetch')
+                    self.waiting_products.append((product_id, search))
+                    continue
+
+                # Stops if the maximum number of products was reached
+                if not self.budget.reserve():
+                    break
+                self.crawler.stats.inc_value('cards/scraped')
+                yield self.load_item(self.card_loader(card))
 
+        else:
+            for product_id in new_products_id_list:
+                # Skip the products scraped recently (incremental mode)
+                if self.listing_index and self.listing_index.is_fresh(product_id):
+                    self.crawler.stats.inc_value('incremental/skipped_fresh')
+                    continue
+                self.waiting_products.append((product_id, search))
+
+        # Pagination - The first page has the number of the last page, so the next pages can be
+        # requested in parallel (see next_search_pages)
+        last_page = response.meta.get('last_page')
+        partitions = []
+        if page == 1:
+            last_page = extractors.search_last_page(response.selector.root)
+            partitions = self.partition_search(search, price_range, last_page, len(products_id_list))
+
+        if partitions:
+            # The products of the price ranges are deduplicated by product ID (see above)
+            self.crawler.stats.inc_value('search/partitions', len(partitions))
+            self.logger.debug('Search split in {} price ranges: {}'.format(len(partitions), response.url))
+            self.waiting_pages.extend((self.search_page_url(search, 1, prices), search, 1, None, prices)
+                                      for prices in partitions)
         # If the current list is not empty
-        if len(products_id_list) > 0:
-            yield scrapy.Request(next_page_url)
+        elif len(products_id_list) > 0:
+            self.waiting_pages.extend(self.next_search_pages(search, page, last_page, len(products_id_list), price_range))
+        else:
+            self.stop_search_pages(search, page, price_range)
+
+        # Distributed mode: the products found and the next page go to the shared queues
+        if self.frontier is not None:
+            self.frontier.push_products(list(self.waiting_products))
+            self.frontier.push_pages(self.waiting_pages)
+            self.waiting_products.clear()
+            self.waiting_pages = []
+
+        for request in self.schedule_products():
+            yield request
+
+
+    # Products still needed, the products found and not requested yet are counted too
+    def products_needed(self):
+        return self.budget.max_items - self.budget.committed - len(self.waiting_products)
+
+
+    # Split a search that reached the pages cap in price ranges, returns [] if it is not split
+    # The first split uses the SEARCH_PRICE_BANDS ranges, then a range that reaches the cap again is
+    # split in two halves (the last range, with no maximum price, is split at twice its minimum price)
+    def partition_search(self, search, price_range, last_page, page_size):
+        if not self.search_price_bands or last_page is None or last_page < self.search_pages_cap:
+            return []
+        # The pages of the search are enough to reach count_max
+        if self.products_needed() <= last_page * page_size:
+            return []
+
+        if price_range is None:
+            bands = self.search_price_bands
+            partitions = [[low, high] for low, high in zip(bands, bands[1:] + [None])]
+        else:
+            low, high = price_range
+            if high is None:
+                middle = max(low * 2, low + self.search_min_price_step)
+            else:
+                middle = round((low + high) / 2.0, 2)
+            partitions = [[low, middle], [middle, high]]
+
+            # The range is too narrow (or the search has too many ranges), only its first pages are scraped
+            too_narrow = high is not None and high - low < self.search_min_price_step * 2
+            too_many = self.search_max_partitions and self.search_partitions.get(search, 0) >= self.search_max_partitions
+            if too_narrow or too_many:
+                self.crawler.stats.inc_value('search/partitions_capped')
+                return []
+
+        self.search_partitions[search] = self.search_partitions.get(search, 0) + len(partitions)
+        return partitions
+
+
+    # Next search pages of a search string (or of a price range of the search)
+    # If the number of the last page is known, the next pages are added up front (they are requested
+    # in parallel, see SEARCH_PAGES_WINDOW), but only the pages needed to reach count_max.
+    # Otherwise (no pagination links), the pages are added one by one
+    def next_search_pages(self, search, page, last_page, page_size, price_range=None):
+        if last_page is None:
+            return [(self.search_page_url(search, page + 1, price_range), search, page + 1, None, price_range)]
+
+        # Distributed mode: all pages are added to the shared queue when the first page is parsed
+        if self.frontier is not None:
+            if page > 1:
+                return []
+            last_added = page
+            pages_needed = last_page
+        else:
+            last_added, last_page = self.search_pages.get(self.search_page_url(search, 1, price_range), [page, last_page])
+            pages_needed = max(1, -(-self.products_needed() // page_size))
+
+        end = min(last_page, page + pages_needed)
+        self.search_pages[self.search_page_url(search, 1, price_range)] = [max(last_added, end), last_page]
+        return [(self.search_page_url(search, n, price_range), search, n, last_page, price_range)
+                for n in range(last_added + 1, end + 1)]
+
+
+    # An empty search page is the end of the search, the next pages are not requested
+    def stop_search_pages(self, search, page, price_range=None):
+        key = self.search_page_url(search, 1, price_range)
+        if key in self.search_pages:
+            self.search_pages[key][1] = min(self.search_pages[key][1], page - 1)
+        next_pages = [p for p in self.waiting_pages if p[1] == search and p[4] == price_range and p[2] > page]
+        if next_pages:
+            self.crawler.stats.inc_value('search/pages_skipped', len(next_pages))
+            self.waiting_pages = [p for p in self.waiting_pages if p not in next_pages]
+
+
+    # Create the ItemLoader of a product using the data of its card in the search page
+    # The loader has no response, the values are added directly (a response would be parsed again for each card)
+    def card_loader(self, card):
+        l = ItemLoader(item=ProductItem())
+        for field, value in card.items():
+            if value:
+                l.add_value(field, value)
+        return l
+
+
+    # Check if the product's page must be visited (cards mode)
+    # All the thresholds set must be reached
+    def deep_fetch(self, card):
+        if self.DEEP_MIN_RATING is None and self.DEEP_MIN_REVIEWS is None:
+            return False
+
+        if self.DEEP_MIN_RATING is not None:
+            rating = parse_rating(card['rating'])
+            if rating is None or rating < self.DEEP_MIN_RATING:
+                return False
+
+        if self.DEEP_MIN_REVIEWS is not None:
+            number_of_reviews = parse_count(card['number_of_reviews'])
+            if number_of_reviews is None or number_of_reviews < self.DEEP_MIN_REVIEWS:
+                return False
+
+        return True
+
+
+    # Request the products waiting while the budget has place
+    # The next search pages are requested only after all the products found were requested
+    def schedule_products(self):
+        if self.frontier is not None:
+            for request in self.schedule_shared_products():
+                yield request
+            return
+
+        while self.waiting_products and self.budget.reserve():
+            product_id, search = self.waiting_products.popleft()
+            yield self.product_request(product_id, search)
+
+        if not self.budget.exhausted and not self.waiting_products:
+            while self.waiting_pages and len(self.pages_in_flight) < self.search_pages_window:
+                yield self.search_request(*self.waiting_pages.pop(0))
+
+
+    # Distributed mode: get the products and the search pages from the shared queues
+    # Each worker gets only a few products at once, so the work is split between all workers
+    # A search page is requested only when there are no products in the queue
+    def schedule_shared_products(self):
+        while len(self.products_in_flight) < self.distributed_prefetch and self.budget.reserve():
+            product = self.frontier.pop_product()
+            if product is None:
+                self.budget.release()
+                if not self.pages_in_flight and not self.budget.exhausted:
+                    page = self.frontier.pop_page()
+                    if page is not None:
+                        lease, page = page
+                        request = self.search_request(*page)
+                        request.meta['frontier_lease'] = lease
+                        # A page leased again (after the lease expired) must not be dropped by the dupe filter
+                        yield request.replace(dont_filter=True)
+                break
+            yield self.product_request(*product)
+
+
+    # Go to the product's page to get the data
+    def product_request(self, product_id, search):
+        self.products_in_flight[product_id] = search
+        product_url = f'https://www.etsy.com/listing/{product_id}'
+        return scrapy.Request(product_url, callback=self.parse_product, errback=self.parse_product_error,
+                              dont_filter=True)
+
+
+    # The product was not scraped, so another product can be requested
+    def release_product(self, product_id):
+        self.products_in_flight.pop(product_id, None)
+        self.budget.release()
+        return self.schedule_products()
+
+
+    def parse_product_error(self, failure):
+        # The unavailable products are dropped by the ResponseClassifierMiddleware
+        if failure.request.meta.get('response_class') == classifier.UNAVAILABLE:
+            self.logger.debug('Product not available: {}'.format(failure.request.url))
+        else:
+            self.logger.error('Error getting the product page: {}'.format(repr(failure)))
+        for request in self.release_product(failure.request.url.split('/')[4]):
+            yield request
 
 
     # Get the HTML from product's page and get the data
+    # If the parsing fails, the place of the product is released (Scrapy logs the error)
     def parse_product(self, response):
+        product_id = response.url.split('/')[4]
+        try:
+            for result in self.parse_product_page(response):
+                yield result
+        except Exception:
+            if not self.product_pending(product_id):
+                self.crawler.stats.inc_value('products/parse_errors')
+                for request in self.release_product(product_id):
+                    yield request
+            raise
+
+
+    # The product is waiting for its reviews or was already scraped, its place is used
+    def product_pending(self, product_id):
+        return (product_id not in self.products_in_flight or
+                any(p == product_id for batch in self.ajax_batch.values() for p, _, _ in batch) or
+                any(p == product_id for shop in self.shops.values() for p, _ in shop['pending']))
 
-        # Stops if the COUNTER reaches the maximum set value
-        if self.COUNTER >= self.COUNT_MAX:
-            raise scrapy.exceptions.CloseSpider(reason='COUNT_MAX value reached - {} items'.format(self.COUNT_MAX))
+
+    def parse_product_page(self, response):
 
         # Check if the product is available
-        no_available_message = response.xpath('//h2[contains(text(), "Darn")]')
-        if no_available_message:
-            return []
+        # The pages are classified by the ResponseClassifierMiddleware, the page is checked here only if it is disabled
+        if 'response_class' not in response.meta and classifier.classify_response(response) == classifier.UNAVAILABLE:
+            for request in self.release_product(response.url.split('/')[4]):
+                yield request
+            return
+
+        # Time of the selectors and of the ItemLoader input processors
+        started = self.metrics.start()
 
         # Create the ItemLoader object that stores each product information
         l = ItemLoader(item=ProductItem(), response=response)
 
+        # Get the fields of the JSON-LD block of the page, the XPaths are used only for the fields not found
+        data = extractors.listing_json_ld(response.selector.root) if self.LISTING_JSON_LD else {}
+
         # Get the product ID (ex: 666125766)
         product_id = response.url.split('/')[4]
         l.add_value('product_id', product_id)
 
         # Get the produc Title
         #l.add_xpath('title', '//meta[@property="og:title"]/@content')
-        l.add_xpath('title', '//div[@data-component="listing-page-title-component"]/h1/text()')
+        self.add_listing_field(l, data, 'title', '//div[@data-component="listing-page-title-component"]/h1/text()')
         #l.add_xpath('title', "//h1[@data-listing-id='{}']".format(response.url.split('/')[4]))
 
-        # Get the product price
-        l.add_xpath('price', '//*[contains(@data-buy-box-region, "price")]//p')
+        # Get the product price (the currency is taken from the price if it is not in the JSON-LD block)
+        self.add_listing_field(l, data, 'price', '//*[contains(@data-buy-box-region, "price")]//p')
+        if 'currency' in data:
+            l.add_value('currency', data['currency'])
 
         # Get the product URL (ex: www.etsy.com/listing/666125766)
         l.add_value('url', '/'.join(response.url.split('/')[2:5]))
@@ -150,15 +767,14 @@ class ProductsSpider(scrapy.Spider):
         l.add_value('product_options', '|'.join(product_options))
 
         # Get the product rating (ex: 4.8 )
-        l.add_xpath('rating', '//a[@href="#reviews"]//input[@name="rating"]/@value')
+        self.add_listing_field(l, data, 'rating', '//a[@href="#reviews"]//input[@name="rating"]/@value')
 
         # Get the number of votes (number of reviews)
-        l.add_xpath('number_of_reviews', '//button[@id="same-listing-reviews-tab"]/span/text()')
+        self.add_listing_field(l, data, 'number_of_reviews', '//button[@id="same-listing-reviews-tab"]/span/text()')
 
         # Count the number of product images
-        images_sel = response.xpath('//ul[@data-carousel-pagination-list=""]/li/img/@data-src-delay').extract()
-        l.add_value('count_of_images', len(images_sel))
-        l.add_value('images_urls', images_sel)
+        self.add_listing_field(l, data, 'images_urls', '//ul[@data-carousel-pagination-list=""]/li/img/@data-src-delay')
+        l.add_value('count_of_images', len(l.get_collected_values('images_urls')))
 
         # Get the product overview
         #l.add_xpath('overview', '//*[@class="listing-page-overview-component"]//li')
@@ -169,10 +785,12 @@ class ProductsSpider(scrapy.Spider):
         l.add_xpath('favorited_by', '//a[contains(text(), " favorites")]/text()', re='(\d+)')
 
         # Get the name of the Store and location
-        l.add_xpath('store_name', '//div[@id="listing-page-cart"]//span/text()')
+        self.add_listing_field(l, data, 'store_name', '//div[@id="listing-page-cart"]//span/text()')
         #l.add_xpath('store_location', '//*[@id="shop-info"]/div')
         #l.add_xpath('return_location', "//*[@class='js-estimated-delivery']/following-sibling::div")
 
+        self.metrics.stop('selectors/listing', started)
+
         # Use the chosen method to get the reviews
         self.logger.info('Reviews scraping option: ' + str(self.reviews_opt))
 
@@ -180,103 +798,184 @@ class ProductsSpider(scrapy.Spider):
         if self.reviews_opt == 3:
             # Getting all Reviews
             store_name = response.xpath('//span[@itemprop="title"]//text()').extract_first()
-            # Build the reviews URL
-            rev_url = "https://www.etsy.com/shop/{}/reviews?ref=l2-see-more-feedback".format(store_name)
-            data = {'itemLoader':l, 'product_id':product_id}
 
-            # Go to the all reviews page
-            yield Request(rev_url, meta=data, callback=self.parse_reviews)
+            # Check if the store's reviews pages were already visited (or are being visited)
+            shop = self.shops.get(store_name)
+            if shop is None:
+                shop = self.shops[store_name] = {'done': False, 'pending': []}
+                # Build the reviews URL
+                rev_url = "https://www.etsy.com/shop/{}/reviews?ref=l2-see-more-feedback".format(store_name)
+
+                # Go to the all reviews page
+                yield self.shop_reviews_request(rev_url, store_name)
+
+            # Wait until all the store's reviews are scraped
+            shop['pending'].append((product_id, l))
+            if shop['done']:
+                for item in self.load_shop_reviews(store_name):
+                    yield item
 
         # Option 2 - Ajax request
         elif self.reviews_opt == 2:
-            # Creating the Ajax request
-            # Getting the session cookie
-            get_cookie = response.request.headers['Cookie'].split(b';')[0].split(b'=')
-            cookies = {get_cookie[0].decode("utf-8"):get_cookie[1].decode("utf-8")}
-
-            # Getting the x-csrf-token
-            headers = {'x-csrf-token': response.xpath("//*[@name='_nnc']/@value").extract_first()}
+            # The reviews of several products are requested in the same Ajax call
+            # Getting the session cookie and the x-csrf-token (only once per crawl)
+            # With the IdentityPoolMiddleware, each identity (cookie jar) has its own session
+            identity = response.meta.get('identity')
+            if identity not in self.ajax_session:
+                self.ajax_session[identity] = self.get_ajax_session(response)
 
             # Shop Id
             shop_id = response.xpath("//*[@property='og:image']/@content").extract_first().split('/')[3]
 
-            formdata = {
-            'stats_sample_rate': '',
-            'specs[reviews][]': 'Listzilla_ApiSpecs_Reviews',
-            'specs[reviews][1][listing_id]': product_id,
-            'specs[reviews][1][shop_id]': shop_id,
-            'specs[reviews][1][render_complete]': 'true'
-            }
+            # The products of each identity are sent in their own batch, with the session of the identity
+            if identity not in self.ajax_batch:
+                self.ajax_batch[identity] = []
+                self.ajax_batch_started[identity] = time.time()
+                # Send the batch after the timeout even if no other product page arrives
+                if self.ajax_batch_timeout > 0:
+                    self.ajax_batch_timers[identity] = reactor.callLater(self.ajax_batch_timeout,
+                                                                        self.ajax_batch_expired, identity)
+            self.ajax_batch[identity].append((product_id, shop_id, l))
+
+            # Send the batch when it is full or when the first product is waiting for too long
+            if (len(self.ajax_batch[identity]) >= self.ajax_batch_size or
+                    time.time() - self.ajax_batch_started[identity] >= self.ajax_batch_timeout):
+                yield self.ajax_request(identity)
+        # Option 1
+        else:
+            # Get the data from each review
+            l.add_value('reviews', self.listing_reviews(product_id, response.selector.root))
+
+            yield self.load_item(l)
 
-            data = {'itemLoader':l, 'product_id':product_id}
-            ajax_url = "https://www.etsy.com/api/v3/ajax/bespoke/member/neu/specs/reviews"
 
-            yield scrapy.FormRequest(ajax_url, headers=headers, cookies=cookies,
-                                    meta=data, formdata=formdata,
-                                    callback=self.parse_ajax_response)
-        # Option 1
+    # Add a field of the product from the JSON-LD block, or from the XPath if the field is not in the block
+    # The source of each field is counted in the stats (listing_fields/<field>/json_ld, xpath or missing)
+    def add_listing_field(self, l, data, field, xpath):
+        if field in data:
+            l.add_value(field, data[field])
+            source = 'json_ld'
         else:
-            # Dict that saves all the reviews data
-            reviews_data = []
-            reviews_counter = 1
+            l.add_xpath(field, xpath)
+            source = 'xpath' if l.get_collected_values(field) else 'missing'
+        self.crawler.stats.inc_value('listing_fields/{}/{}'.format(field, source))
 
-            # Get the data from each review
-            all_reviews = response.xpath('//*[@class="listing-page__review col-group pl-xs-0 pr-xs-0"]')
-            # Process each review
-            for r in all_reviews:
-
-                # Get the profile URL of the reviewer
-                reviewer_profile = r.xpath(".//*[@class='display-block']/parent::*//@href").extract_first()
-                if reviewer_profile:
-                    # Build the full profile url
-                    reviewer_profile = 'www.etsy.com' + reviewer_profile
-                else:
-                    # If the profile is inactive there is no profile url
-                    continue
 
-                review_date = r.xpath(".//*[@class='text-link-underline display-inline-block mr-xs-1']/parent::*//text()").extract()[2].strip()
-                reviewer_rating = r.xpath('.//input[@name="rating"]/@value').extract_first()
-                review_content = " ".join(r.xpath('.//div[@class="overflow-hidden"]//text()').extract()).strip()
+    # Get the session cookie and the x-csrf-token used in the Ajax requests
+    def get_ajax_session(self, response):
+        cookies = {}
+        cookie_header = response.request.headers.get('Cookie')
+        if cookie_header:
+            get_cookie = cookie_header.split(b';')[0].split(b'=')
+            cookies = {get_cookie[0].decode("utf-8"):get_cookie[1].decode("utf-8")}
 
-                # Build the review string
-                rev_data = "Review number: {} \nProfile: {} \nRating: {} \nDate: {} \nContent: {}".format(reviews_counter, reviewer_profile, reviewer_rating, review_date, review_content)
+        headers = {'x-csrf-token': response.xpath("//*[@name='_nnc']/@value").extract_first()}
+        return {'cookies': cookies, 'headers': headers}
 
-                # Save into the list
-                reviews_data.append(rev_data)
-                reviews_counter += 1
 
-            # Saves all reviews data
-            l.add_value('reviews', "\n\n".join(reviews_data))
+    # Create one Ajax request with the reviews specs of all products in the batch of the identity
+    # Each product has its own spec (ex: specs[reviews_666125766][...]) and its reviews
+    # are returned in the same key of the JSON output
+    def ajax_request(self, identity=None):
+        batch = self.ajax_batch.pop(identity)
+        self.ajax_batch_started.pop(identity, None)
+        timer = self.ajax_batch_timers.pop(identity, None)
+        if timer is not None and timer.active():
+            timer.cancel()
 
-            # Increment the items counter
-            self.COUNTER += 1
-            print('\nProducts scraped: {}\n'.format(self.COUNTER))
+        formdata = {'stats_sample_rate': ''}
+        products = []
+        for product_id, shop_id, l in batch:
+            spec = 'reviews_{}'.format(product_id)
+            formdata['specs[{}][]'.format(spec)] = 'Listzilla_ApiSpecs_Reviews'
+            formdata['specs[{}][1][listing_id]'.format(spec)] = product_id
+            formdata['specs[{}][1][shop_id]'.format(spec)] = shop_id
+            formdata['specs[{}][1][render_complete]'.format(spec)] = 'true'
+            products.append((product_id, spec, l))
 
-            yield l.load_item()
+        self.crawler.stats.inc_value('reviews_ajax/requests')
+        self.crawler.stats.inc_value('reviews_ajax/products', len(products))
 
+        # The request uses the session (and the identity) of the products' pages
+        session = self.ajax_session[identity]
+        meta = {'products': products}
+        if identity is not None:
+            meta['identity'] = identity
 
-    # Parse the Ajax response (Json) and extract reviews data
-    def parse_ajax_response(self, response):
-        # Get the itemLoader object from parser_products
-        l = response.meta['itemLoader']
+        ajax_url = "https://www.etsy.com/api/v3/ajax/bespoke/member/neu/specs/reviews"
+        return scrapy.FormRequest(ajax_url, headers=session['headers'],
+                                  cookies=session['cookies'],
+                                  meta=meta, formdata=formdata,
+                                  callback=self.parse_ajax_response,
+                                  errback=self.parse_ajax_error, dont_filter=True)
 
-        # Dict that saves all the reviews data
-        reviews_data = []
-        reviews_counter = 1
 
+    # Ajax requests of all the products waiting in the batches
+    def flush_ajax_batches(self):
+        return [self.ajax_request(identity) for identity in list(self.ajax_batch)]
+
+
+    # The first product of the batch waited for ajax_batch_timeout, send the batch
+    def ajax_batch_expired(self, identity):
+        self.ajax_batch_timers.pop(identity, None)
+        if identity in self.ajax_batch:
+            self.crawler.stats.inc_value('reviews_ajax/timeouts')
+            self.crawl_request(self.ajax_request(identity))
+
+
+    # Send a request that is not returned by a callback
+    def crawl_request(self, request):
+        try:
+            self.crawler.engine.crawl(request)
+        except TypeError:
+            # Scrapy < 2.6 also needs the spider
+            self.crawler.engine.crawl(request, self)
+
+
+    # Send the products waiting in the batches before the spider is closed
+    # Distributed mode: get more work from the shared queues, and wait while other workers are parsing search pages
+    def spider_idle(self, spider):
+        requests = self.flush_ajax_batches()
+        if self.frontier is not None:
+            requests.extend(self.schedule_products())
+
+        for request in requests:
+            self.crawl_request(request)
+
+        if requests or (self.frontier is not None and not self.frontier.finished() and not self.budget.done):
+            raise DontCloseSpider
+
+
+    # Parse the Ajax response (Json) and extract reviews data
+    def parse_ajax_response(self, response):
         # Loads the Json data
         j = json.loads(response.text)
-        html = j["output"]["reviews"]
-        # Create the Selector
-        sel = scrapy.Selector(text=html)
+        output = j.get("output") or {}
+
+        # Get the itemLoader object of each product in the batch
+        for product_id, spec, l in response.meta['products']:
+            html = output.get(spec)
+            if html:
+                # Create the Selector
+                sel = scrapy.Selector(text=html)
+                # Get the data from each review
+                l.add_value('reviews', self.listing_reviews(product_id, sel.root))
+            else:
+                self.crawler.stats.inc_value('reviews_ajax/missing_output')
+
+            yield self.load_item(l)
 
-        # Get the data from each review
-        all_reviews = sel.xpath('//*[@class="listing-page__review col-group pl-xs-0 pr-xs-0"]')
-        # Process each review
-        for r in all_reviews:
+
+    # Get the reviews in the product's page (or in the Ajax response)
+    def listing_reviews(self, product_id, root):
+        reviews = []
+        with self.metrics.time('selectors/listing_reviews'):
+            extracted_reviews = extractors.listing_reviews.extract(root)
+
+        for r in extracted_reviews:
 
             # Get the profile URL of the reviewer
-            reviewer_profile = r.xpath(".//*[@class='display-block']/parent::*//@href").extract_first()
+            reviewer_profile = r['profile']
             if reviewer_profile:
                 # Build the full profile url
                 reviewer_profile = 'www.etsy.com' + reviewer_profile
@@ -284,113 +983,172 @@ class ProductsSpider(scrapy.Spider):
                 # If the profile is inactive there is no profile url
                 continue
 
-            review_date = r.xpath(".//*[@class='text-link-underline display-inline-block mr-xs-1']/parent::*//text()").extract()[2].strip()
-            reviewer_rating = r.xpath('.//input[@name="rating"]/@value').extract_first()
-            review_content = " ".join(r.xpath('.//div[@class="overflow-hidden"]//text()').extract()).strip()
+            reviews.append(ReviewItem(product_id=product_id, review_number=len(reviews) + 1,
+                                      profile=reviewer_profile, rating=r['rating'],
+                                      date=r['date'].strip(), content=r['content']))
+        return reviews
 
-            # Build the string
-            rev_data = "Review number: {} \nProfile: {} \nRating: {} \nDate: {} \nContent: {}".format(reviews_counter, reviewer_profile, reviewer_rating, review_date, review_content)
 
-            # Saves the string in a list
-            reviews_data.append(rev_data)
-            reviews_counter += 1
+    # If the Ajax request fails, saves the product without the reviews
+    def parse_ajax_error(self, failure):
+        self.logger.error('Error getting the product reviews: {}'.format(repr(failure)))
+        for product_id, spec, l in failure.request.meta['products']:
+            yield self.load_item(l)
 
-        # aves all reviews data
-        l.add_value('reviews', "\n\n".join(reviews_data))
 
-        # Increment the items counter
-        self.COUNTER += 1
-        print('\nProducts scraped: {}\n'.format(self.COUNTER))
+    # Parse the Store reviews page
+    def parse_reviews(self, response):
+        store_name = response.meta['store_name']
+        shop = self.shops[store_name]
+        shop['pages'] = shop.get('pages', 0) + 1
 
-        yield l.load_item()
+        # Get the data from each review and save it by product ID
+        reviews = []
+        too_old = False
+        root = response.selector.root
+        with self.metrics.time('selectors/shop_reviews'):
+            extracted_reviews = extractors.shop_reviews.extract(root)
 
+        for r in extracted_reviews:
 
-    # Parse the Store reviews page
-    def parse_reviews(self, response):
-        # Get the itemLoader object from parser_products
-        l = response.meta['itemLoader']
-
-        # Dict that saves all the reviews data
-        # Check if this is the first access or if there is data from another reviews page
-        if 'reviews_data' in response.meta.keys():
-            reviews_data = response.meta['reviews_data']
-            reviews_counter = response.meta['reviews_counter']
-        else:
-            reviews_data = []
-            reviews_counter = 1
-
-        # Get the data from each review
-        all_reviews = response.xpath("//*[@data-region='review']")
-
-        # Process each review
-        for r in all_reviews:
-
-            # Get the product id of the review
-            product_id = response.xpath("//*[@data-region='listing']//@href").extract_first().split('/')[4]
-
-            # Check if this is the product in analysis
-            if response.meta['product_id'] == product_id:
-                # Get the profile URL of the reviewer
-                reviewer_profile = r.xpath(".//*[@class='shop2-review-attribution']//@href").extract_first()
-                if reviewer_profile:
-                    # Shorter version of the profile url
-                    reviewer_profile = reviewer_profile.split('?')[0]
-                else:
-                    # If the profile is inactive there is no profile url
-                    continue
+            # Get the profile URL of the reviewer
+            reviewer_profile = r['profile']
+            if reviewer_profile:
+                # Shorter version of the profile url
+                reviewer_profile = reviewer_profile.split('?')[0]
+            else:
+                # If the profile is inactive there is no profile url
+                continue
 
-                reviewer_rating = r.xpath('.//input[@name="rating"]/@value').extract_first()
-                review_date = r.xpath(".//*[@class='shop2-review-attribution']//text()").extract()[2].replace('on ','').strip()
-                review_content = " ".join(r.xpath('.//div[@class="text-gray-lighter"]//text()').extract()).strip()
+            review_date = r['date'].replace('on ','').strip()
 
-                # Build the string
-                rev_data = "Review number: {} \nProfile: {} \nRating: {} \nDate: {} \nContent: {}".format(reviews_counter, reviewer_profile, reviewer_rating, review_date, review_content)
+            # The reviews are sorted by date (newest first), the older reviews are not saved
+            if self.reviews_max_age and self.review_age(review_date) > self.reviews_max_age:
+                too_old = True
+                continue
+
+            reviews.append((r['listing_id'], reviewer_profile, r['rating'], review_date, r['content']))
 
-                # Saves the string in a list
-                reviews_data.append(rev_data)
-                reviews_counter += 1
+        # Only the next page is kept in memory
+        self.reviews_spool.add(store_name, response.meta.get('reviews_page', response.url), reviews)
 
         # Go to the next reviews page
-        next_page_url = response.xpath("//*[contains(text(),'Next page')]/parent::*/@href").extract_first()
-        # Check if there is a next page
-        if next_page_url:
-            # Save the current data
-            data = {'itemLoader':l, 'product_id':product_id, 'reviews_data':reviews_data, 'reviews_counter':reviews_counter}
+        next_page_url = next(iter(extractors.SHOP_REVIEWS_NEXT_PAGE(root)), None)
+        # Check if there is a next page and if it can have useful reviews
+        if next_page_url and not self.stop_reviews_walk(store_name, too_old):
             # Build the request
-            yield Request(next_page_url, meta=data, callback=self.parse_reviews)
+            yield self.shop_reviews_request(next_page_url, store_name)
 
         else:
-            # If there is no next page, saves the data
-             # Saves the data
-            l.add_value('reviews', "\n\n".join(reviews_data))
-            # Increment the items counter
-            self.COUNTER += 1
-            print('\nProducts scraped: {}\n'.format(self.COUNTER))
-
-            yield l.load_item()
-
-
-    # Create the Excel file
-    def close(self, reason):
-
-        # Check if there is a CSV file in arguments
-        csv_found = False
-        for arg in sys.argv:
-            if '.csv' in arg:
-                csv_found = True
-
-        if csv_found:
-            self.logger.info('Creating Excel file')
-            #  Get the last csv file created
-            csv_file = max(glob.iglob('*.csv'), key=os.path.getctime)
-
-            wb = Workbook()
-            ws = wb.active
-
-            with open(csv_file, 'r', encoding='utf-8') as f:
-                for row in csv.reader(f):
-                    # Check if the row is not empty
-                    if row:
-                        ws.append(row)
-            # Saves the file
-            wb.save(csv_file.replace('.csv', '') + '.xlsx')
+            # If there is no next page, saves the data of all products waiting for the store's reviews
+            shop['done'] = True
+            shop['next_page'] = None
+            for item in self.load_shop_reviews(store_name):
+                yield item
+
+
+    # Check the rules to stop visiting the store's reviews pages (see settings.py)
+    # Only the products already waiting for the store's reviews are checked: a product of the
+    # store found after the pages were visited gets the reviews found until the stop
+    def stop_reviews_walk(self, store_name, too_old):
+        shop = self.shops[store_name]
+        reason = None
+
+        if too_old:
+            reason = 'max_age'
+        elif self.reviews_max_pages and shop['pages'] >= self.reviews_max_pages:
+            reason = 'max_pages'
+        elif shop['pending'] and (self.reviews_max_per_product or self.reviews_stop_at_known_count):
+            # All the products waiting have all the reviews they need
+            if all(self.reviews_complete(store_name, product_id, l) for product_id, l in shop['pending']):
+                reason = 'products_complete'
+
+        if reason:
+            self.crawler.stats.inc_value('reviews_walk/stopped/{}'.format(reason))
+        return reason is not None
+
+
+    # Check if the reviews found for the product reached the maximum or the number of reviews of the product
+    def reviews_complete(self, store_name, product_id, l):
+        needed = []
+        if self.reviews_max_per_product:
+            needed.append(self.reviews_max_per_product)
+        if self.reviews_stop_at_known_count:
+            number_of_reviews = parse_count(l.get_output_value('number_of_reviews'))
+            if number_of_reviews is not None:
+                needed.append(number_of_reviews)
+
+        return bool(needed) and self.reviews_spool.count(store_name, product_id) >= min(needed)
+
+
+    # Age of a review in seconds (ex: "Dec 28, 2019"), 0 if the date is not valid
+    def review_age(self, review_date):
+        try:
+            return time.time() - time.mktime(time.strptime(review_date, '%b %d, %Y'))
+        except ValueError:
+            return 0
+
+
+    # If a store's reviews page fails, saves the products with the reviews scraped until now
+    def parse_reviews_error(self, failure):
+        self.logger.error('Error getting the store reviews: {}'.format(repr(failure)))
+
+        store_name = failure.request.meta['store_name']
+        shop = self.shops[store_name]
+        shop['done'] = True
+        shop['next_page'] = None
+        for item in self.load_shop_reviews(store_name):
+            yield item
+
+
+    # Request a store's reviews page, the page is saved in the checkpoint until it is parsed
+    def shop_reviews_request(self, url, store_name):
+        self.shops[store_name]['next_page'] = url
+        return Request(url, meta={'store_name':store_name, 'reviews_page': url}, callback=self.parse_reviews,
+                       errback=self.parse_reviews_error)
+
+
+    # Add the store's reviews of each product waiting for them
+    def load_shop_reviews(self, store_name):
+        shop = self.shops[store_name]
+        while shop['pending']:
+            product_id, l = shop['pending'].pop()
+
+            # Saves the data
+            reviews = self.reviews_spool.get(store_name, product_id, limit=self.reviews_max_per_product or None)
+            l.add_value('reviews', [ReviewItem(product_id=product_id, review_number=reviews_counter,
+                                               profile=profile, rating=rating, date=date, content=content)
+                                    for reviews_counter, (profile, rating, date, content) in enumerate(reviews, 1)])
+
+            yield self.load_item(l)
+
+
+    # Build the product item when all its data was scraped
+    def load_item(self, l):
+        # Save the search strings that found the product
+        product_id = l.get_output_value('product_id')
+        if self.frontier is not None:
+            l.add_value('search_queries', sorted(self.frontier.listing_queries(product_id)))
+        else:
+            l.add_value('search_queries', sorted(self.listing_queries.get(product_id, [])))
+        self.products_in_flight.pop(product_id, None)
+
+        # Increment the items counter
+        self.budget.complete()
+        self.metrics.inc('products_scraped')
+
+        # Time of the ItemLoader output processors
+        with self.metrics.time('itemloader/load_item'):
+            return l.load_item()
+
+
+    # Size of the spider queues (see the CrawlMetrics extension)
+    def queue_depths(self):
+        return {
+            'waiting_products': len(self.waiting_products),
+            'waiting_pages': len(self.waiting_pages),
+            'products_in_flight': len(self.products_in_flight),
+            'pages_in_flight': len(self.pages_in_flight),
+            'ajax_batch': sum(len(batch) for batch in self.ajax_batch.values()),
+            'shops_pending': sum(len(shop['pending']) for shop in self.shops.values()),
+        }
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+# Unit tests of the functions that convert the scraped strings
+# Run with: python -m unittest discover tests (or python -m pytest tests)
+
+import unittest
+from decimal import Decimal
+from etsy.normalization import parse_price, parse_rating, parse_count
+
+
+class ParsePriceTest(unittest.TestCase):
+
+    def check(self, text, amount, currency):
+        self.assertEqual(parse_price(text), (Decimal(amount), currency), text)
+
+    def test_dot_decimal_separator(self):
+        self.check('$24.99+', '24.99', 'USD')
+        self.check('CA$ 10.00', '10.00', 'CAD')
+        self.check('BRL 1,236.62', '1236.62', 'BRL')
+        self.check('£1,234,567.89', '1234567.89', 'GBP')
+        self.check('1,236', '1236', None)
+        self.check('$5.', '5', 'USD')
+
+    def test_comma_decimal_separator(self):
+        self.check('€24,99', '24.99', 'EUR')
+        self.check('1.236,62 €', '1236.62', 'EUR')
+
+    def test_dot_thousands_separator_without_decimals(self):
+        self.check('1.236 €', '1236', 'EUR')
+        self.check('1.236.000 €', '1236000', 'EUR')
+
+    def test_space_thousands_separator(self):
+        self.check('1 236,50 €', '1236.50', 'EUR')
+        self.check('1 236,50 €', '1236.50', 'EUR')
+        self.check('1 236,50 €', '1236.50', 'EUR')
+        self.check('kr 1 234', '1234', 'SEK')
+        self.check('1 236.50 CHF', '1236.50', 'CHF')
+
+    def test_numbers(self):
+        self.assertEqual(parse_price(24), (Decimal('24'), None))
+        self.assertEqual(parse_price(Decimal('24.99')), (Decimal('24.99'), None))
+
+    def test_no_price(self):
+        self.assertEqual(parse_price(None), (None, None))
+        self.assertEqual(parse_price(''), (None, None))
+        self.assertEqual(parse_price('Sold out'), (None, None))
+
+
+class ParseRatingTest(unittest.TestCase):
+
+    def test_rating(self):
+        self.assertEqual(parse_rating('4.8333'), 4.83)
+        self.assertEqual(parse_rating(5), 5)
+        self.assertEqual(parse_rating('0'), 0)
+
+    def test_rating_in_wrong_format(self):
+        self.assertEqual(parse_rating('48.333'), 4.83)
+        self.assertEqual(parse_rating('483.33'), 4.83)
+
+    def test_no_rating(self):
+        self.assertIsNone(parse_rating(None))
+        self.assertIsNone(parse_rating(''))
+        self.assertIsNone(parse_rating('no reviews'))
+
+
+class ParseCountTest(unittest.TestCase):
+
+    def test_count(self):
+        self.assertEqual(parse_count('(1,234)'), 1234)
+        self.assertEqual(parse_count('1350 favorites'), 1350)
+        self.assertEqual(parse_count('12 reviews, 3 photos'), 12)
+        self.assertEqual(parse_count(42), 42)
+
+    def test_no_count(self):
+        self.assertIsNone(parse_count(None))
+        self.assertIsNone(parse_count(''))
+        self.assertIsNone(parse_count('no reviews'))
+
+
+if __name__ == '__main__':
+    unittest.main()